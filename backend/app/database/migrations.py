@@ -0,0 +1,14 @@
+from sqlalchemy import text
+
+# Changes to tables that already exist, create_all only creates missing ones.
+# They all run on every startup, in order, so each must be idempotent
+MIGRATIONS = [
+    # feature_flags.display_name. Not backfilled, existing rows keep NULL and are
+    # displayed by get_display_name the way they always were
+    "ALTER TABLE feature_flags ADD COLUMN IF NOT EXISTS display_name VARCHAR",
+]
+
+
+async def run_migrations(conn):
+    for migration in MIGRATIONS:
+        await conn.execute(text(migration))
@@ -1,5 +1,5 @@
-from sqlalchemy import (Boolean, CheckConstraint, Column, ForeignKey, Integer,
-                        String)
+from sqlalchemy import (JSON, BigInteger, Boolean, CheckConstraint, Column,
+                        DateTime, ForeignKey, Index, Integer, String)
 from sqlalchemy.orm import declarative_base, relationship
 
 Base = declarative_base()  # Define Base here
@@ -10,6 +10,8 @@ class FeatureFlag(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, unique=True, index=True)
+    # the name as it was typed, `name` is its normalized form
+    display_name = Column(String, nullable=True)
     is_enabled = Column(Boolean, default=False)
     parent_id = Column(Integer, ForeignKey("feature_flags.id"), nullable=True)
 
@@ -17,5 +19,80 @@ class FeatureFlag(Base):
     children = relationship("FeatureFlag", back_populates="parent")
     parent = relationship("FeatureFlag", remote_side=[id], back_populates="children")
 
-    # Add CHECK constraint
-    __table_args__ = (CheckConstraint("parent_id != id", name="check_parent_not_self"),)
+    __table_args__ = (
+        # Add CHECK constraint
+        CheckConstraint("parent_id != id", name="check_parent_not_self"),
+        # pages of root features or of a parent's children, in name order
+        Index("ix_feature_flags_parent_id_name", "parent_id", "name"),
+    )
+
+
+class FeatureFlagState(Base):
+    # single row holding the version of the whole flag set. Every write bumps it
+    # inside its own transaction, so versions are committed in order
+    __tablename__ = "feature_flag_state"
+
+    id = Column(Integer, primary_key=True)
+    version = Column(BigInteger, nullable=False, default=0)
+
+
+class FeatureFlagRules(Base):
+    # targeting rules of a feature (app.routers.v1.schemas.FeatureRules), which is
+    # then only on for the users they select. Features without any are on or off
+    # for everyone
+    __tablename__ = "feature_flag_rules"
+
+    feature_id = Column(
+        Integer, ForeignKey("feature_flags.id", ondelete="CASCADE"), primary_key=True
+    )
+    rules = Column(JSON, nullable=False)
+
+
+class FeatureFlagChange(Base):
+    # change log: the features touched by each flag set version. Written in the same
+    # transaction as the change itself, old versions are compacted away on write
+    __tablename__ = "feature_flag_changes"
+
+    version = Column(BigInteger, primary_key=True)
+    feature_id = Column(Integer, primary_key=True)
+
+
+class FeatureFlagAudit(Base):
+    # append-only history of the changes made to each feature and by whom. Written
+    # after the change is committed, in batches, by app.services.audit. No foreign
+    # key, the history of deleted features is kept
+    __tablename__ = "feature_flag_audit"
+
+    id = Column(BigInteger, primary_key=True)
+    feature_id = Column(Integer, nullable=False)
+    # create, update, delete, or cascade for children following their parent
+    action = Column(String, nullable=False)
+    actor = Column(String, nullable=True)
+    changed_at = Column(DateTime(timezone=True), nullable=False)
+    flag_set_version = Column(BigInteger, nullable=True)
+    # state after the change, only the id is known for deletes
+    name = Column(String, nullable=True)
+    is_enabled = Column(Boolean, nullable=True)
+    old_is_enabled = Column(Boolean, nullable=True)
+    parent_id = Column(Integer, nullable=True)
+
+    __table_args__ = (
+        # history of a feature, and of all features, by time range
+        Index(
+            "ix_feature_flag_audit_feature_id_changed_at", "feature_id", "changed_at"
+        ),
+        Index("ix_feature_flag_audit_changed_at", "changed_at"),
+    )
+
+
+class FeatureFlagUsage(Base):
+    # evaluations of each feature, added up from the counters of every worker by
+    # app.services.usage. Kept through renames, dropped with the feature, so a
+    # feature created again under the same name starts from zero
+    __tablename__ = "feature_flag_usage"
+
+    feature_id = Column(
+        Integer, ForeignKey("feature_flags.id", ondelete="CASCADE"), primary_key=True
+    )
+    evaluations = Column(BigInteger, nullable=False, default=0)
+    last_evaluated_at = Column(DateTime(timezone=True), nullable=True)
@@ -1,45 +1,415 @@
-from app.database.models import FeatureFlag
+import os
+from datetime import datetime
+from typing import Iterable, List, Optional
+
+from app.database.models import (FeatureFlag, FeatureFlagAudit,
+                                 FeatureFlagChange, FeatureFlagRules,
+                                 FeatureFlagState, FeatureFlagUsage)
+from app.database.session import FEATURE_CHANGES_CHANNEL, INSTANCE_ID
 from app.utility.exceptions import FeatureNotFoundException
-from sqlalchemy import delete
+from app.utility.tracing import default_tracer
+from sqlalchemy import (CTE, JSON, BigInteger, Boolean, DateTime, Integer,
+                        String, Text, and_, any_, case, cast, delete, exists,
+                        func, literal, or_, true, union_all, update)
+from sqlalchemy.dialects.postgresql import ARRAY, aggregate_order_by, insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from sqlalchemy.orm import selectinload
+from sqlalchemy.orm import aliased, selectinload
+
+# columns of a feature as read by the Core paths, no ORM objects involved
+FEATURE_COLUMNS = (
+    FeatureFlag.id,
+    FeatureFlag.name,
+    FeatureFlag.display_name,
+    FeatureFlag.is_enabled,
+    FeatureFlag.parent_id,
+)
+
+
+# NOTIFY payloads are capped at 8000 bytes by postgres. Bigger changes are announced
+# without ids, which listeners treat as "everything changed"
+FEATURE_CHANGE_NOTIFY_MAX_IDS = 500
+# number of flag set versions kept in the change log. Clients further behind
+# than that have to do a full resync
+FEATURE_CHANGE_LOG_RETENTION = int(os.getenv("FEATURE_CHANGE_LOG_RETENTION", 10000))
+
+
+def published_feature_change(changed_ids: CTE) -> CTE:
+    # CTE publishing the change made by the rest of the statement: the features
+    # in `changed_ids.c.feature_id` (nulls and duplicates are fine). If there are
+    # any, it bumps the flag set version, appends the change log (compacting it)
+    # and queues a NOTIFY, postgres delivers the notification only if the
+    # transaction commits. One row of version and ids, none if nothing changed.
+    # The statement has to select from it, or the NOTIFY is never sent
+    ids = (
+        select(changed_ids.c.feature_id)
+        .filter(changed_ids.c.feature_id.is_not(None))
+        .distinct()
+        .cte("changed_ids")
+    )
+    bumped = (
+        insert(FeatureFlagState)
+        .from_select(
+            ["id", "version"],
+            select(literal(1), literal(1)).filter(exists(select(ids.c.feature_id))),
+        )
+        .on_conflict_do_update(
+            index_elements=[FeatureFlagState.id],
+            set_={"version": FeatureFlagState.version + 1},
+        )
+        .returning(FeatureFlagState.version)
+        .cte("bumped")
+    )
+    logged = (
+        insert(FeatureFlagChange)
+        .from_select(
+            ["version", "feature_id"],
+            # one version row, for each id
+            select(bumped.c.version, ids.c.feature_id)
+            .select_from(bumped)
+            .join(ids, true()),
+        )
+        .cte("logged")
+    )
+    compacted = (
+        delete(FeatureFlagChange)
+        .where(
+            FeatureFlagChange.version
+            <= select(bumped.c.version).scalar_subquery() - FEATURE_CHANGE_LOG_RETENTION
+        )
+        .cte("compacted")
+    )
+    all_ids = select(
+        func.array_agg(aggregate_order_by(ids.c.feature_id, ids.c.feature_id))
+    ).scalar_subquery()
+    notify_ids = select(
+        case(
+            (
+                func.count() <= FEATURE_CHANGE_NOTIFY_MAX_IDS,
+                func.array_agg(aggregate_order_by(ids.c.feature_id, ids.c.feature_id)),
+            )
+        )
+    ).scalar_subquery()
+    payload = func.json_build_object(
+        "version", bumped.c.version, "ids", notify_ids, "origin", INSTANCE_ID
+    )
+    return (
+        select(
+            bumped.c.version,
+            all_ids.label("ids"),
+            func.pg_notify(FEATURE_CHANGES_CHANNEL, cast(payload, Text)).label(
+                "notified"
+            ),
+        )
+        # not referenced by the select, but data modifying CTEs always run
+        .add_cte(logged)
+        .add_cte(compacted)
+        .cte("published")
+    )
+
+
+def feature_change(published_row) -> Optional[dict]:
+    # what apply_feature_change expects, from the columns of published_feature_change
+    if published_row.version is None:
+        return None
+    return {
+        "version": published_row.version,
+        "ids": list(published_row.ids),
+        "origin": INSTANCE_ID,
+    }
+
+
+@default_tracer.traced("db")
+async def publish_feature_change(db: AsyncSession, feature_ids: Iterable[int]):
+    # Must run inside the writing transaction, before commit. For writes that
+    # can't carry published_feature_change in their own statement
+    changed_ids = select(
+        func.unnest(literal(list(feature_ids), ARRAY(Integer))).label("feature_id")
+    ).cte("changed")
+    published = published_feature_change(changed_ids)
+    result = await db.execute(select(published.c.version, published.c.ids))
+    row = result.first()
+    return feature_change(row) if row is not None else None
+
+
+@default_tracer.traced("db")
+async def get_flag_set_version(db: AsyncSession) -> int:
+    result = await db.execute(
+        select(FeatureFlagState.version).filter(FeatureFlagState.id == 1)
+    )
+    # no row yet means nothing was ever written
+    return result.scalar() or 0
+
+
+@default_tracer.traced("db")
+async def get_changed_features(db: AsyncSession, since_version: int):
+    # Returns (current version, oldest version still in the change log, features
+    # changed after `since_version` as (feature_id, FeatureFlag or None if deleted))
+    state = await db.execute(
+        select(
+            select(FeatureFlagState.version)
+            .filter(FeatureFlagState.id == 1)
+            .scalar_subquery(),
+            select(func.min(FeatureFlagChange.version)).scalar_subquery(),
+        )
+    )
+    current_version, oldest_version = state.one()
+    current_version = current_version or 0
+    if current_version <= since_version:
+        return current_version, oldest_version, []
+
+    # versions are read first, rows may be newer than current_version but never older
+    changed_ids = (
+        select(FeatureFlagChange.feature_id)
+        .filter(
+            FeatureFlagChange.version > since_version,
+            FeatureFlagChange.version <= current_version,
+        )
+        .distinct()
+        .subquery()
+    )
+    result = await db.execute(
+        select(changed_ids.c.feature_id, FeatureFlag).outerjoin(
+            FeatureFlag, FeatureFlag.id == changed_ids.c.feature_id
+        )
+    )
+    return current_version, oldest_version, result.all()
+
 
+def guarded_parent(parent_id: Optional[int]):
+    # SQL for the parent rules: the parent exists and isn't a child itself
+    if parent_id is None:
+        return true()
+    parent = aliased(FeatureFlag)
+    return exists().where(parent.id == parent_id, parent.parent_id.is_(None))
 
-async def get_feature_by_name(db: AsyncSession, name: str):
-    feature = await db.execute(select(FeatureFlag).filter(FeatureFlag.name == name))
-    return feature.scalar()
 
+def parent_checks(parent_id: Optional[int]):
+    # why guarded_parent failed, evaluated in the same statement
+    parent = aliased(FeatureFlag)
+    return (
+        exists().where(parent.id == parent_id).label("parent_found"),
+        exists()
+        .where(parent.id == parent_id, parent.parent_id.is_not(None))
+        .label("parent_nested"),
+    )
 
-async def get_feature_by_id(
-    db: AsyncSession, feature_id: int, with_children: bool = False
+
+@default_tracer.traced("db")
+async def insert_feature(
+    db: AsyncSession,
+    name: str,
+    display_name: str,
+    is_enabled: bool,
+    parent_id: Optional[int],
 ):
-    if with_children:
-        feature = await db.execute(
-            select(FeatureFlag)
-            .options(
-                selectinload(FeatureFlag.children).selectinload(FeatureFlag.children)
-            )  # Load nested children
-            .filter(FeatureFlag.id == feature_id)
+    # One statement: INSERT guarded by the parent rules, RETURNING the new row,
+    # with the change published alongside. Always returns one row; `id` is None
+    # if the guard failed, the `parent_*` columns tell why. A taken name fails on
+    # the unique index (IntegrityError), even against a concurrent insert
+    written = (
+        insert(FeatureFlag)
+        .from_select(
+            ["name", "display_name", "is_enabled", "parent_id"],
+            select(
+                literal(name, String),
+                literal(display_name, String),
+                literal(is_enabled, Boolean),
+                literal(parent_id, Integer),
+            ).filter(guarded_parent(parent_id)),
         )
-    else:
-        feature = await db.execute(
-            select(FeatureFlag).filter(FeatureFlag.id == feature_id)
+        .returning(*FEATURE_COLUMNS)
+        .cte("written")
+    )
+    # the parent's children changed as well
+    changed_ids = union_all(
+        select(written.c.id.label("feature_id")), select(written.c.parent_id)
+    ).cte("changed")
+    published = published_feature_change(changed_ids)
+    result = await db.execute(
+        select(
+            written.c.id,
+            written.c.name,
+            written.c.display_name,
+            written.c.is_enabled,
+            written.c.parent_id,
+            published.c.version,
+            published.c.ids,
+            *parent_checks(parent_id),
+        )
+        .select_from(select(literal(1)).subquery())
+        .outerjoin(written, true())
+        .outerjoin(published, true())
+    )
+    return result.one()
+
+
+def children_status_update(
+    parent_id: int, is_enabled: bool, limit: Optional[int] = None, *where
+) -> CTE:
+    # UPDATE CTE setting the status of the parent's children, never loaded. Only
+    # touches children with another status, at most `limit` of them, and returns
+    # them with their `old_is_enabled`
+    old = aliased(FeatureFlag)
+    to_update = FeatureFlag.parent_id == parent_id
+    if limit:
+        child = aliased(FeatureFlag)
+        to_update = FeatureFlag.id.in_(
+            select(child.id)
+            .filter(
+                child.parent_id == parent_id,
+                child.is_enabled.is_distinct_from(is_enabled),
+            )
+            .order_by(child.id)
+            .limit(limit)
+        )
+    return (
+        update(FeatureFlag)
+        .where(
+            to_update,
+            FeatureFlag.is_enabled.is_distinct_from(is_enabled),
+            old.id == FeatureFlag.id,
+            *where,
+        )
+        .values(is_enabled=is_enabled)
+        .returning(*FEATURE_COLUMNS, old.is_enabled.label("old_is_enabled"))
+        .cte("children_written")
+    )
+
+
+def children_json(rows, *columns: str):
+    # scalar subquery of `rows` (FEATURE_COLUMNS and `columns`) as a JSON array of
+    # objects, in id order. NULL if there are none
+    keys = [column.key for column in FEATURE_COLUMNS] + list(columns)
+    return select(
+        func.json_agg(
+            aggregate_order_by(
+                func.json_build_object(
+                    *(item for key in keys for item in (key, rows.c[key]))
+                ),
+                rows.c.id,
+            ),
+            type_=JSON,
         )
-    return feature.scalar()
+    ).scalar_subquery()
+
 
+@default_tracer.traced("db")
+async def update_children_status(
+    db: AsyncSession, parent_id: int, is_enabled: bool, limit: Optional[int] = None
+):
+    # One statement setting the status of (at most `limit` more of) the parent's
+    # children and publishing them. Returns the change and the children it wrote
+    # (dicts, see update_db_feature), None once all are done
+    children_written = children_status_update(parent_id, is_enabled, limit)
+    changed_ids = select(children_written.c.id.label("feature_id")).cte("changed")
+    published = published_feature_change(changed_ids)
+    result = await db.execute(
+        select(
+            published.c.version,
+            published.c.ids,
+            children_json(children_written, "old_is_enabled").label("children"),
+        )
+    )
+    row = result.first()
+    if row is None:
+        return None
+    return feature_change(row), row.children
 
-async def add_feature(db: AsyncSession, db_feature: FeatureFlag):
-    # add to db
-    db.add(db_feature)
-    await db.commit()
 
-    # Refresh the feature to load relationships (eagerly load children)
-    # this is to refresh the 'db_feature' object. So it is required to fetch the latest from db.
-    # This is required to fetch the auto-generated fields, for eg. 'id' and 'children'. So if not required, we can skip.
-    await db.refresh(db_feature, ["children"])
+@default_tracer.traced("db")
+async def update_db_feature(
+    db: AsyncSession,
+    feature_id: int,
+    name: str,
+    display_name: str,
+    is_enabled: bool,
+    parent_id: Optional[int],
+    children_limit: Optional[int] = None,
+):
+    # One statement: UPDATE guarded by the parent rules (and, to get a parent,
+    # the feature must have no children of its own), children follow a status
+    # change, the change is published alongside. Always returns one row; `id` is
+    # None if nothing was updated, the other columns tell why. `children` are the
+    # feature's children, as dicts, after the update (i.e. with the new status,
+    # even those beyond `children_limit`, see update_children_status); with a
+    # `children_limit`, only that many of them. `changed_children` are the
+    # children whose status it changed, with their `old_is_enabled`
+    old = aliased(FeatureFlag)
+    child = aliased(FeatureFlag)
+    has_children = exists().where(child.parent_id == feature_id)
+    guard = guarded_parent(parent_id)
+    if parent_id is not None:
+        guard = and_(guard, ~has_children)
+    written = (
+        update(FeatureFlag)
+        # the joined row is read before the update, i.e. the old values
+        .where(FeatureFlag.id == feature_id, old.id == FeatureFlag.id, guard)
+        .values(
+            name=name,
+            display_name=display_name,
+            is_enabled=is_enabled,
+            parent_id=parent_id,
+        )
+        .returning(
+            *FEATURE_COLUMNS,
+            old.parent_id.label("old_parent_id"),
+            old.is_enabled.label("old_is_enabled"),
+        )
+        .cte("written")
+    )
+    # children take the parent's status iff the parent's status is modified
+    toggled = exists().where(written.c.old_is_enabled.is_distinct_from(is_enabled))
+    children_written = children_status_update(
+        feature_id, is_enabled, children_limit, toggled
+    )
+    # the feature, its old and new parent (their children changed) and children
+    # whose status changed
+    changed_ids = union_all(
+        select(written.c.id.label("feature_id")),
+        select(written.c.parent_id),
+        select(written.c.old_parent_id),
+        select(children_written.c.id),
+    ).cte("changed")
+    published = published_feature_change(changed_ids)
+    # statements of one query all see the same snapshot, so children are read as
+    # they were before the update and get the new status applied here
+    children = select(
+        child.id,
+        child.name,
+        child.display_name,
+        case((toggled, is_enabled), else_=child.is_enabled).label("is_enabled"),
+        child.parent_id,
+    ).filter(child.parent_id == feature_id, exists(select(written.c.id)))
+    if children_limit:
+        # a family too large to update at once is too large to return, the rest
+        # is paged through GET /features?parent_id=
+        children = children.order_by(child.id).limit(children_limit)
+    children = children.subquery("children")
+    result = await db.execute(
+        select(
+            written.c.id,
+            written.c.name,
+            written.c.display_name,
+            written.c.is_enabled,
+            written.c.parent_id,
+            written.c.old_is_enabled,
+            children_json(children).label("children"),
+            children_json(children_written, "old_is_enabled").label("changed_children"),
+            published.c.version,
+            published.c.ids,
+            exists().where(old.id == feature_id).label("feature_found"),
+            has_children.label("has_children"),
+            *parent_checks(parent_id),
+        )
+        .select_from(select(literal(1)).subquery())
+        .outerjoin(written, true())
+        .outerjoin(published, true())
+    )
+    return result.one()
 
 
+@default_tracer.traced("db")
 async def get_all_db_features(db: AsyncSession, flatten: bool = False):
     if flatten:
         result = await db.execute(select(FeatureFlag))
@@ -55,12 +425,317 @@ async def get_all_db_features(db: AsyncSession, flatten: bool = False):
     return result.scalars().all()
 
 
+@default_tracer.traced("db")
+async def get_feature_rows(db: AsyncSession, feature_id: Optional[int] = None):
+    # Core read path: one SELECT of plain FEATURE_COLUMNS rows in name order, no
+    # ORM objects. Every feature, or the feature and its children
+    query = select(*FEATURE_COLUMNS)
+    if feature_id is not None:
+        query = query.filter(
+            or_(FeatureFlag.id == feature_id, FeatureFlag.parent_id == feature_id)
+        )
+    result = await db.execute(query.order_by(FeatureFlag.name))
+    return result.all()
+
+
+@default_tracer.traced("db")
+async def get_db_features_page(
+    db: AsyncSession,
+    limit: int,
+    after_name: Optional[str] = None,
+    is_enabled: Optional[bool] = None,
+    parent_id: Optional[int] = None,
+):
+    # Root features (or the children of `parent_id`) in name order, the first
+    # `limit` after `after_name`. Keyset pagination on the unique name, served by
+    # the (parent_id, name) index however deep the page is
+    query = select(*FEATURE_COLUMNS).filter(
+        FeatureFlag.parent_id.is_(None)
+        if parent_id is None
+        else FeatureFlag.parent_id == parent_id
+    )
+    if after_name is not None:
+        query = query.filter(FeatureFlag.name > after_name)
+    if is_enabled is not None:
+        query = query.filter(FeatureFlag.is_enabled == is_enabled)
+    result = await db.execute(query.order_by(FeatureFlag.name).limit(limit))
+    return result.all()
+
+
+@default_tracer.traced("db")
+async def get_db_children(
+    db: AsyncSession, parent_ids: List[int], limit: Optional[int] = None
+):
+    # children of all the given features, in name order. With a `limit`, the first
+    # that many of each, read off the (parent_id, name) index whatever the size of
+    # the family
+    if limit is None:
+        result = await db.execute(
+            select(*FEATURE_COLUMNS)
+            .filter(FeatureFlag.parent_id == any_(literal(parent_ids, ARRAY(Integer))))
+            .order_by(FeatureFlag.name)
+        )
+        return result.all()
+    parents = (
+        func.unnest(literal(parent_ids, ARRAY(Integer)))
+        .table_valued("id")
+        .render_derived(name="parents")
+    )
+    children = (
+        select(*FEATURE_COLUMNS)
+        .filter(FeatureFlag.parent_id == parents.c.id)
+        .order_by(FeatureFlag.name)
+        .limit(limit)
+        .lateral("children")
+    )
+    result = await db.execute(
+        select(children)
+        .select_from(parents)
+        .join(children, true())
+        .order_by(children.c.name)
+    )
+    return result.all()
+
+
+@default_tracer.traced("db")
 async def delete_db_feature(db: AsyncSession, feature_id: int):
     try:
-        res = await db.execute(delete(FeatureFlag).filter(FeatureFlag.id == feature_id))
-        if res.rowcount == 0:
+        res = await db.execute(
+            delete(FeatureFlag)
+            .filter(FeatureFlag.id == feature_id)
+            .returning(FeatureFlag.parent_id)
+        )
+        deleted = res.first()
+        if deleted is None:
             raise FeatureNotFoundException()
+        # parent's children changed as well
+        change = await publish_feature_change(db, [feature_id, deleted.parent_id])
         await db.commit()
+        return change
     except Exception as exc:
         await db.rollback()
         raise exc
+
+
+@default_tracer.traced("db")
+async def get_batch_features(db: AsyncSession, names: List[str], ids: List[int]):
+    # Everything a batch needs to be validated, in one query: features with any of
+    # the names (duplicates), with any of the ids (targets and parents) and the
+    # children of those ids
+    result = await db.execute(
+        select(*FEATURE_COLUMNS).filter(
+            or_(
+                FeatureFlag.name == any_(literal(names, ARRAY(String))),
+                FeatureFlag.id == any_(literal(ids, ARRAY(Integer))),
+                FeatureFlag.parent_id == any_(literal(ids, ARRAY(Integer))),
+            )
+        )
+    )
+    return result.all()
+
+
+@default_tracer.traced("db")
+async def bulk_update_features(db: AsyncSession, rows: List[dict]):
+    # rows of id, name, is_enabled and parent_id. Sent as a single executemany
+    if rows:
+        await db.execute(update(FeatureFlag), rows)
+
+
+@default_tracer.traced("db")
+async def bulk_delete_features(
+    db: AsyncSession, feature_ids: List[int], detach_children: bool = False
+):
+    # detach_children: children not deleted with their parent are deleted by a
+    # later statement of the transaction, their parent_id is cleared until then
+    if not feature_ids:
+        return
+    deleted = FeatureFlag.id == any_(literal(feature_ids, ARRAY(Integer)))
+    if detach_children:
+        await db.execute(
+            update(FeatureFlag)
+            .filter(
+                FeatureFlag.parent_id == any_(literal(feature_ids, ARRAY(Integer))),
+                ~deleted,
+            )
+            .values(parent_id=None)
+        )
+    await db.execute(delete(FeatureFlag).filter(deleted))
+
+
+@default_tracer.traced("db")
+async def bulk_insert_features(db: AsyncSession, rows: List[dict]) -> List[int]:
+    # multi-row INSERT ... RETURNING id, ids come back in the order of `rows`
+    if not rows:
+        return []
+    result = await db.execute(
+        insert(FeatureFlag).returning(FeatureFlag.id, sort_by_parameter_order=True),
+        rows,
+    )
+    return list(result.scalars().all())
+
+
+@default_tracer.traced("db")
+async def insert_audit_events(db: AsyncSession, events: List[dict]):
+    # a single multi-row INSERT
+    if events:
+        await db.execute(insert(FeatureFlagAudit).values(events))
+
+
+@default_tracer.traced("db")
+async def get_audit_events(
+    db: AsyncSession,
+    feature_id: Optional[int] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    limit: int = 100,
+):
+    # newest first, `since` included and `until` excluded
+    query = select(FeatureFlagAudit)
+    if feature_id is not None:
+        query = query.filter(FeatureFlagAudit.feature_id == feature_id)
+    if since is not None:
+        query = query.filter(FeatureFlagAudit.changed_at >= since)
+    if until is not None:
+        query = query.filter(FeatureFlagAudit.changed_at < until)
+    result = await db.execute(
+        query.order_by(
+            FeatureFlagAudit.changed_at.desc(), FeatureFlagAudit.id.desc()
+        ).limit(limit)
+    )
+    return result.scalars().all()
+
+
+@default_tracer.traced("db")
+async def upsert_feature_usage(
+    db: AsyncSession,
+    feature_ids: List[int],
+    evaluations: List[int],
+    last_evaluated_at: List[datetime],
+):
+    # One statement adding the counts to the usage of each feature, features
+    # deleted since they were counted are ignored. Rows are written in id order,
+    # so concurrent flushes of several workers lock them in the same order
+    counts = select(
+        func.unnest(literal(feature_ids, ARRAY(Integer))).label("feature_id"),
+        func.unnest(literal(evaluations, ARRAY(BigInteger))).label("evaluations"),
+        func.unnest(literal(last_evaluated_at, ARRAY(DateTime(timezone=True)))).label(
+            "last_evaluated_at"
+        ),
+    ).subquery()
+    statement = insert(FeatureFlagUsage).from_select(
+        ["feature_id", "evaluations", "last_evaluated_at"],
+        select(counts.c.feature_id, counts.c.evaluations, counts.c.last_evaluated_at)
+        .join(FeatureFlag, FeatureFlag.id == counts.c.feature_id)
+        .order_by(counts.c.feature_id),
+    )
+    await db.execute(
+        statement.on_conflict_do_update(
+            index_elements=[FeatureFlagUsage.feature_id],
+            set_={
+                "evaluations": FeatureFlagUsage.evaluations
+                + statement.excluded.evaluations,
+                "last_evaluated_at": func.greatest(
+                    FeatureFlagUsage.last_evaluated_at,
+                    statement.excluded.last_evaluated_at,
+                ),
+            },
+        )
+    )
+
+
+@default_tracer.traced("db")
+async def get_feature_usage_rows(
+    db: AsyncSession, unused_since: Optional[datetime] = None, limit: int = 100
+):
+    # every feature with its usage, least recently evaluated (never first)
+    query = select(
+        *FEATURE_COLUMNS,
+        func.coalesce(FeatureFlagUsage.evaluations, 0).label("evaluations"),
+        FeatureFlagUsage.last_evaluated_at,
+    ).outerjoin(FeatureFlagUsage, FeatureFlagUsage.feature_id == FeatureFlag.id)
+    if unused_since is not None:
+        query = query.filter(
+            or_(
+                FeatureFlagUsage.last_evaluated_at.is_(None),
+                FeatureFlagUsage.last_evaluated_at < unused_since,
+            )
+        )
+    result = await db.execute(
+        query.order_by(
+            FeatureFlagUsage.last_evaluated_at.asc().nulls_first(), FeatureFlag.name
+        ).limit(limit)
+    )
+    return result.all()
+
+
+@default_tracer.traced("db")
+async def get_db_feature_rules(db: AsyncSession, feature_id: int):
+    # (feature found, its rules or None)
+    result = await db.execute(
+        select(FeatureFlag.id, FeatureFlagRules.rules)
+        .outerjoin(FeatureFlagRules, FeatureFlagRules.feature_id == FeatureFlag.id)
+        .filter(FeatureFlag.id == feature_id)
+    )
+    row = result.first()
+    return row is not None, None if row is None else row.rules
+
+
+@default_tracer.traced("db")
+async def set_db_feature_rules(
+    db: AsyncSession, feature_id: int, rules: Optional[dict]
+):
+    # Replaces the rules of a feature, None removes them. Published like any other
+    # change of the feature and of its children, evaluated with the parent's rules.
+    # Returns None if the feature doesn't exist
+    try:
+        if rules is None:
+            await db.execute(
+                delete(FeatureFlagRules).where(
+                    FeatureFlagRules.feature_id == feature_id
+                )
+            )
+        else:
+            statement = insert(FeatureFlagRules).values(
+                feature_id=feature_id, rules=rules
+            )
+            await db.execute(
+                statement.on_conflict_do_update(
+                    index_elements=[FeatureFlagRules.feature_id],
+                    set_={"rules": statement.excluded.rules},
+                )
+            )
+        changed_ids = (
+            select(FeatureFlag.id.label("feature_id"))
+            .filter(
+                or_(FeatureFlag.id == feature_id, FeatureFlag.parent_id == feature_id)
+            )
+            .cte("changed")
+        )
+        published = published_feature_change(changed_ids)
+        result = await db.execute(select(published.c.version, published.c.ids))
+        row = result.first()
+        await db.commit()
+        return feature_change(row) if row is not None else None
+    except Exception as exc:
+        await db.rollback()
+        raise exc
+
+
+@default_tracer.traced("db")
+async def get_targeting_rules(db: AsyncSession):
+    # features with rules of their own or of their parent, with both
+    own = aliased(FeatureFlagRules)
+    parent = aliased(FeatureFlagRules)
+    result = await db.execute(
+        select(
+            FeatureFlag.id,
+            FeatureFlag.name,
+            FeatureFlag.parent_id,
+            own.rules.label("rules"),
+            parent.rules.label("parent_rules"),
+        )
+        .outerjoin(own, own.feature_id == FeatureFlag.id)
+        .outerjoin(parent, parent.feature_id == FeatureFlag.parent_id)
+        .filter(or_(own.feature_id.is_not(None), parent.feature_id.is_not(None)))
+    )
+    return result.all()
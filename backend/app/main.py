@@ -1,12 +1,27 @@
-from app.database.models import Base  # Import Base here
-from app.database.session import engine
-from app.routers import health
+from app.database.session import (FEATURE_CHANGE_LISTENER_ENABLED,
+                                  create_tables, engine,
+                                  feature_change_listener, replicas)
+from app.routers import health, metrics
 from app.routers.v1 import feature_flag
+from app.services import feature_flag as feature_flag_svc
+from app.services.audit import audit_log
+from app.services.constants import SHARED_SNAPSHOT_ENABLED
+from app.services.snapshot import snapshot_refresher
+from app.services.usage import evaluation_usage
+from app.utility.capture import (CAPTURE_SAMPLE_RATE, CaptureMiddleware,
+                                 capture_writer)
+from app.utility.metrics import MetricsMiddleware, instrument_engine
+from app.utility.profiling import PROFILING_ENABLED, ProfilingMiddleware
+from app.utility.tracing import TracingMiddleware, default_tracer
+from app.utility.tracing import instrument_engine as trace_engine
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 app = FastAPI()
 
+# the primary and every read replica
+db_engines = [engine, *replicas.engines]
+
 # Allow requests from React frontend (localhost:3000)
 app.add_middleware(
     CORSMiddleware,
@@ -14,15 +29,64 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Allow all HTTP methods (GET, POST, PUT, DELETE, etc.)
     allow_headers=["*"],  # Allow all headers
+    # conditional requests, and reading its own writes from replicas
+    expose_headers=["ETag", "X-Flag-Set-Version"],
 )
 
+# a sample of the requests recorded for tests/perf/replay.py
+if CAPTURE_SAMPLE_RATE > 0:
+    app.add_middleware(CaptureMiddleware)
+
+# stack sampling profiles of single requests, only installed when configured
+if PROFILING_ENABLED:
+    app.add_middleware(ProfilingMiddleware)
+
+# spans of requests, service calls, db operations and SQL statements
+if default_tracer.enabled:
+    app.add_middleware(TracingMiddleware)
+    for db_engine in db_engines:
+        trace_engine(db_engine.sync_engine)
+
+# request latency, in-flight requests and status codes by route, and the time
+# of every SQL statement, exposed at /metrics
+app.add_middleware(MetricsMiddleware)
+for db_engine in db_engines:
+    instrument_engine(db_engine.sync_engine)
+
 # Include routers
 app.include_router(feature_flag.router)
 app.include_router(health.router)
+app.include_router(metrics.router)
 
 
 # Create tables (for development only)
 @app.on_event("startup")
 async def startup():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    await create_tables()
+
+    # writes the audit events queued by writes, in the background
+    audit_log.start()
+    # and the evaluation counts
+    evaluation_usage.start()
+
+    # keep this worker's caches in sync with writes made by other workers
+    if FEATURE_CHANGE_LISTENER_ENABLED:
+        feature_change_listener.start(
+            feature_flag_svc.handle_feature_change_notification
+        )
+
+    # one worker of the host keeps the shared snapshot up to date
+    if SHARED_SNAPSHOT_ENABLED:
+        await feature_flag_svc.start_flag_snapshot()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await feature_change_listener.stop()
+    await snapshot_refresher.stop()
+    # write the audit events still queued, and the evaluations not counted yet
+    await audit_log.stop()
+    await evaluation_usage.stop()
+    # export the spans and write the captured requests still queued
+    default_tracer.shutdown()
+    capture_writer.shutdown()
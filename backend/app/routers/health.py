@@ -1,3 +1,7 @@
+from app.database.session import get_pool_stats, replicas
+from app.services.audit import audit_log
+from app.services.cache import feature_cache
+from app.services.usage import evaluation_usage
 from fastapi import APIRouter
 
 router = APIRouter(prefix="/health", tags=["health"])
@@ -6,3 +10,28 @@ router = APIRouter(prefix="/health", tags=["health"])
 @router.get("")
 async def create_feature():
     return {"status": "healthy"}
+
+
+@router.get("/cache")
+async def get_cache_stats():
+    return feature_cache.stats()
+
+
+@router.get("/pool")
+async def get_pool_status():
+    return get_pool_stats()
+
+
+@router.get("/replicas")
+async def get_replicas_status():
+    return replicas.stats()
+
+
+@router.get("/audit")
+async def get_audit_stats():
+    return audit_log.stats()
+
+
+@router.get("/usage")
+async def get_usage_stats():
+    return evaluation_usage.stats()
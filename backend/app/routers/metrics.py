@@ -0,0 +1,83 @@
+from app.database.session import get_pool_stats
+from app.services.cache import feature_cache
+from app.utility.metrics import default_metrics
+from fastapi import APIRouter, Response
+
+router = APIRouter(tags=["metrics"])
+
+
+def cache_metrics():
+    stats = feature_cache.stats()
+    return [
+        (
+            "feature_cache_hits_total",
+            "counter",
+            "Feature cache lookups served from memory.",
+            stats["hits"],
+        ),
+        (
+            "feature_cache_misses_total",
+            "counter",
+            "Feature cache lookups that went to the db.",
+            stats["misses"],
+        ),
+        (
+            "feature_cache_hit_ratio",
+            "gauge",
+            "Share of feature cache lookups served from memory.",
+            stats["hit_ratio"],
+        ),
+        (
+            "feature_cache_entries",
+            "gauge",
+            "Entries in the feature cache.",
+            stats["entries"],
+        ),
+    ]
+
+
+def pool_metrics():
+    stats = get_pool_stats()
+    return [
+        (
+            "db_pool_checked_out",
+            "gauge",
+            "Connections checked out of the pool.",
+            stats["checked_out"],
+        ),
+        (
+            "db_pool_overflow",
+            "gauge",
+            "Connections open beyond the pool size.",
+            stats["overflow"],
+        ),
+        (
+            "db_pool_checkouts_total",
+            "counter",
+            "Connections checked out of the pool.",
+            stats["checkouts"],
+        ),
+        (
+            "db_pool_timeouts_total",
+            "counter",
+            "Checkouts that timed out waiting for a connection.",
+            stats["timeouts"],
+        ),
+        (
+            "db_pool_wait_seconds_total",
+            "counter",
+            "Time spent waiting for a connection.",
+            stats["wait_seconds_total"],
+        ),
+    ]
+
+
+default_metrics.add_collector(cache_metrics)
+default_metrics.add_collector(pool_metrics)
+
+
+@router.get("/metrics")
+async def get_metrics():
+    return Response(
+        content=default_metrics.render(), media_type="text/plain; version=0.0.4"
+    )
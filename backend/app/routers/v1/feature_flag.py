@@ -1,35 +1,88 @@
-from app.database.session import get_db
-from app.routers.v1.schemas import AllFeaturesList, Feature, FeatureCreate
+from datetime import datetime
+from typing import Optional
+
+from app.database.session import get_db, get_read_db
+from app.routers.v1.schemas import (AllFeaturesList, BatchItemResult,
+                                    BatchRequest, BatchResult, Feature,
+                                    FeatureChanges, FeatureCreate,
+                                    FeatureEvaluationRequest,
+                                    FeatureEvaluationResponse, FeatureHistory,
+                                    FeatureRules, FeatureUsageList)
 from app.services import feature_flag as feature_flag_svc
-from app.utility.exceptions import (DeletingParentFeature,
+from app.services.cache import feature_cache
+from app.services.constants import (AUDIT_PAGE_SIZE, AUDIT_PAGE_SIZE_LIMIT,
+                                    FAST_JSON_RESPONSES, FEATURES_PAGE_SIZE,
+                                    FEATURES_PAGE_SIZE_LIMIT)
+from app.services.usage import evaluation_usage
+from app.utility.exceptions import (BatchValidationException, DBIntegrityError,
+                                    DeletingParentFeature,
                                     DuplicateFeatureNameException,
                                     FeatureNotFoundException,
+                                    InvalidCursorException,
                                     NameLengthLimitException,
                                     NestedChildException, SelfParentException)
-from fastapi import APIRouter, Depends, HTTPException
+from app.utility.tracing import default_tracer
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 
 router = APIRouter(prefix="/api/v1/features", tags=["feature"])
 
 
+EXCEPTION_MAP = {
+    DuplicateFeatureNameException: (409, "Feature with this name already exists"),
+    SelfParentException: (400, "Feature cannot be its own parent"),
+    FeatureNotFoundException: (404, "Feature or parent feature not found"),
+    NestedChildException: (400, "Only one-level relationships allowed)"),
+    NameLengthLimitException: (400, "Feature name is not within limit"),
+    DeletingParentFeature: (400, "Parent feature can't be deleted"),
+}
+
+
+def exception_status(exception):
+    return EXCEPTION_MAP.get(type(exception), (500, "Internal server error"))
+
+
 # Common function to handle exceptions
 def handle_exceptions(exception):
-    exception_map = {
-        DuplicateFeatureNameException: (409, "Feature with this name already exists"),
-        SelfParentException: (400, "Feature cannot be its own parent"),
-        FeatureNotFoundException: (404, "Feature or parent feature not found"),
-        NestedChildException: (400, "Only one-level relationships allowed)"),
-    }
-    status_code, detail = exception_map.get(
-        type(exception), (500, "Internal server error")
-    )
+    status_code, detail = exception_status(exception)
     raise HTTPException(status_code=status_code, detail=detail)
 
 
+def etag_matches(if_none_match: Optional[str], etag: Optional[str]) -> bool:
+    # If-None-Match uses the weak comparison, so W/"1" matches "1"
+    if not if_none_match or not etag:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag})
+
+
+def set_flag_set_version(response: Response):
+    # the flag set version of the write, at least. Sent back as
+    # X-Min-Flag-Set-Version, reads only go to replicas that have replayed it
+    response.headers["X-Flag-Set-Version"] = str(feature_cache.flag_set_version)
+
+
 @router.post("/", response_model=Feature)
-async def create_feature(feature: FeatureCreate, db: AsyncSession = Depends(get_db)):
+@default_tracer.traced("router")
+async def create_feature(
+    feature: FeatureCreate,
+    response: Response,
+    x_actor: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db),
+):
     try:
-        feature_response = await feature_flag_svc.create_feature(db, feature)
+        feature_response = await feature_flag_svc.create_feature(
+            db, feature, actor=x_actor
+        )
+        set_flag_set_version(response)
         return feature_response
     except NameLengthLimitException:
         raise HTTPException(status_code=400, detail="Feature name is not within limit")
@@ -50,22 +103,230 @@ async def create_feature(feature: FeatureCreate, db: AsyncSession = Depends(get_
         raise HTTPException(status_code=500, detail="Internal server error")
 
 
+@router.post("/batch", response_model=BatchResult)
+@default_tracer.traced("router")
+async def apply_batch(
+    batch: BatchRequest,
+    response: Response,
+    x_actor: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db),
+):
+    try:
+        batch_result = await feature_flag_svc.apply_batch(
+            db, batch.operations, actor=x_actor
+        )
+        set_flag_set_version(response)
+        return batch_result
+    except BatchValidationException as exc:
+        # nothing was written, report every operation
+        failed = dict(exc.errors)
+        batch_result = BatchResult()
+        for index, operation in enumerate(batch.operations):
+            if index in failed:
+                status_code, detail = exception_status(failed[index])
+            else:
+                status_code, detail = 424, "Not applied, other operations failed"
+            batch_result.results.append(
+                BatchItemResult(
+                    index=index, op=operation.op, status_code=status_code, detail=detail
+                )
+            )
+        return JSONResponse(status_code=400, content=batch_result.model_dump())
+    except DBIntegrityError:
+        raise HTTPException(
+            status_code=409, detail="Batch conflicts with a concurrent change"
+        )
+    except Exception:
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+
+@router.post("/evaluate", response_model=FeatureEvaluationResponse)
+@default_tracer.traced("router")
+async def evaluate_features(
+    evaluation_request: FeatureEvaluationRequest,
+    db: AsyncSession = Depends(get_read_db),
+):
+    try:
+        features = await feature_flag_svc.evaluate_features(
+            db, evaluation_request.names, evaluation_request.context
+        )
+        return FeatureEvaluationResponse(features=features)
+    except Exception:
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+
+# declared before /{feature_id}, otherwise "stream" is taken for an id
+@router.get("/stream")
+@default_tracer.traced("router")
+async def stream_feature_changes():
+    return StreamingResponse(
+        feature_flag_svc.stream_feature_changes(),
+        media_type="text/event-stream",
+        # don't let proxies buffer or cache the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# declared before /{feature_id}, otherwise "changes" is taken for an id
+@router.get("/changes", response_model=FeatureChanges)
+@default_tracer.traced("router")
+async def get_feature_changes(
+    since: int = Query(ge=0), db: AsyncSession = Depends(get_read_db)
+):
+    try:
+        return await feature_flag_svc.get_feature_changes(db, since)
+    except Exception:
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+
+# declared before /{feature_id}, otherwise "usage" is taken for an id
+@router.get("/usage", response_model=FeatureUsageList)
+@default_tracer.traced("router")
+async def get_feature_usage(
+    unused_since: Optional[datetime] = None,
+    limit: int = Query(FEATURES_PAGE_SIZE, ge=1, le=FEATURES_PAGE_SIZE_LIMIT),
+    db: AsyncSession = Depends(get_read_db),
+):
+    # `unused_since` keeps the features not evaluated since then, dead flags
+    try:
+        return await feature_flag_svc.get_feature_usage(db, unused_since, limit)
+    except Exception:
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+
+# declared before /{feature_id}, otherwise "history" is taken for an id
+@router.get("/history", response_model=FeatureHistory)
+@default_tracer.traced("router")
+async def get_history(
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    limit: int = Query(AUDIT_PAGE_SIZE, ge=1, le=AUDIT_PAGE_SIZE_LIMIT),
+    db: AsyncSession = Depends(get_read_db),
+):
+    try:
+        return await feature_flag_svc.get_feature_history(db, None, since, until, limit)
+    except Exception:
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+
+@router.get("/{feature_id}/history", response_model=FeatureHistory)
+@default_tracer.traced("router")
+async def get_feature_history(
+    feature_id: int,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    limit: int = Query(AUDIT_PAGE_SIZE, ge=1, le=AUDIT_PAGE_SIZE_LIMIT),
+    db: AsyncSession = Depends(get_read_db),
+):
+    # the history of deleted features is kept, so no 404
+    try:
+        return await feature_flag_svc.get_feature_history(
+            db, feature_id, since, until, limit
+        )
+    except Exception:
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+
+@router.get("/{feature_id}/rules", response_model=FeatureRules)
+@default_tracer.traced("router")
+async def get_feature_rules(feature_id: int, db: AsyncSession = Depends(get_read_db)):
+    try:
+        rules = await feature_flag_svc.get_feature_rules(db, feature_id)
+    except FeatureNotFoundException:
+        raise HTTPException(status_code=404, detail="Feature not found")
+    except Exception:
+        raise HTTPException(status_code=500, detail="Internal server error")
+    if rules is None:
+        raise HTTPException(status_code=404, detail="Feature has no targeting rules")
+    return rules
+
+
+@router.put("/{feature_id}/rules", response_model=FeatureRules)
+@default_tracer.traced("router")
+async def set_feature_rules(
+    feature_id: int,
+    rules: FeatureRules,
+    response: Response,
+    x_actor: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db),
+):
+    try:
+        rules = await feature_flag_svc.set_feature_rules(
+            db, feature_id, rules, actor=x_actor
+        )
+    except FeatureNotFoundException:
+        raise HTTPException(status_code=404, detail="Feature not found")
+    except Exception:
+        raise HTTPException(status_code=500, detail="Internal server error")
+    set_flag_set_version(response)
+    return rules
+
+
+@router.delete("/{feature_id}/rules")
+@default_tracer.traced("router")
+async def delete_feature_rules(
+    feature_id: int,
+    response: Response,
+    x_actor: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db),
+):
+    # the feature is on or off for everyone again
+    try:
+        await feature_flag_svc.set_feature_rules(db, feature_id, None, actor=x_actor)
+    except FeatureNotFoundException:
+        raise HTTPException(status_code=404, detail="Feature not found")
+    except Exception:
+        raise HTTPException(status_code=500, detail="Internal server error")
+    set_flag_set_version(response)
+
+
 @router.get("/{feature_id}", response_model=Feature)
-async def get_feature_details(feature_id: int, db: AsyncSession = Depends(get_db)):
+@default_tracer.traced("router")
+async def get_feature_details(
+    feature_id: int,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    x_min_flag_set_version: Optional[int] = Header(None),
+    db: AsyncSession = Depends(get_read_db),
+):
+    # answered from memory, no db call or serialization if the client is up to
+    # date, unless what is cached is older than the client's last write
+    etag = feature_flag_svc.get_cached_etag(feature_id, x_min_flag_set_version)
+    if etag_matches(if_none_match, etag):
+        # still a read of the feature, cached so it exists
+        evaluation_usage.count([feature_id])
+        return not_modified(etag)
+
     try:
-        return await feature_flag_svc.get_feature_details(db, feature_id)
+        feature = await feature_flag_svc.get_feature_details(
+            db, feature_id, x_min_flag_set_version
+        )
     except FeatureNotFoundException:
         raise HTTPException(status_code=404, detail="Feature not found")
     except Exception:
         raise HTTPException(status_code=500, detail="Internal server error")
 
+    etag = feature_flag_svc.get_cached_etag(feature_id)
+    if etag:
+        response.headers["ETag"] = etag
+    return feature
+
 
 @router.put("/{feature_id}", response_model=Feature)
+@default_tracer.traced("router")
 async def update_feature(
-    feature_id: int, feature_update: FeatureCreate, db: AsyncSession = Depends(get_db)
+    feature_id: int,
+    feature_update: FeatureCreate,
+    response: Response,
+    x_actor: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db),
 ):
     try:
-        return await feature_flag_svc.update_feature(db, feature_id, feature_update)
+        feature = await feature_flag_svc.update_feature(
+            db, feature_id, feature_update, actor=x_actor
+        )
+        set_flag_set_version(response)
+        return feature
     except NameLengthLimitException:
         raise HTTPException(status_code=400, detail="Feature name is not within limit")
     except DuplicateFeatureNameException:
@@ -86,17 +347,87 @@ async def update_feature(
 
 
 @router.get("", response_model=AllFeaturesList)
-async def get_all_features(db: AsyncSession = Depends(get_db)):
+@default_tracer.traced("router")
+async def get_all_features(
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=FEATURES_PAGE_SIZE_LIMIT),
+    cursor: Optional[str] = None,
+    is_enabled: Optional[bool] = None,
+    parent_id: Optional[int] = None,
+    if_none_match: Optional[str] = Header(None),
+    x_min_flag_set_version: Optional[int] = Header(None),
+    db: AsyncSession = Depends(get_read_db),
+):
+    # any of these asks for one page instead of the whole (cached) tree
+    if (limit, cursor, is_enabled, parent_id) != (None, None, None, None):
+        try:
+            return await feature_flag_svc.get_features_page(
+                db, limit or FEATURES_PAGE_SIZE, cursor, is_enabled, parent_id
+            )
+        except InvalidCursorException:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        except Exception:
+            raise HTTPException(status_code=500, detail="Internal server error")
+
+    # shared by all the workers of the host: no db call, nothing built or copied
+    snapshot = feature_flag_svc.get_shared_snapshot(x_min_flag_set_version)
+    if snapshot is not None:
+        etag = f'"{snapshot.flag_set_version}"'
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
+        return Response(
+            content=snapshot.features_json,
+            media_type="application/json",
+            headers={"ETag": etag},
+        )
+
+    cache_key = (
+        feature_flag_svc.ALL_FEATURES_JSON_CACHE_KEY
+        if FAST_JSON_RESPONSES
+        else feature_flag_svc.ALL_FEATURES_CACHE_KEY
+    )
+    # answered from memory, no db call or serialization if the client is up to
+    # date, unless what is cached is older than the client's last write
+    etag = feature_flag_svc.get_cached_etag(cache_key, x_min_flag_set_version)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+
     try:
-        return await feature_flag_svc.get_all_features(db)
+        if FAST_JSON_RESPONSES:
+            # bytes as they go on the wire, response_model is bypassed
+            content = await feature_flag_svc.get_all_features_json(
+                db, x_min_flag_set_version
+            )
+        else:
+            all_features = await feature_flag_svc.get_all_features(
+                db, x_min_flag_set_version
+            )
     except Exception:
         raise HTTPException(status_code=500, detail="Internal server error")
 
+    etag = feature_flag_svc.get_cached_etag(cache_key)
+    if FAST_JSON_RESPONSES:
+        return Response(
+            content=content,
+            media_type="application/json",
+            headers={"ETag": etag} if etag else None,
+        )
+    if etag:
+        response.headers["ETag"] = etag
+    return all_features
+
 
 @router.delete("/{feature_id}")
-async def delete_feature(feature_id: int, db: AsyncSession = Depends(get_db)):
+@default_tracer.traced("router")
+async def delete_feature(
+    feature_id: int,
+    response: Response,
+    x_actor: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db),
+):
     try:
-        await feature_flag_svc.delete_feature(db, feature_id)
+        await feature_flag_svc.delete_feature(db, feature_id, actor=x_actor)
+        set_flag_set_version(response)
     except FeatureNotFoundException:
         raise HTTPException(status_code=404, detail="Feature not found")
     except DeletingParentFeature:
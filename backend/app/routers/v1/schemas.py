@@ -1,6 +1,10 @@
-from typing import List, Optional
+from datetime import datetime
+from typing import Dict, List, Literal, Optional, Union
 
-from pydantic import BaseModel
+from app.services.constants import (BATCH_OPERATIONS_LIMIT,
+                                    EVALUATE_NAMES_LIMIT, RULE_VALUES_LIMIT,
+                                    RULES_LIMIT)
+from pydantic import BaseModel, Field, model_validator
 
 
 class FeatureBase(BaseModel):
@@ -27,3 +31,152 @@ Feature.update_forward_refs()
 
 class AllFeaturesList(BaseModel):
     features: Optional[List["Feature"]] = []
+    # paginated lists only: pass as `cursor` to get the next page, None on the last
+    next_cursor: Optional[str] = None
+    # paginated lists only: root id -> `cursor` of the rest of its children, for
+    # the roots with more children than the page size (get them with `parent_id`)
+    children_cursors: Dict[int, str] = {}
+
+
+class FeatureSummary(FeatureBase):
+    # a single feature without its children
+    id: int
+
+    class Config:
+        from_attributes = True
+
+
+class FeatureChanges(BaseModel):
+    # cursor to pass as `since` next time
+    version: int
+    # the requested version is no longer in the change log, fetch the full list
+    resync: bool = False
+    upserted: List[FeatureSummary] = []
+    deleted: List[int] = []
+
+
+# a value of the evaluation context, or of a rule condition
+ContextValue = Union[str, int, float, bool]
+
+
+class FeatureEvaluationRequest(BaseModel):
+    names: List[str] = Field(max_length=EVALUATE_NAMES_LIMIT)
+    # the user the features are evaluated for, e.g. {"user_id": "42",
+    # "country": "IN"}. Only used by features with targeting rules
+    context: Dict[str, ContextValue] = {}
+
+
+class FeatureEvaluationResponse(BaseModel):
+    # requested name -> effective state (parent's state taken into account)
+    features: Dict[str, bool] = {}
+
+
+class BatchOperation(BaseModel):
+    op: Literal["create", "update", "delete"]
+    # feature to update or delete
+    id: Optional[int] = None
+    name: Optional[str] = None
+    is_enabled: Optional[bool] = None
+    parent_id: Optional[int] = None
+    # create only: `ref` names the new feature within the batch, so that later
+    # creates can use it as their parent through `parent_ref`
+    ref: Optional[str] = None
+    parent_ref: Optional[str] = None
+
+    @model_validator(mode="after")
+    def check_fields(self):
+        if self.op in ("update", "delete") and self.id is None:
+            raise ValueError(f"'{self.op}' needs the id of the feature")
+        if self.op in ("create", "update") and (
+            self.name is None or self.is_enabled is None
+        ):
+            raise ValueError(f"'{self.op}' needs name and is_enabled")
+        if self.op != "create" and (self.ref or self.parent_ref):
+            raise ValueError("ref and parent_ref can only be used to create")
+        if self.parent_id is not None and self.parent_ref is not None:
+            raise ValueError("use either parent_id or parent_ref")
+        return self
+
+
+class BatchRequest(BaseModel):
+    operations: List[BatchOperation] = Field(max_length=BATCH_OPERATIONS_LIMIT)
+
+    @model_validator(mode="after")
+    def check_refs_unique(self):
+        refs = [operation.ref for operation in self.operations if operation.ref]
+        if len(refs) != len(set(refs)):
+            raise ValueError("refs must be unique within a batch")
+        return self
+
+
+class BatchItemResult(BaseModel):
+    # position of the operation in the request
+    index: int
+    op: str
+    status_code: int
+    feature: Optional[FeatureSummary] = None
+    detail: Optional[str] = None
+
+
+class BatchResult(BaseModel):
+    results: List[BatchItemResult] = []
+
+
+class AuditEvent(BaseModel):
+    id: int
+    feature_id: int
+    # create, update, delete, or cascade for children following their parent
+    action: str
+    # X-Actor header of the request that made the change
+    actor: Optional[str] = None
+    changed_at: datetime
+    flag_set_version: Optional[int] = None
+    # state after the change, only the id is known for deletes
+    name: Optional[str] = None
+    is_enabled: Optional[bool] = None
+    old_is_enabled: Optional[bool] = None
+    parent_id: Optional[int] = None
+
+    class Config:
+        from_attributes = True
+
+
+class FeatureHistory(BaseModel):
+    # newest first
+    events: List[AuditEvent] = []
+
+
+class FeatureUsage(BaseModel):
+    id: int
+    name: str
+    # evaluations counted since the feature has had its name
+    evaluations: int = 0
+    # None if never evaluated
+    last_evaluated_at: Optional[datetime] = None
+
+
+class FeatureUsageList(BaseModel):
+    # least recently evaluated first
+    features: List[FeatureUsage] = []
+
+
+class RuleCondition(BaseModel):
+    # the context attribute is (in) or isn't (not_in) one of `values`. A missing
+    # attribute is in none
+    attribute: str
+    operator: Literal["in", "not_in"] = "in"
+    values: List[ContextValue] = Field(max_length=RULE_VALUES_LIMIT)
+
+
+class TargetingRule(BaseModel):
+    # users matching all the conditions, `rollout` percent of them
+    conditions: List[RuleCondition] = []
+    rollout: float = Field(100, ge=0, le=100)
+
+
+class FeatureRules(BaseModel):
+    # The first rule whose conditions match decides, the feature is off for users
+    # matching none. Always off if the feature is disabled, or its parent is off
+    rules: List[TargetingRule] = Field(max_length=RULES_LIMIT)
+    # context attribute rollouts bucket users by, a user missing it is left out
+    rollout_key: str = "user_id"
@@ -0,0 +1,145 @@
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime, timezone
+from typing import Optional
+
+from app.database.operations import insert_audit_events
+from app.database.session import AsyncSessionLocal
+from app.services.constants import (AUDIT_BATCH_SIZE, AUDIT_ENABLED,
+                                    AUDIT_FLUSH_SECONDS, AUDIT_QUEUE_SIZE)
+
+logger = logging.getLogger(__name__)
+
+
+def audit_event(
+    feature_id: int,
+    action: str,
+    actor: Optional[str] = None,
+    flag_set_version: Optional[int] = None,
+    name: Optional[str] = None,
+    is_enabled: Optional[bool] = None,
+    old_is_enabled: Optional[bool] = None,
+    parent_id: Optional[int] = None,
+) -> dict:
+    # a row of the audit table, timed now rather than when it is written
+    return {
+        "feature_id": feature_id,
+        "action": action,
+        "actor": actor,
+        "changed_at": datetime.now(timezone.utc),
+        "flag_set_version": flag_set_version,
+        "name": name,
+        "is_enabled": is_enabled,
+        "old_is_enabled": old_is_enabled,
+        "parent_id": parent_id,
+    }
+
+
+class AuditLog:
+    """
+    Write-behind audit log. Writes queue their changes with record(), which
+    never waits on the db, and a background task inserts them in batches: as
+    soon as `batch_size` are queued, or every `flush_seconds`. stop() writes
+    what is still queued.
+
+    Changes are recorded once committed, so a process dying before its queue is
+    flushed loses them; the changes themselves are never held up or rolled back
+    by the audit.
+    """
+
+    def __init__(
+        self,
+        session_factory=AsyncSessionLocal,
+        batch_size: int = AUDIT_BATCH_SIZE,
+        flush_seconds: float = AUDIT_FLUSH_SECONDS,
+        queue_size: int = AUDIT_QUEUE_SIZE,
+        enabled: bool = AUDIT_ENABLED,
+    ):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.queue_size = queue_size
+        self.enabled = enabled
+        self.queue: deque = deque()
+        self.written = 0
+        self.dropped = 0
+        self.failed_flushes = 0
+        self._full: Optional[asyncio.Event] = None
+        self._stopping = False
+        self._task: Optional[asyncio.Task] = None
+
+    def record(self, *events: dict):
+        if not self.enabled:
+            return
+        for event in events:
+            if len(self.queue) >= self.queue_size:
+                self.dropped += 1
+                continue
+            self.queue.append(event)
+        if self._full is not None and len(self.queue) >= self.batch_size:
+            self._full.set()
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._full = asyncio.Event()
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            # not cancelled, a batch being written would be lost
+            self._stopping = True
+            self._full.set()
+            await self._task
+            self._task = None
+            self._full = None
+        # drain the queue, until a flush fails
+        while self.queue and await self.flush():
+            pass
+
+    async def flush(self) -> bool:
+        # writes one batch, put back in the queue if that fails
+        batch = [
+            self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))
+        ]
+        if not batch:
+            return True
+        try:
+            async with self.session_factory() as db:
+                await insert_audit_events(db, batch)
+                await db.commit()
+        except Exception:
+            logger.exception("Failed to write %s audit events", len(batch))
+            self.failed_flushes += 1
+            room = self.queue_size - len(self.queue)
+            self.dropped += max(0, len(batch) - room)
+            self.queue.extendleft(reversed(batch[:room]))
+            return False
+        self.written += len(batch)
+        return True
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            if self._stopping:
+                return
+            self._full.clear()
+            # a full queue takes several batches, a failing db one attempt a tick
+            while self.queue and await self.flush():
+                if len(self.queue) < self.batch_size:
+                    break
+
+    def stats(self) -> dict:
+        return {
+            "queued": len(self.queue),
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed_flushes": self.failed_flushes,
+        }
+
+
+audit_log = AuditLog()
@@ -0,0 +1,154 @@
+import asyncio
+import time
+from typing import (Any, Awaitable, Callable, Dict, Hashable, Iterable,
+                    Optional, Tuple)
+
+from app.services.constants import FEATURE_CACHE_TTL_SECONDS
+
+
+class FeatureCache:
+    """
+    In-process cache for fully built feature responses.
+
+    Every invalidation bumps `version`. A value is only stored if it was built
+    against the current version, so a read that raced with a write can never
+    put stale data back into the cache.
+
+    Each entry also remembers the flag set version (feature_flag_state.version)
+    read before its data was loaded, which is what its ETag is built from.
+
+    Reads can ask for data at least as recent as a flag set version (a client's
+    own write), older entries are then treated as missing.
+
+    Integer keys hold data of a single feature (its details) and are dropped only
+    when that feature changes. Any other key holds data built from the whole flag
+    set and is dropped on every change.
+    """
+
+    def __init__(self, ttl_seconds: float = FEATURE_CACHE_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self.clear()
+
+    def clear(self):
+        self.version = 0
+        # latest flag set version (feature_flag_state.version) this worker has seen
+        self.flag_set_version = 0
+        self.hits = 0
+        self.misses = 0
+        # key -> (value, stored_at, flag_set_version)
+        self._entries: Dict[Hashable, Tuple[Any, float, Optional[int]]] = {}
+        self.lock = asyncio.Lock()
+
+    def _fresh_entry(self, key: Hashable, min_flag_set_version: Optional[int] = None):
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() - entry[1] >= self.ttl_seconds:
+            return None
+        if min_flag_set_version and (entry[2] or 0) < min_flag_set_version:
+            return None
+        return entry
+
+    def peek(
+        self, key: Hashable, min_flag_set_version: Optional[int] = None
+    ) -> Optional[Any]:
+        # same as get() but without touching the hit/miss counters
+        entry = self._fresh_entry(key, min_flag_set_version)
+        return None if entry is None else entry[0]
+
+    def peek_flag_set_version(
+        self, key: Hashable, min_flag_set_version: Optional[int] = None
+    ) -> Optional[int]:
+        entry = self._fresh_entry(key, min_flag_set_version)
+        return None if entry is None else entry[2]
+
+    def get(
+        self, key: Hashable, min_flag_set_version: Optional[int] = None
+    ) -> Optional[Any]:
+        value = self.peek(key, min_flag_set_version)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(
+        self,
+        key: Hashable,
+        value: Any,
+        version: int,
+        flag_set_version: Optional[int] = None,
+    ) -> bool:
+        # `version` is the cache version read before building the value,
+        # `flag_set_version` the db version read before loading its data
+        if version != self.version or self.ttl_seconds <= 0:
+            return False
+        # read from a replica lagging behind a change this worker already applied
+        if flag_set_version is not None and flag_set_version < self.flag_set_version:
+            return False
+        self._entries[key] = (value, time.monotonic(), flag_set_version)
+        self.observe_flag_set_version(flag_set_version)
+        return True
+
+    async def get_or_build(
+        self,
+        key: Hashable,
+        build: Callable[[], Awaitable[Any]],
+        read_flag_set_version: Optional[Callable[[], Awaitable[int]]] = None,
+        min_flag_set_version: Optional[int] = None,
+    ):
+        cached_value = self.get(key, min_flag_set_version)
+        if cached_value is not None:
+            return cached_value
+
+        # only one caller per worker builds the value, the rest wait for it
+        async with self.lock:
+            cached_value = self.peek(key, min_flag_set_version)
+            if cached_value is not None:
+                return cached_value
+
+            version = self.version
+            flag_set_version = None
+            if read_flag_set_version is not None:
+                flag_set_version = await read_flag_set_version()
+            value = await build()
+            self.set(key, value, version, flag_set_version)
+        return value
+
+    def invalidate(self, feature_ids: Optional[Iterable[int]] = None):
+        # feature_ids=None means anything may have changed
+        self.version += 1
+        if feature_ids is None:
+            self._entries.clear()
+            return
+        feature_ids = set(feature_ids)
+        self._entries = {
+            key: entry
+            for key, entry in self._entries.items()
+            if isinstance(key, int) and key not in feature_ids
+        }
+
+    def observe_flag_set_version(self, flag_set_version: Optional[int]):
+        # versions can arrive out of order, never go back
+        if flag_set_version is not None and flag_set_version > self.flag_set_version:
+            self.flag_set_version = flag_set_version
+
+    def apply_change(
+        self, feature_ids: Optional[Iterable[int]], flag_set_version: Optional[int]
+    ):
+        self.invalidate(feature_ids)
+        self.observe_flag_set_version(flag_set_version)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "version": self.version,
+            "flag_set_version": self.flag_set_version,
+            "entries": len(self._entries),
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+        }
+
+
+# one cache per worker process
+feature_cache = FeatureCache()
@@ -1,2 +1,76 @@
+import os
+import tempfile
+
 FEATURE_NAME_LOWER_LIMIT = 1
 FEATURE_NAME_UPPER_LIMIT = 50
+
+# max number of feature names accepted by a single evaluate request
+EVALUATE_NAMES_LIMIT = 1000
+
+# max number of targeting rules of a feature, and of values of a rule condition
+RULES_LIMIT = 100
+RULE_VALUES_LIMIT = 1000
+
+# page size of the feature list when paginated, and the largest one accepted
+FEATURES_PAGE_SIZE = 100
+FEATURES_PAGE_SIZE_LIMIT = 1000
+
+# max number of operations accepted by a single batch request
+BATCH_OPERATIONS_LIMIT = 5000
+
+# serve the full feature list as JSON bytes built straight from the db rows,
+# skipping response model validation (install orjson to make it faster still)
+FAST_JSON_RESPONSES = os.getenv("FAST_JSON_RESPONSES", "false").lower() == "true"
+
+# children of a parent whose status changes are updated this many per statement,
+# to keep statements small for very large families, and the update returns that
+# many children at most. 0 updates and returns them all at once
+CHILDREN_UPDATE_CHUNK_SIZE = int(os.getenv("CHILDREN_UPDATE_CHUNK_SIZE", 0))
+
+# how long (in seconds) a cached feature snapshot is served before it is rebuilt
+# writes invalidate the cache immediately, the TTL is only a safety net. 0 disables caching
+FEATURE_CACHE_TTL_SECONDS = float(os.getenv("FEATURE_CACHE_TTL_SECONDS", 30))
+
+# per client buffer of the change stream, a client falling further behind is
+# disconnected with a resync event
+FEATURE_EVENTS_QUEUE_SIZE = int(os.getenv("FEATURE_EVENTS_QUEUE_SIZE", 100))
+# seconds between keep-alive comments on an idle change stream
+FEATURE_EVENTS_HEARTBEAT_SECONDS = float(
+    os.getenv("FEATURE_EVENTS_HEARTBEAT_SECONDS", 15)
+)
+
+# serve the feature list and evaluations from a snapshot file shared by all the
+# workers of a host, written by only one of them. /dev/shm keeps it in memory
+SHARED_SNAPSHOT_ENABLED = (
+    os.getenv("SHARED_SNAPSHOT_ENABLED", "false").lower() == "true"
+)
+SNAPSHOT_PATH = os.getenv(
+    "SNAPSHOT_PATH",
+    (
+        "/dev/shm/feature-core-flags.snapshot"
+        if os.path.isdir("/dev/shm")
+        else os.path.join(tempfile.gettempdir(), "feature-core-flags.snapshot")
+    ),
+)
+# seconds between checks for missed changes by the refreshing worker, and between
+# attempts of the others to take over from it
+SNAPSHOT_REFRESH_SECONDS = float(os.getenv("SNAPSHOT_REFRESH_SECONDS", 5))
+
+# changes are queued in memory and written to the audit table in the background,
+# AUDIT_BATCH_SIZE rows per INSERT or every AUDIT_FLUSH_SECONDS. Past
+# AUDIT_QUEUE_SIZE queued changes, new ones are dropped (and counted)
+AUDIT_ENABLED = os.getenv("AUDIT_ENABLED", "true").lower() == "true"
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", 500))
+AUDIT_FLUSH_SECONDS = float(os.getenv("AUDIT_FLUSH_SECONDS", 1))
+AUDIT_QUEUE_SIZE = int(os.getenv("AUDIT_QUEUE_SIZE", 10000))
+
+# page size of the change history, and the largest one accepted
+AUDIT_PAGE_SIZE = 100
+AUDIT_PAGE_SIZE_LIMIT = 1000
+
+# evaluations of each feature are counted in memory, and added to the usage table
+# every USAGE_FLUSH_SECONDS. Features beyond USAGE_MAX_FEATURES distinct ones
+# between two flushes aren't counted
+USAGE_ENABLED = os.getenv("USAGE_ENABLED", "true").lower() == "true"
+USAGE_FLUSH_SECONDS = float(os.getenv("USAGE_FLUSH_SECONDS", 10))
+USAGE_MAX_FEATURES = int(os.getenv("USAGE_MAX_FEATURES", 100000))
@@ -0,0 +1,64 @@
+import asyncio
+import json
+from typing import Optional, Set
+
+from app.services.constants import FEATURE_EVENTS_QUEUE_SIZE
+
+# sent instead of the missed events, clients should fetch the list (or the delta) again
+RESYNC_FRAME = b"event: resync\ndata: {}\n\n"
+
+
+class Subscription:
+    def __init__(self, queue_size: int):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        # set when the subscriber fell too far behind, it gets a resync and is closed
+        self.overflowed = False
+
+
+class ChangeHub:
+    """
+    Fans feature change events out to the streaming clients of this worker.
+
+    Every event is encoded once and the same bytes are queued for all subscribers.
+    Publishing never waits on a subscriber: one whose bounded queue is full is
+    marked as overflowed and dropped, instead of slowing everybody else down.
+    Events are not deduplicated, a worker skips the notifications of its own
+    writes so every change is published exactly once.
+    """
+
+    def __init__(self, queue_size: int = FEATURE_EVENTS_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.subscribers: Set[Subscription] = set()
+        self.published = 0
+        self.overflows = 0
+
+    def subscribe(self) -> Subscription:
+        subscription = Subscription(self.queue_size)
+        self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self.subscribers.discard(subscription)
+
+    def publish(self, change: Optional[dict]):
+        # `change` is a change payload (version + ids), None if changes were missed
+        if change is None:
+            frame = RESYNC_FRAME
+        else:
+            data = json.dumps({"version": change["version"], "ids": change["ids"]})
+            frame = f"id: {change['version']}\nevent: change\ndata: {data}\n\n".encode()
+
+        self.published += 1
+        for subscription in list(self.subscribers):
+            try:
+                subscription.queue.put_nowait(frame)
+            except asyncio.QueueFull:
+                # the queue is full, so the stream wakes up right away and
+                # sends a resync instead of what is left in there
+                self.overflows += 1
+                subscription.overflowed = True
+                self.unsubscribe(subscription)
+
+
+# one hub per worker process, fed by local writes and the LISTEN connection
+change_hub = ChangeHub()
@@ -1,205 +1,721 @@
-from app.database.models import FeatureFlag
-from app.database.operations import (add_feature, delete_db_feature,
-                                     get_all_db_features, get_feature_by_id,
-                                     get_feature_by_name)
-from app.routers.v1.schemas import AllFeaturesList, Feature, FeatureCreate
-from app.services.constants import (FEATURE_NAME_LOWER_LIMIT,
-                                    FEATURE_NAME_UPPER_LIMIT)
-from app.utility.exceptions import (DBIntegrityError, DeletingParentFeature,
+import asyncio
+import base64
+import json
+from collections import defaultdict
+from datetime import datetime
+from itertools import groupby
+from operator import itemgetter
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Tuple
+
+from app.database.operations import (bulk_delete_features,
+                                     bulk_insert_features,
+                                     bulk_update_features, delete_db_feature,
+                                     feature_change, get_audit_events,
+                                     get_batch_features, get_changed_features,
+                                     get_db_children, get_db_feature_rules,
+                                     get_db_features_page, get_feature_rows,
+                                     get_feature_usage_rows,
+                                     get_flag_set_version, get_targeting_rules,
+                                     insert_feature, publish_feature_change,
+                                     set_db_feature_rules,
+                                     update_children_status, update_db_feature)
+from app.database.session import INSTANCE_ID, AsyncSessionLocal
+from app.routers.v1.schemas import (AllFeaturesList, AuditEvent,
+                                    BatchItemResult, BatchOperation,
+                                    BatchResult, Feature, FeatureChanges,
+                                    FeatureCreate, FeatureHistory,
+                                    FeatureRules, FeatureSummary, FeatureUsage,
+                                    FeatureUsageList)
+from app.services.audit import audit_event, audit_log
+from app.services.cache import feature_cache
+from app.services.constants import (CHILDREN_UPDATE_CHUNK_SIZE,
+                                    FEATURE_EVENTS_HEARTBEAT_SECONDS,
+                                    FEATURE_NAME_LOWER_LIMIT,
+                                    FEATURE_NAME_UPPER_LIMIT,
+                                    SHARED_SNAPSHOT_ENABLED)
+from app.services.events import RESYNC_FRAME, change_hub
+from app.services.rules import Evaluator, build_targeting_index, compiled_rules
+from app.services.snapshot import (Snapshot, encode_snapshot, flag_snapshot,
+                                   snapshot_refresher)
+from app.services.usage import evaluation_usage
+from app.utility.exceptions import (BatchValidationException, DBIntegrityError,
+                                    DeletingParentFeature,
                                     DuplicateFeatureNameException,
                                     FeatureNotFoundException,
+                                    InvalidCursorException,
                                     NameLengthLimitException,
                                     NestedChildException, SelfParentException)
-from app.utility.utils import denormalize_name, normalize_name
+from app.utility.tracing import default_tracer
+from app.utility.utils import denormalize_name, dumps_json, normalize_name
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 
+ALL_FEATURES_CACHE_KEY = "all_features"
+EVALUATION_INDEX_CACHE_KEY = "evaluation_index"
+TARGETING_INDEX_CACHE_KEY = "targeting_index"
+SNAPSHOT_TARGETING_INDEX_CACHE_KEY = "snapshot_targeting_index"
+ALL_FEATURES_JSON_CACHE_KEY = "all_features_json"
+# constraint violated by a write -> exception raised instead of DBIntegrityError
+CONSTRAINT_EXCEPTIONS = {
+    "ix_feature_flags_name": DuplicateFeatureNameException,
+    "check_parent_not_self": SelfParentException,
+    # the parent was deleted meanwhile
+    "feature_flags_parent_id_fkey": FeatureNotFoundException,
+    # rules of a feature deleted meanwhile
+    "feature_flag_rules_feature_id_fkey": FeatureNotFoundException,
+}
 
-async def validate_parent(
-    db: AsyncSession, parent_id: int, db_feature_with_children: FeatureFlag = None
-):
-    # Rule 1: A feature can't be its own parent
-    if (
-        parent_id
-        and db_feature_with_children
-        and parent_id == db_feature_with_children.id
+
+def apply_feature_change(change: dict = None):
+    # `change` is what publish_feature_change returned. None means we don't know
+    # what changed, so drop everything
+    if change is None:
+        feature_cache.invalidate()
+        compiled_rules.invalidate()
+    else:
+        feature_cache.apply_change(change["ids"], change["version"])
+        compiled_rules.invalidate(change["ids"])
+    # let streaming clients know
+    change_hub.publish(change)
+    # and the snapshot refresher, if this worker runs it
+    snapshot_refresher.notify()
+
+
+def handle_feature_change_notification(change: dict = None):
+    # called by the LISTEN connection for writes made by any worker. None is
+    # passed on (re)connect, as notifications may have been missed meanwhile
+    if change is not None and change.get("origin") == INSTANCE_ID:
+        # our own write, already applied when it was committed
+        return
+    apply_feature_change(change)
+
+
+def get_cached_etag(
+    cache_key, min_flag_set_version: Optional[int] = None
+) -> Optional[str]:
+    # Strong ETag for the data cached under `cache_key`: the flag set version it
+    # was built at. None if that data isn't cached, or older than
+    # `min_flag_set_version`
+    flag_set_version = feature_cache.peek_flag_set_version(
+        cache_key, min_flag_set_version
+    )
+    if flag_set_version is None:
+        return None
+    return f'"{flag_set_version}"'
+
+
+def clean_feature_name(name: str) -> str:
+    # name without surrounding spaces, if it is within the length limits
+    if name:
+        name = name.strip()
+    if (not name) or (
+        len(name) < FEATURE_NAME_LOWER_LIMIT or len(name) > FEATURE_NAME_UPPER_LIMIT
     ):
-        raise SelfParentException()
+        raise NameLengthLimitException()
+    return name
 
-    # Rule 2: Parent must exist (if provided)
-    if parent_id is not None:
-        parent = await get_feature_by_id(db, parent_id)
-        if not parent:
-            raise FeatureNotFoundException()
 
-        # Rule 3: Parent must not have its own parent (no nested relationships)
-        if parent.parent_id is not None:
-            raise NestedChildException()
+def parent_exception(written) -> Exception:
+    # why a guarded write of insert_feature or update_db_feature wrote nothing
+    if not written.parent_found:
+        return FeatureNotFoundException()
+    # the parent is a child itself, or the feature has children of its own
+    return NestedChildException()
 
-    # Rule 4: current feature should not be a parent of any other feature. Basically it shouldn't have any child
-    if parent_id and db_feature_with_children and db_feature_with_children.children:
-        raise NestedChildException()
 
+def integrity_error_exception(exc: IntegrityError) -> Exception:
+    # asyncpg's exception, with the name of the violated constraint, is the cause
+    cause = getattr(exc.orig, "__cause__", None)
+    constraint_name = getattr(cause, "constraint_name", None)
+    return CONSTRAINT_EXCEPTIONS.get(constraint_name, DBIntegrityError)()
 
-async def check_feature_name_exists(db: AsyncSession, name: str):
-    # Check if a feature with the same name already exists
-    existing_feature = await get_feature_by_name(db, name)
-    if existing_feature:
-        return True
-    return False
 
+def get_display_name(name: str, display_name: Optional[str]) -> str:
+    # the name as it was typed. Rows written before it was stored get the
+    # denormalized name instead
+    return display_name if display_name is not None else denormalize_name(name)
 
-def dernomalize_feature_and_children_names(feature: Feature):
-    # Denormalize names for response
-    feature.name = denormalize_name(feature.name)
-    for child in feature.children:
-        child.name = denormalize_name(child.name)
 
+def feature_from_row(row) -> Feature:
+    # response model for a row of FEATURE_COLUMNS, without children. Not validated
+    # again, the values come from the db
+    return Feature.model_construct(
+        id=row.id,
+        name=get_display_name(row.name, row.display_name),
+        is_enabled=row.is_enabled,
+        parent_id=row.parent_id,
+        children=[],
+    )
 
-async def create_feature(db: AsyncSession, feature: FeatureCreate):
-    try:
-        if feature.name:
-            feature.name = feature.name.strip()
-        if (not feature.name) or (
-            len(feature.name) < FEATURE_NAME_LOWER_LIMIT
-            or len(feature.name) > FEATURE_NAME_UPPER_LIMIT
-        ):
-            raise NameLengthLimitException()
 
-        # Normalize the feature name
-        normalized_name = normalize_name(feature.name)
+def written_feature_response(written, children=()) -> Feature:
+    # response for a feature row returned by a write, children as dicts
+    feature_response = feature_from_row(written)
+    feature_response.children = [
+        feature_from_row(SimpleNamespace(**child)) for child in children
+    ]
+    return feature_response
 
-        # Check if a feature with the same name already exists
-        if await check_feature_name_exists(db, normalized_name):
-            raise DuplicateFeatureNameException()
 
-        # Validate parent rules
-        await validate_parent(db, feature.parent_id)
+def flag_set_version_of(changes) -> Optional[int]:
+    # version of the last of the changes made by a write
+    versions = [change["version"] for change in changes if change is not None]
+    return max(versions, default=None)
 
-        # Create feature with normalized name
-        db_feature = FeatureFlag(
-            name=normalized_name,
-            is_enabled=feature.is_enabled,
-            parent_id=feature.parent_id,
-        )
-        await add_feature(db, db_feature)
 
-        # Convert SQLAlchemy model to Pydantic model
-        feature_response = Feature.model_validate(db_feature)
+def audit_written(
+    action: str,
+    written,
+    actor: Optional[str],
+    changes,
+    old_is_enabled: Optional[bool] = None,
+    changed_children=(),
+) -> List[dict]:
+    # audit events of a feature row returned by a write, and of the children whose
+    # status the write changed to follow the parent's (dicts, see update_db_feature)
+    flag_set_version = flag_set_version_of(changes)
+    events = [
+        audit_event(
+            written.id,
+            action,
+            actor,
+            flag_set_version,
+            get_display_name(written.name, written.display_name),
+            written.is_enabled,
+            old_is_enabled,
+            written.parent_id,
+        )
+    ]
+    events += [
+        audit_event(
+            child["id"],
+            "cascade",
+            actor,
+            flag_set_version,
+            get_display_name(child["name"], child["display_name"]),
+            child["is_enabled"],
+            child["old_is_enabled"],
+            written.id,
+        )
+        for child in changed_children
+    ]
+    return events
 
-        # Denormalize names for response
-        dernomalize_feature_and_children_names(feature_response)
 
-        return feature_response
-    except IntegrityError:
+@default_tracer.traced("service")
+async def create_feature(
+    db: AsyncSession, feature: FeatureCreate, actor: Optional[str] = None
+):
+    feature.name = clean_feature_name(feature.name)
+    try:
+        # a single statement: the parent rules are checked by the INSERT itself,
+        # a taken name fails on the unique index, concurrent creates included
+        written = await insert_feature(
+            db,
+            normalize_name(feature.name),
+            feature.name,
+            feature.is_enabled,
+            feature.parent_id,
+        )
+        if written.id is None:
+            raise parent_exception(written)
+        await db.commit()
+    except IntegrityError as exc:
         await db.rollback()
-        raise DBIntegrityError()
+        raise integrity_error_exception(exc)
 
+    change = feature_change(written)
+    apply_feature_change(change)
+    audit_log.record(*audit_written("create", written, actor, [change]))
+    return written_feature_response(written)
 
-async def get_feature_details(db: AsyncSession, feature_id: int):
-    db_feature = await get_feature_by_id(db, feature_id, with_children=True)
-    if not db_feature:
-        raise FeatureNotFoundException()
 
-    # Convert SQLAlchemy model to Pydantic model
-    feature_response = Feature.model_validate(db_feature)
+@default_tracer.traced("service")
+async def get_feature_details(
+    db: AsyncSession, feature_id: int, min_flag_set_version: Optional[int] = None
+):
+    # `min_flag_set_version`, the client's last write, skips older cached data
+    cached_response = feature_cache.get(feature_id, min_flag_set_version)
+    if cached_response is not None:
+        evaluation_usage.count([feature_id])
+        return cached_response
 
-    # Denormalize names for response
-    dernomalize_feature_and_children_names(feature_response)
+    cache_version = feature_cache.version
+    # read the version before the data, so the data is never older than its version
+    flag_set_version = await get_flag_set_version(db)
+    features = assemble_feature_tree(await get_feature_rows(db, feature_id))
+    if not features:
+        raise FeatureNotFoundException()
+    feature_response = features[0]
 
+    feature_cache.set(feature_id, feature_response, cache_version, flag_set_version)
+    evaluation_usage.count([feature_id])
     return feature_response
 
 
+@default_tracer.traced("service")
 async def update_feature(
-    db: AsyncSession, feature_id: int, feature_update: FeatureCreate
+    db: AsyncSession,
+    feature_id: int,
+    feature_update: FeatureCreate,
+    actor: Optional[str] = None,
 ):
+    feature_update.name = clean_feature_name(feature_update.name)
+    # a feature can't be its own parent, the other parent rules are checked by
+    # the UPDATE
+    if feature_update.parent_id == feature_id:
+        raise SelfParentException()
     try:
-        if feature_update.name:
-            feature_update.name = feature_update.name.strip()
-        if (not feature_update.name) or (
-            len(feature_update.name) < FEATURE_NAME_LOWER_LIMIT
-            or len(feature_update.name) > FEATURE_NAME_UPPER_LIMIT
+        # a single statement, which also updates children's status iff the
+        # status is modified. A taken name fails on the unique index
+        written = await update_db_feature(
+            db,
+            feature_id,
+            normalize_name(feature_update.name),
+            feature_update.name,
+            feature_update.is_enabled,
+            feature_update.parent_id,
+            children_limit=CHILDREN_UPDATE_CHUNK_SIZE,
+        )
+        if written.id is None:
+            if not written.feature_found:
+                raise FeatureNotFoundException()
+            raise parent_exception(written)
+        changes = [feature_change(written)]
+        changed_children = list(written.changed_children or [])
+
+        # the rest of a large family, chunk by chunk in the same transaction. A
+        # full chunk may not be the last one
+        if (
+            CHILDREN_UPDATE_CHUNK_SIZE
+            and len(changed_children) == CHILDREN_UPDATE_CHUNK_SIZE
         ):
-            raise NameLengthLimitException()
+            while (
+                chunk := await update_children_status(
+                    db,
+                    feature_id,
+                    feature_update.is_enabled,
+                    CHILDREN_UPDATE_CHUNK_SIZE,
+                )
+            ) is not None:
+                changes.append(chunk[0])
+                changed_children += chunk[1]
+        await db.commit()
+    except IntegrityError as exc:
+        await db.rollback()
+        raise integrity_error_exception(exc)
+
+    for change in changes:
+        apply_feature_change(change)
+    audit_log.record(
+        *audit_written(
+            "update",
+            written,
+            actor,
+            changes,
+            written.old_is_enabled,
+            changed_children,
+        )
+    )
+    return written_feature_response(written, written.children or [])
+
+
+@default_tracer.traced("service")
+async def get_all_features(
+    db: AsyncSession, min_flag_set_version: Optional[int] = None
+):
+    # served from the in-process snapshot while it is fresh, no db call at all
+    return await feature_cache.get_or_build(
+        ALL_FEATURES_CACHE_KEY,
+        lambda: build_all_features(db),
+        lambda: get_flag_set_version(db),
+        min_flag_set_version,
+    )
+
+
+@default_tracer.traced("service")
+def assemble_feature_tree(rows) -> List[Feature]:
+    # (id, name, is_enabled, parent_id) rows in name order -> features whose parent
+    # isn't among the rows, each with its children, names denormalized. Linear,
+    # rows come from the db so they are not validated again
+    features = {row.id: feature_from_row(row) for row in rows}
+    roots = []
+    for feature in features.values():
+        parent = features.get(feature.parent_id)
+        if parent is None:
+            roots.append(feature)
+        else:
+            parent.children.append(feature)
+    return roots
+
+
+@default_tracer.traced("service")
+async def build_all_features(db: AsyncSession):
+    # a single query, parents and children are put together in memory
+    return AllFeaturesList(features=assemble_feature_tree(await get_feature_rows(db)))
+
+
+@default_tracer.traced("service")
+async def get_all_features_json(
+    db: AsyncSession, min_flag_set_version: Optional[int] = None
+) -> bytes:
+    # same as get_all_features, already serialized
+    return await feature_cache.get_or_build(
+        ALL_FEATURES_JSON_CACHE_KEY,
+        lambda: build_all_features_json(db),
+        lambda: get_flag_set_version(db),
+        min_flag_set_version,
+    )
+
+
+@default_tracer.traced("service")
+async def build_all_features_json(db: AsyncSession) -> bytes:
+    return features_json(await get_feature_rows(db))
+
+
+def features_json(rows) -> bytes:
+    # rows -> plain dicts -> JSON bytes, no models involved. Keys in the order of
+    # the response models, so the output is the same as get_all_features'
+    features = {
+        row.id: {
+            "name": get_display_name(row.name, row.display_name),
+            "is_enabled": row.is_enabled,
+            "parent_id": row.parent_id,
+            "id": row.id,
+            "children": [],
+        }
+        for row in rows
+    }
+    roots = []
+    for feature in features.values():
+        parent = features.get(feature["parent_id"])
+        if parent is None:
+            roots.append(feature)
+        else:
+            parent["children"].append(feature)
+    return dumps_json({"features": roots, "next_cursor": None, "children_cursors": {}})
+
+
+def get_shared_snapshot(
+    min_flag_set_version: Optional[int] = None,
+) -> Optional[Snapshot]:
+    # the snapshot shared by the workers of this host, unless it is older than a
+    # change this worker already knows about (its own writes included) or than
+    # `min_flag_set_version`
+    if not SHARED_SNAPSHOT_ENABLED:
+        return None
+    snapshot = flag_snapshot.current()
+    if snapshot is None or snapshot.flag_set_version < max(
+        feature_cache.flag_set_version, min_flag_set_version or 0
+    ):
+        return None
+    return snapshot
+
+
+async def read_flag_set_version() -> int:
+    async with AsyncSessionLocal() as db:
+        return await get_flag_set_version(db)
+
+
+async def build_flag_snapshot() -> bytes:
+    async with AsyncSessionLocal() as db:
+        # read the version before the data, like the cache does
+        flag_set_version = await get_flag_set_version(db)
+        rows = await get_feature_rows(db)
+        targeting_rows = await get_targeting_rules(db)
+    return encode_snapshot(
+        flag_set_version,
+        rows,
+        features_json(rows),
+        dumps_json([row._asdict() for row in targeting_rows]),
+    )
+
+
+async def start_flag_snapshot():
+    # a snapshot left from before this worker started is only used once it is at
+    # least as recent as the db
+    feature_cache.observe_flag_set_version(await read_flag_set_version())
+    snapshot_refresher.start(build_flag_snapshot, read_flag_set_version)
+
+
+def encode_cursor(name: str) -> str:
+    # opaque to clients: the normalized name of the last feature of a page
+    return base64.urlsafe_b64encode(json.dumps({"name": name}).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> str:
+    try:
+        name = json.loads(base64.urlsafe_b64decode(cursor.encode()))["name"]
+    except (ValueError, TypeError, KeyError):
+        raise InvalidCursorException()
+    if not isinstance(name, str):
+        raise InvalidCursorException()
+    return name
+
+
+@default_tracer.traced("service")
+async def get_features_page(
+    db: AsyncSession,
+    limit: int,
+    cursor: Optional[str] = None,
+    is_enabled: Optional[bool] = None,
+    parent_id: Optional[int] = None,
+) -> AllFeaturesList:
+    # One page of root features with their children, or of the children of
+    # `parent_id`. Filters apply to the listed features, not to their children.
+    # Ordered and limited in SQL, so a page costs the same however many flags exist
+    after_name = decode_cursor(cursor) if cursor is not None else None
+    # one more than asked, to know if there is a next page
+    db_features = await get_db_features_page(
+        db, limit + 1, after_name, is_enabled, parent_id
+    )
+
+    features_page = AllFeaturesList(features=[])
+    if len(db_features) > limit:
+        db_features = db_features[:limit]
+        features_page.next_cursor = encode_cursor(db_features[-1].name)
+
+    # at most `limit` children of each root too, one more to know if there are
+    # others. Those are paged through `parent_id`
+    children = defaultdict(list)
+    if parent_id is None and db_features:
+        for db_child in await get_db_children(
+            db, [db_feature.id for db_feature in db_features], limit + 1
+        ):
+            children[db_child.parent_id].append(db_child)
+
+    for db_feature in db_features:
+        feature_response = feature_from_row(db_feature)
+        db_children = children[db_feature.id]
+        if len(db_children) > limit:
+            db_children = db_children[:limit]
+            features_page.children_cursors[db_feature.id] = encode_cursor(
+                db_children[-1].name
+            )
+        feature_response.children = [
+            feature_from_row(db_child) for db_child in db_children
+        ]
+        features_page.features.append(feature_response)
+    return features_page
 
-        db_feature = await get_feature_by_id(db, feature_id, with_children=True)
-        if not db_feature:
-            raise FeatureNotFoundException()
 
-        # Check if a feature with the same name already exists, if name is being updated
-        # TODO: see if we can combine this with above db query
-        new_normalized_name = normalize_name(feature_update.name)
-        if new_normalized_name != db_feature.name:
-            existing_feature = await get_feature_by_name(db, new_normalized_name)
-            if existing_feature:
-                raise DuplicateFeatureNameException()
-
-        # Validate parent rules (include current_feature_id to check self-parenting)
-        await validate_parent(
-            db, feature_update.parent_id, db_feature_with_children=db_feature
+def build_evaluation_index(db_features) -> Dict[str, Tuple[int, bool]]:
+    # normalized name -> (id, effective state). A child is only on if its parent is
+    # on too
+    enabled_by_id = {db_feature.id: db_feature.is_enabled for db_feature in db_features}
+    return {
+        db_feature.name: (
+            db_feature.id,
+            bool(
+                db_feature.is_enabled
+                and (
+                    db_feature.parent_id is None
+                    or enabled_by_id.get(db_feature.parent_id, False)
+                )
+            ),
         )
+        for db_feature in db_features
+    }
 
-        # update children status same as parent status iff (<=>) parent status is being modified
-        # we need to do it before updating the db_feature object with feature_update
-        if db_feature.is_enabled != feature_update.is_enabled:
-            for child in db_feature.children:
-                child: Feature
-                child.is_enabled = feature_update.is_enabled
 
-        # Update fields
-        for key, value in feature_update.model_dump().items():
-            setattr(db_feature, key, value)
-        db_feature.name = new_normalized_name
+@default_tracer.traced("service")
+async def get_evaluation_index(db: AsyncSession) -> Dict[str, Tuple[int, bool]]:
+    async def build():
+        return build_evaluation_index(await get_feature_rows(db))
 
-        await db.commit()
+    # rebuilt only after a change (or once the TTL runs out)
+    return await feature_cache.get_or_build(
+        EVALUATION_INDEX_CACHE_KEY, build, lambda: get_flag_set_version(db)
+    )
 
-        # Refresh the feature to load relationships (eagerly load children)
-        await db.refresh(db_feature, ["children"])
 
-        # Convert SQLAlchemy model to Pydantic model
-        feature_response = Feature.model_validate(db_feature)
+@default_tracer.traced("service")
+async def get_targeting_index(db: AsyncSession) -> Dict[str, Evaluator]:
+    async def build():
+        return build_targeting_index(await get_targeting_rules(db))
 
-        # Denormalize names for response
-        dernomalize_feature_and_children_names(feature_response)
+    # rebuilt after a change, recompiling only the rules of the changed features
+    return await feature_cache.get_or_build(
+        TARGETING_INDEX_CACHE_KEY, build, lambda: get_flag_set_version(db)
+    )
 
-        return feature_response
-    except IntegrityError:
-        await db.rollback()
-        raise DBIntegrityError()
+
+def get_snapshot_targeting_index(snapshot: Snapshot) -> Dict[str, Evaluator]:
+    # same as get_targeting_index, from the rules in the shared snapshot
+    cached = feature_cache.peek(SNAPSHOT_TARGETING_INDEX_CACHE_KEY)
+    if cached is not None and cached[0] == snapshot.flag_set_version:
+        return cached[1]
+    index = build_targeting_index(
+        SimpleNamespace(**row) for row in json.loads(snapshot.targeting_json.tobytes())
+    )
+    feature_cache.set(
+        SNAPSHOT_TARGETING_INDEX_CACHE_KEY,
+        (snapshot.flag_set_version, index),
+        feature_cache.version,
+        snapshot.flag_set_version,
+    )
+    return index
+
+
+@default_tracer.traced("service")
+async def evaluate_features(
+    db: AsyncSession, names: List[str], context: Optional[dict] = None
+) -> Dict[str, bool]:
+    normalized_names = [normalize_name(name) for name in names]
+    snapshot = get_shared_snapshot()
+    if snapshot is not None:
+        lookup = snapshot.lookup
+        targeting_index = get_snapshot_targeting_index(snapshot)
+    else:
+        lookup = (await get_evaluation_index(db)).get
+        targeting_index = await get_targeting_index(db)
+
+    states = {}
+    feature_ids = []
+    for name, normalized_name in zip(names, normalized_names):
+        found = lookup(normalized_name)
+        if found is None:
+            # unknown features are reported as disabled, and not counted
+            states[name] = False
+        else:
+            feature_ids.append(found[0])
+            states[name] = found[1]
+    evaluation_usage.count(feature_ids)
+
+    # features with rules, or whose parent has some, are only on for the users
+    # the rules select
+    if targeting_index:
+        context = context or {}
+        for name, normalized_name in zip(names, normalized_names):
+            evaluator = targeting_index.get(normalized_name)
+            if evaluator is not None and states[name]:
+                states[name] = evaluator(context)
+    return states
+
+
+@default_tracer.traced("service")
+async def get_feature_rules(
+    db: AsyncSession, feature_id: int
+) -> Optional[FeatureRules]:
+    # None if the feature has no rules
+    found, rules = await get_db_feature_rules(db, feature_id)
+    if not found:
+        raise FeatureNotFoundException()
+    return None if rules is None else FeatureRules.model_validate(rules)
+
+
+@default_tracer.traced("service")
+async def set_feature_rules(
+    db: AsyncSession,
+    feature_id: int,
+    rules: Optional[FeatureRules],
+    actor: Optional[str] = None,
+):
+    # None removes the rules, the feature is then on or off for everyone
+    try:
+        change = await set_db_feature_rules(
+            db, feature_id, None if rules is None else rules.model_dump()
+        )
+    except IntegrityError as exc:
+        raise integrity_error_exception(exc)
+    if change is None:
+        raise FeatureNotFoundException()
+    apply_feature_change(change)
+    audit_log.record(
+        audit_event(feature_id, "rules", actor, flag_set_version_of([change]))
+    )
+    return rules
 
 
-async def get_all_features(db: AsyncSession):
-    # fetch all the parent features only, i.e. parent_id == null
-    # because we will anyway get all the children (because of use of selectinload)
-    # two advantages:
-    #   1. no duplicates. Child will only appear at 2nd level
-    #   2. we will get the child in nested manner which will be helpful
+@default_tracer.traced("service")
+async def get_feature_usage(
+    db: AsyncSession, unused_since: Optional[datetime], limit: int
+) -> FeatureUsageList:
+    # as last flushed by each worker, up to USAGE_FLUSH_SECONDS behind
+    rows = await get_feature_usage_rows(db, unused_since, limit)
+    return FeatureUsageList(
+        features=[
+            FeatureUsage(
+                id=row.id,
+                name=get_display_name(row.name, row.display_name),
+                evaluations=row.evaluations,
+                last_evaluated_at=row.last_evaluated_at,
+            )
+            for row in rows
+        ]
+    )
 
-    all_db_features = await get_all_db_features(db)
 
-    # Convert SQLAlchemy model to Pydantic model
-    # Denormalize names in the same loop
-    all_features_response = AllFeaturesList(features=[])
-    for db_feature in all_db_features:
-        feature_response = Feature.model_validate(db_feature)
+@default_tracer.traced("service")
+async def get_feature_changes(db: AsyncSession, since_version: int) -> FeatureChanges:
+    current_version, oldest_version, changes = await get_changed_features(
+        db, since_version
+    )
+    if since_version > current_version or (
+        # versions after `since_version` were already compacted away
+        current_version > since_version
+        and (oldest_version is None or oldest_version > since_version + 1)
+    ):
+        return FeatureChanges(version=current_version, resync=True)
 
-        # denormalize name for feature_response
-        dernomalize_feature_and_children_names(feature_response)
+    feature_changes = FeatureChanges(version=current_version)
+    for feature_id, db_feature in changes:
+        if db_feature is None:
+            feature_changes.deleted.append(feature_id)
+            continue
+        feature_response = FeatureSummary.model_validate(db_feature)
+        feature_response.name = get_display_name(
+            db_feature.name, db_feature.display_name
+        )
+        feature_changes.upserted.append(feature_response)
 
-        # add to the final response
-        all_features_response.features.append(feature_response)
+    feature_changes.upserted.sort(key=lambda feat: feat.name)
+    feature_changes.deleted.sort()
+    return feature_changes
 
-    # sort by name
-    all_features_response.features.sort(key=lambda feat: feat.name)
-    # sort children
-    for feature in all_features_response.features:
-        if feature.children:
-            feature.children.sort(key=lambda feat: feat.name)
 
-    return all_features_response
+@default_tracer.traced("service")
+async def get_feature_history(
+    db: AsyncSession,
+    feature_id: Optional[int],
+    since: Optional[datetime],
+    until: Optional[datetime],
+    limit: int,
+) -> FeatureHistory:
+    # changes of one feature, or of all of them, from the audit table. The latest
+    # changes may not be there yet, they are written in the background
+    events = await get_audit_events(db, feature_id, since, until, limit)
+    return FeatureHistory(events=[AuditEvent.model_validate(event) for event in events])
 
 
-async def delete_feature(db: AsyncSession, feature_id: int):
+async def stream_feature_changes():
+    # Server-sent events for every change seen by this worker, as long as the
+    # client stays connected
+    subscription = change_hub.subscribe()
+    try:
+        while True:
+            try:
+                frame = await asyncio.wait_for(
+                    subscription.queue.get(), FEATURE_EVENTS_HEARTBEAT_SECONDS
+                )
+            except asyncio.TimeoutError:
+                # comment line, keeps proxies from closing an idle connection
+                yield b": keep-alive\n\n"
+                continue
+            if subscription.overflowed:
+                # client is too slow, it has to catch up by fetching again
+                yield RESYNC_FRAME
+                return
+            yield frame
+    finally:
+        change_hub.unsubscribe(subscription)
+
+
+@default_tracer.traced("service")
+async def delete_feature(
+    db: AsyncSession, feature_id: int, actor: Optional[str] = None
+):
     # check if feature exists
     # db_feature = await get_feature_by_id(db, feature_id, with_children=True)
     # if not db_feature:
@@ -213,7 +729,330 @@ async def delete_feature(db: AsyncSession, feature_id: int):
 
     # now delete
     try:
-        await delete_db_feature(db, feature_id)
+        change = await delete_db_feature(db, feature_id)
     except IntegrityError:
         # will be raised when we try to delete a parent feature (because of foreign contraint on the same table)
         raise DeletingParentFeature()
+    apply_feature_change(change)
+    audit_log.record(
+        audit_event(feature_id, "delete", actor, flag_set_version_of([change]))
+    )
+
+
+# rule violations reported per operation of a batch
+BATCH_ITEM_EXCEPTIONS = (
+    DuplicateFeatureNameException,
+    SelfParentException,
+    FeatureNotFoundException,
+    NestedChildException,
+    DeletingParentFeature,
+)
+
+
+class BatchPlan:
+    """
+    Applies the operations of a batch to an in-memory copy of the features they
+    touch, in request order, checking the same rules as the single feature
+    endpoints. `writes` records each row as it was validated, in that order, so
+    the db goes through the same states and its unique name index and foreign
+    keys hold at every step.
+
+    Features created by the batch get negative temporary ids until inserted.
+    """
+
+    def __init__(self, db_rows):
+        self.features = {
+            row.id: {
+                "id": row.id,
+                "name": row.name,
+                "display_name": row.display_name,
+                "is_enabled": row.is_enabled,
+                "parent_id": row.parent_id,
+            }
+            for row in db_rows
+        }
+        self.ids_by_name = {row.name: row.id for row in db_rows}
+        # statuses before the batch, for the audit
+        self.old_is_enabled = {row.id: row.is_enabled for row in db_rows}
+        self.children = defaultdict(set)
+        for row in db_rows:
+            if row.parent_id is not None:
+                self.children[row.parent_id].add(row.id)
+
+        # ("update", row), ("delete", (id, children left)) or ("create", row)
+        self.writes = []
+        self.updated = set()
+        self.deleted = set()
+        self.created = []
+        self.refs = {}
+        # every feature whose details change, including old and new parents
+        self.changed = set()
+        # features the batch deletes, their parent may be deleted before them
+        self.to_delete = set()
+
+    def check_parent(self, parent_id: Optional[int], feature_id: Optional[int] = None):
+        # same rules as insert_feature and update_db_feature check in SQL
+        if parent_id is not None and feature_id is not None and parent_id == feature_id:
+            raise SelfParentException()
+        if parent_id is not None:
+            parent = self.features.get(parent_id)
+            if parent is None:
+                raise FeatureNotFoundException()
+            if parent["parent_id"] is not None:
+                raise NestedChildException()
+        if (
+            parent_id is not None
+            and feature_id is not None
+            and self.children[feature_id]
+        ):
+            raise NestedChildException()
+
+    def check_name_free(self, name: str, feature_id: Optional[int] = None):
+        if self.ids_by_name.get(name, feature_id) != feature_id:
+            raise DuplicateFeatureNameException()
+
+    def set_parent(self, feature: dict, parent_id: Optional[int]):
+        if feature["parent_id"] is not None:
+            self.children[feature["parent_id"]].discard(feature["id"])
+            self.changed.add(feature["parent_id"])
+        if parent_id is not None:
+            self.children[parent_id].add(feature["id"])
+            self.changed.add(parent_id)
+        feature["parent_id"] = parent_id
+
+    def update(self, operation: BatchOperation, name: str, display_name: str):
+        feature = self.features.get(operation.id)
+        if feature is None:
+            raise FeatureNotFoundException()
+        self.check_name_free(name, operation.id)
+        self.check_parent(operation.parent_id, operation.id)
+
+        # children follow the parent's status iff it is being modified, those
+        # already with that status are left alone
+        if feature["is_enabled"] != operation.is_enabled:
+            for child_id in self.children[operation.id]:
+                if self.features[child_id]["is_enabled"] == operation.is_enabled:
+                    continue
+                self.features[child_id]["is_enabled"] = operation.is_enabled
+                self.writes.append(("update", dict(self.features[child_id])))
+                self.updated.add(child_id)
+                self.changed.add(child_id)
+
+        del self.ids_by_name[feature["name"]]
+        self.ids_by_name[name] = operation.id
+        feature["name"] = name
+        feature["display_name"] = display_name
+        feature["is_enabled"] = operation.is_enabled
+        self.set_parent(feature, operation.parent_id)
+        self.writes.append(("update", dict(feature)))
+        self.updated.add(operation.id)
+        self.changed.add(operation.id)
+
+    def delete(self, operation: BatchOperation):
+        feature = self.features.get(operation.id)
+        if feature is None:
+            raise FeatureNotFoundException()
+        if self.children[operation.id] - self.to_delete:
+            raise DeletingParentFeature()
+
+        # children left are deleted later in the batch, detached until then
+        children_left = bool(self.children[operation.id])
+        for child_id in self.children.pop(operation.id, ()):
+            self.features[child_id]["parent_id"] = None
+        self.set_parent(feature, None)
+        del self.ids_by_name[feature["name"]]
+        del self.features[operation.id]
+        self.updated.discard(operation.id)
+        self.deleted.add(operation.id)
+        self.changed.add(operation.id)
+        self.writes.append(("delete", (operation.id, children_left)))
+
+    def create(self, operation: BatchOperation, name: str, display_name: str):
+        self.check_name_free(name)
+        parent_id = operation.parent_id
+        if operation.parent_ref is not None:
+            if operation.parent_ref not in self.refs:
+                raise FeatureNotFoundException()
+            parent_id = self.refs[operation.parent_ref]
+        self.check_parent(parent_id)
+
+        temp_id = -(len(self.created) + 1)
+        feature = {
+            "id": temp_id,
+            "name": name,
+            "display_name": display_name,
+            "is_enabled": operation.is_enabled,
+            "parent_id": None,
+        }
+        self.features[temp_id] = feature
+        self.ids_by_name[name] = temp_id
+        self.set_parent(feature, parent_id)
+        self.writes.append(("create", dict(feature)))
+        self.created.append(temp_id)
+        if operation.ref is not None:
+            self.refs[operation.ref] = temp_id
+
+
+def audit_batch(plan: BatchPlan, operations, real_ids, actor, change) -> List[dict]:
+    # audit events of the features a batch created, updated or deleted, children
+    # whose status followed their parent's as cascades
+    flag_set_version = flag_set_version_of([change])
+    updated_ids = {operation.id for operation in operations if operation.op == "update"}
+    events = [
+        audit_event(feature_id, "delete", actor, flag_set_version)
+        for feature_id in plan.deleted
+    ]
+    # features are keyed by their temporary id, created ones have their real id
+    for action, keys in (
+        ("create", real_ids),
+        ("update", plan.updated & updated_ids),
+        ("cascade", plan.updated - updated_ids),
+    ):
+        for key in keys:
+            feature = plan.features[key]
+            events.append(
+                audit_event(
+                    feature["id"],
+                    action,
+                    actor,
+                    flag_set_version,
+                    get_display_name(feature["name"], feature["display_name"]),
+                    feature["is_enabled"],
+                    plan.old_is_enabled.get(key),
+                    feature["parent_id"],
+                )
+            )
+    return events
+
+
+async def write_batch(db: AsyncSession, writes) -> Dict[int, int]:
+    # BatchPlan.writes in order, consecutive ones of the same kind in one
+    # statement. Returns the ids of the created features by temporary id
+    real_ids = {}
+
+    def resolve(row: dict) -> dict:
+        return dict(
+            row,
+            id=real_ids.get(row["id"], row["id"]),
+            parent_id=real_ids.get(row["parent_id"], row["parent_id"]),
+        )
+
+    for op, group in groupby(writes, key=itemgetter(0)):
+        payloads = [payload for _, payload in group]
+        if op == "update":
+            await bulk_update_features(db, [resolve(row) for row in payloads])
+        elif op == "delete":
+            await bulk_delete_features(
+                db,
+                [real_ids.get(feature_id, feature_id) for feature_id, _ in payloads],
+                any(children_left for _, children_left in payloads),
+            )
+        else:
+            # features whose parent is created by the same statement go in a
+            # second one, once their parent's id is known
+            temp_ids = {row["id"] for row in payloads}
+            for second_round in (False, True):
+                rows = [
+                    row
+                    for row in payloads
+                    if (row["parent_id"] in temp_ids) == second_round
+                ]
+                if not rows:
+                    continue
+                new_ids = await bulk_insert_features(
+                    db,
+                    [
+                        {
+                            key: value
+                            for key, value in resolve(row).items()
+                            if key != "id"
+                        }
+                        for row in rows
+                    ],
+                )
+                real_ids.update(zip((row["id"] for row in rows), new_ids))
+    return real_ids
+
+
+@default_tracer.traced("service")
+async def apply_batch(
+    db: AsyncSession, operations: List[BatchOperation], actor: Optional[str] = None
+):
+    # All or nothing. Operations are validated in request order and written in
+    # that same order, so a batch that validates can be written as is. A parent
+    # can be deleted before its children if the batch deletes them too
+    errors = []
+    display_names = {}
+    for index, operation in enumerate(operations):
+        if operation.op == "delete":
+            continue
+        try:
+            display_names[index] = clean_feature_name(operation.name)
+        except NameLengthLimitException as exc:
+            errors.append((index, exc))
+    names = {index: normalize_name(name) for index, name in display_names.items()}
+
+    ids = {
+        feature_id
+        for operation in operations
+        for feature_id in (operation.id, operation.parent_id)
+        if feature_id is not None
+    }
+    plan = BatchPlan(await get_batch_features(db, list(names.values()), list(ids)))
+    plan.to_delete = {
+        operation.id for operation in operations if operation.op == "delete"
+    }
+
+    invalid = {index for index, _ in errors}
+    created_indexes = {}
+    for index, operation in enumerate(operations):
+        if index in invalid:
+            continue
+        try:
+            if operation.op == "update":
+                plan.update(operation, names[index], display_names[index])
+            elif operation.op == "delete":
+                plan.delete(operation)
+            else:
+                plan.create(operation, names[index], display_names[index])
+                created_indexes[index] = plan.created[-1]
+        except BATCH_ITEM_EXCEPTIONS as exc:
+            errors.append((index, exc))
+
+    if errors:
+        raise BatchValidationException(sorted(errors, key=lambda error: error[0]))
+
+    try:
+        real_ids = await write_batch(db, plan.writes)
+        for temp_id, new_id in real_ids.items():
+            feature = plan.features[temp_id]
+            feature["id"] = new_id
+            feature["parent_id"] = real_ids.get(
+                feature["parent_id"], feature["parent_id"]
+            )
+
+        changed_ids = {
+            real_ids.get(feature_id, feature_id) for feature_id in plan.changed
+        }
+        changed_ids.update(real_ids.values())
+        change = await publish_feature_change(db, changed_ids)
+        await db.commit()
+    except IntegrityError:
+        # a concurrent write conflicts with the batch
+        await db.rollback()
+        raise DBIntegrityError()
+    apply_feature_change(change)
+    audit_log.record(*audit_batch(plan, operations, real_ids, actor, change))
+
+    batch_result = BatchResult()
+    for index, operation in enumerate(operations):
+        item = BatchItemResult(index=index, op=operation.op, status_code=200)
+        # final state, None if the batch deleted it afterwards
+        feature = plan.features.get(created_indexes.get(index, operation.id))
+        if operation.op != "delete" and feature is not None:
+            item.feature = FeatureSummary(**feature)
+            item.feature.name = get_display_name(
+                feature["name"], feature["display_name"]
+            )
+        batch_result.results.append(item)
+    return batch_result
@@ -0,0 +1,109 @@
+import hashlib
+import json
+from typing import Callable, Dict, Iterable, List, Optional
+
+# rollouts are in steps of 0.01%
+ROLLOUT_BUCKETS = 10000
+
+Evaluator = Callable[[dict], bool]
+
+
+def rollout_bucket(feature_id: int, key) -> int:
+    # Stable bucket of a user for a feature. Salted with the feature id, so each
+    # feature picks its own users, and a user in a 20% rollout stays in at 30%
+    digest = hashlib.sha1(f"{feature_id}:{key}".encode()).digest()
+    return int.from_bytes(digest[:8], "big") % ROLLOUT_BUCKETS
+
+
+def compile_rules(feature_id: int, rules: dict) -> Evaluator:
+    # FeatureRules as stored -> function of the evaluation context. Conditions are
+    # turned into (attribute, set of values, negated) tuples and percentages into
+    # bucket thresholds once, evaluating is a few lookups and at most one hash
+    compiled = [
+        (
+            tuple(
+                (
+                    condition["attribute"],
+                    frozenset(condition["values"]),
+                    condition.get("operator", "in") == "not_in",
+                )
+                for condition in rule.get("conditions", [])
+            ),
+            round(rule.get("rollout", 100) * ROLLOUT_BUCKETS / 100),
+        )
+        for rule in rules["rules"]
+    ]
+    rollout_key = rules.get("rollout_key", "user_id")
+
+    def evaluate(context: dict) -> bool:
+        for conditions, threshold in compiled:
+            for attribute, values, negated in conditions:
+                if (context.get(attribute) in values) == negated:
+                    break
+            else:
+                if threshold >= ROLLOUT_BUCKETS:
+                    return True
+                key = context.get(rollout_key)
+                return (
+                    threshold > 0
+                    and key is not None
+                    and rollout_bucket(feature_id, key) < threshold
+                )
+        return False
+
+    return evaluate
+
+
+def all_of(evaluators: List[Evaluator]) -> Evaluator:
+    if len(evaluators) == 1:
+        return evaluators[0]
+    first, second = evaluators
+    return lambda context: first(context) and second(context)
+
+
+class CompiledRules:
+    """
+    Evaluators compiled from the rules of each feature, reused until the rules
+    change. Entries are dropped when their feature changes, like the cached
+    feature details, and recompiled on next use.
+    """
+
+    def __init__(self):
+        # feature id -> (rules as compiled, evaluator)
+        self._evaluators: Dict[int, tuple] = {}
+        self.compiled = 0
+
+    def get(self, feature_id: int, rules: dict) -> Evaluator:
+        key = json.dumps(rules, sort_keys=True)
+        entry = self._evaluators.get(feature_id)
+        if entry is None or entry[0] != key:
+            entry = (key, compile_rules(feature_id, rules))
+            self._evaluators[feature_id] = entry
+            self.compiled += 1
+        return entry[1]
+
+    def invalidate(self, feature_ids: Optional[Iterable[int]] = None):
+        # None drops all of them
+        if feature_ids is None:
+            self._evaluators.clear()
+            return
+        for feature_id in feature_ids:
+            self._evaluators.pop(feature_id, None)
+
+
+compiled_rules = CompiledRules()
+
+
+def build_targeting_index(rows) -> Dict[str, Evaluator]:
+    # rows of get_targeting_rules -> normalized name -> evaluator, only for the
+    # features with rules of their own or of their parent. A child's evaluator
+    # includes its parent's rules: the parent gates it for each user too
+    index = {}
+    for row in rows:
+        evaluators = []
+        if row.parent_rules is not None:
+            evaluators.append(compiled_rules.get(row.parent_id, row.parent_rules))
+        if row.rules is not None:
+            evaluators.append(compiled_rules.get(row.id, row.rules))
+        index[row.name] = all_of(evaluators)
+    return index
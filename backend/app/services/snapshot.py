@@ -0,0 +1,310 @@
+import asyncio
+import fcntl
+import logging
+import mmap
+import os
+import struct
+from typing import Awaitable, Callable, Optional, Tuple
+
+from app.services.constants import SNAPSHOT_PATH, SNAPSHOT_REFRESH_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Snapshot file layout, little endian:
+#   header          magic, format, flag set version, count, sizes of the 4 blobs
+#   ids             int64[count]
+#   parent ids      int64[count], 0 for none
+#   name offsets    uint32[count + 1], into the names blob
+#   display offsets uint32[count + 1], into the display names blob
+#   enabled bits    ceil(count / 8) bytes, bit i of byte i // 8
+#   effective bits  same, enabled and (no parent or parent enabled)
+#   names           normalized names, utf-8, sorted bytewise for binary search
+#   display names   utf-8, empty for flags without one
+#   features json   the GET /api/v1/features response body
+#   targeting json  rows of get_targeting_rules, as a list of dicts
+SNAPSHOT_MAGIC = b"FFSN"
+SNAPSHOT_FORMAT = 2
+HEADER = struct.Struct("<4sHxxQIIIII")
+
+
+def pack_bits(values) -> bytes:
+    bits = bytearray((len(values) + 7) // 8)
+    for i, value in enumerate(values):
+        if value:
+            bits[i >> 3] |= 1 << (i & 7)
+    return bytes(bits)
+
+
+def pack_strings(strings):
+    # (offsets, blob) of utf-8 strings laid end to end
+    encoded = [string.encode() for string in strings]
+    offsets = [0]
+    for string in encoded:
+        offsets.append(offsets[-1] + len(string))
+    return struct.pack(f"<{len(offsets)}I", *offsets), b"".join(encoded)
+
+
+def encode_snapshot(
+    flag_set_version: int, rows, features_json: bytes, targeting_json: bytes = b"[]"
+) -> bytes:
+    # rows of FEATURE_COLUMNS -> snapshot file contents
+    rows = sorted(rows, key=lambda row: row.name.encode())
+    enabled_by_id = {row.id: row.is_enabled for row in rows}
+    name_offsets, names = pack_strings(row.name for row in rows)
+    display_offsets, display_names = pack_strings(
+        row.display_name or "" for row in rows
+    )
+    count = len(rows)
+    return b"".join(
+        (
+            HEADER.pack(
+                SNAPSHOT_MAGIC,
+                SNAPSHOT_FORMAT,
+                flag_set_version,
+                count,
+                len(names),
+                len(display_names),
+                len(features_json),
+                len(targeting_json),
+            ),
+            struct.pack(f"<{count}q", *(row.id for row in rows)),
+            struct.pack(f"<{count}q", *(row.parent_id or 0 for row in rows)),
+            name_offsets,
+            display_offsets,
+            pack_bits([row.is_enabled for row in rows]),
+            pack_bits(
+                [
+                    row.is_enabled
+                    and (row.parent_id is None or enabled_by_id.get(row.parent_id))
+                    for row in rows
+                ]
+            ),
+            names,
+            display_names,
+            features_json,
+            targeting_json,
+        )
+    )
+
+
+class Snapshot:
+    """
+    Read-only view of a snapshot file mapped in memory. Nothing is copied or
+    decoded upfront: lookups read the mapped pages, shared by every worker.
+    """
+
+    def __init__(self, buffer):
+        view = memoryview(buffer)
+        if len(view) < HEADER.size:
+            raise ValueError("Truncated flag snapshot")
+        (
+            magic,
+            file_format,
+            self.flag_set_version,
+            self.count,
+            names_size,
+            display_names_size,
+            json_size,
+            targeting_size,
+        ) = HEADER.unpack_from(view)
+        if magic != SNAPSHOT_MAGIC or file_format != SNAPSHOT_FORMAT:
+            raise ValueError("Not a feature flag snapshot")
+
+        def section(size):
+            nonlocal offset
+            offset += size
+            return view[offset - size : offset]
+
+        count = self.count
+        bits_size = (count + 7) // 8
+        # the sections have to fill the file exactly, nothing is read past it
+        size = (
+            HEADER.size
+            + 16 * count
+            + 8 * (count + 1)
+            + 2 * bits_size
+            + names_size
+            + display_names_size
+            + json_size
+            + targeting_size
+        )
+        if len(view) != size:
+            raise ValueError("Truncated or corrupt flag snapshot")
+        offset = HEADER.size
+        self.ids = section(8 * count).cast("q")
+        self.parent_ids = section(8 * count).cast("q")
+        self.name_offsets = section(4 * (count + 1)).cast("I")
+        self.display_offsets = section(4 * (count + 1)).cast("I")
+        self.enabled_bits = section(bits_size)
+        self.effective_bits = section(bits_size)
+        self.names = section(names_size)
+        self.display_names = section(display_names_size)
+        self.features_json = section(json_size)
+        self.targeting_json = section(targeting_size)
+        # offsets are used as they are by lookups, so they are checked once here
+        for offsets, blob_size in (
+            (self.name_offsets, names_size),
+            (self.display_offsets, display_names_size),
+        ):
+            if offsets[0] != 0 or offsets[count] != blob_size:
+                raise ValueError("Corrupt flag snapshot offsets")
+            previous = 0
+            for string_offset in offsets:
+                if string_offset < previous:
+                    raise ValueError("Corrupt flag snapshot offsets")
+                previous = string_offset
+
+    def name(self, i: int) -> bytes:
+        return self.names[self.name_offsets[i] : self.name_offsets[i + 1]].tobytes()
+
+    def index_of(self, name: str) -> Optional[int]:
+        # binary search over the sorted names
+        target = name.encode()
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.name(middle) < target:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self.name(low) == target:
+            return low
+        return None
+
+    def is_enabled(self, i: int) -> bool:
+        return bool(self.enabled_bits[i >> 3] & (1 << (i & 7)))
+
+    def lookup(self, name: str) -> Optional[Tuple[int, bool]]:
+        # (id, effective state) of the feature with a normalized name, if any
+        i = self.index_of(name)
+        if i is None:
+            return None
+        return self.ids[i], bool(self.effective_bits[i >> 3] & (1 << (i & 7)))
+
+    def evaluate(self, name: str) -> bool:
+        # effective state of a normalized name, unknown names are disabled
+        found = self.lookup(name)
+        return found is not None and found[1]
+
+
+class SnapshotStore:
+    # the snapshot file at `path`, replaced atomically by publish() and remapped
+    # by current() whenever it was replaced
+    def __init__(self, path: str = SNAPSHOT_PATH):
+        self.path = path
+        self._key = None
+        self._snapshot: Optional[Snapshot] = None
+
+    def current(self) -> Optional[Snapshot]:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if key != self._key:
+            try:
+                with open(self.path, "rb") as file:
+                    # the mapping outlives the file, and a replaced file too
+                    buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                self._snapshot = Snapshot(buffer)
+            except (OSError, ValueError, TypeError, IndexError, struct.error):
+                # readers fall back to the db until the file is replaced
+                logger.exception("Failed to map the flag snapshot %s", self.path)
+                self._snapshot = None
+            self._key = key
+        return self._snapshot
+
+    def publish(self, data: bytes):
+        # readers see either the old file or the new one, never a partial write
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, self.path)
+
+
+class SnapshotRefresher:
+    """
+    Keeps the snapshot up to date. Every worker runs one, but only the worker
+    holding the lock file refreshes: on each change it is notified of, and every
+    `interval` seconds if the flag set version moved on (changes made while it
+    wasn't listening). The others retry the lock every `interval`, to take over
+    if that worker goes away.
+    """
+
+    def __init__(
+        self, store: SnapshotStore, interval: float = SNAPSHOT_REFRESH_SECONDS
+    ):
+        self.store = store
+        self.interval = interval
+        self.lock_path = f"{store.path}.lock"
+        self.leader = False
+        self._lock_file = None
+        self._changed: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def try_lock(self) -> bool:
+        lock_file = open(self.lock_path, "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        # held until this process exits
+        self._lock_file = lock_file
+        return True
+
+    def notify(self):
+        if self._changed is not None:
+            self._changed.set()
+
+    def start(
+        self,
+        build: Callable[[], Awaitable[bytes]],
+        read_flag_set_version: Callable[[], Awaitable[int]],
+    ):
+        if self._task is None:
+            self._changed = asyncio.Event()
+            self._task = asyncio.create_task(self._run(build, read_flag_set_version))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+            self.leader = False
+
+    async def refresh(self, build, read_flag_set_version) -> bool:
+        snapshot = self.store.current()
+        if (
+            snapshot is not None
+            and snapshot.flag_set_version == await read_flag_set_version()
+        ):
+            return False
+        self.store.publish(await build())
+        return True
+
+    async def _run(self, build, read_flag_set_version):
+        while True:
+            # cleared first, changes made during a refresh trigger another one
+            self._changed.clear()
+            if not self.leader:
+                self.leader = self.try_lock()
+            if self.leader:
+                try:
+                    await self.refresh(build, read_flag_set_version)
+                except Exception:
+                    logger.exception("Failed to refresh the flag snapshot")
+            try:
+                await asyncio.wait_for(self._changed.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+
+flag_snapshot = SnapshotStore()
+snapshot_refresher = SnapshotRefresher(flag_snapshot)
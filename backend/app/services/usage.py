@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Iterable, Optional
+
+from app.database.operations import upsert_feature_usage
+from app.database.session import AsyncSessionLocal
+from app.services.constants import (USAGE_ENABLED, USAGE_FLUSH_SECONDS,
+                                    USAGE_MAX_FEATURES)
+
+logger = logging.getLogger(__name__)
+
+
+class UsageCounters:
+    """
+    Evaluations of each feature, by id, seen by this worker since the last
+    flush, and when the last one happened. A background task adds them to the usage
+    table every `flush_seconds`, in one upsert, and starts counting afresh.
+
+    Counting never waits and takes no lock: it runs on the event loop without
+    awaiting, and flush() swaps in new dicts before it awaits the db. Each
+    worker counts on its own, the upsert adds the counts of all of them up.
+    """
+
+    def __init__(
+        self,
+        session_factory=AsyncSessionLocal,
+        flush_seconds: float = USAGE_FLUSH_SECONDS,
+        max_features: int = USAGE_MAX_FEATURES,
+        enabled: bool = USAGE_ENABLED,
+    ):
+        self.session_factory = session_factory
+        self.flush_seconds = flush_seconds
+        self.max_features = max_features
+        self.enabled = enabled
+        # feature id -> evaluations, time.time() of the last one
+        self.counts = {}
+        self.last_evaluated = {}
+        self.flushed = 0
+        self.dropped = 0
+        self.failed_flushes = 0
+        self._stopped: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def count(self, feature_ids: Iterable[int]):
+        # ids of existing features only, they are all kept until the flush
+        if not self.enabled:
+            return
+        now = time.time()
+        counts, last_evaluated = self.counts, self.last_evaluated
+        for feature_id in feature_ids:
+            if feature_id not in counts and len(counts) >= self.max_features:
+                self.dropped += 1
+                continue
+            counts[feature_id] = counts.get(feature_id, 0) + 1
+            last_evaluated[feature_id] = now
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._stopped = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._stopped.set()
+            await self._task
+            self._task = None
+            self._stopped = None
+        await self.flush()
+
+    async def flush(self) -> bool:
+        counts, last_evaluated = self.counts, self.last_evaluated
+        if not counts:
+            return True
+        self.counts, self.last_evaluated = {}, {}
+        feature_ids = sorted(counts)
+        try:
+            async with self.session_factory() as db:
+                await upsert_feature_usage(
+                    db,
+                    feature_ids,
+                    [counts[feature_id] for feature_id in feature_ids],
+                    [
+                        datetime.fromtimestamp(last_evaluated[feature_id], timezone.utc)
+                        for feature_id in feature_ids
+                    ],
+                )
+                await db.commit()
+        except Exception:
+            logger.exception(
+                "Failed to write the usage of %s features", len(feature_ids)
+            )
+            self.failed_flushes += 1
+            # counted again with the next flush
+            for feature_id in feature_ids:
+                self.counts[feature_id] = (
+                    self.counts.get(feature_id, 0) + counts[feature_id]
+                )
+                self.last_evaluated[feature_id] = max(
+                    self.last_evaluated.get(feature_id, 0), last_evaluated[feature_id]
+                )
+            return False
+        self.flushed += sum(counts.values())
+        return True
+
+    async def _run(self):
+        while not self._stopped.is_set():
+            try:
+                await asyncio.wait_for(self._stopped.wait(), self.flush_seconds)
+            except asyncio.TimeoutError:
+                await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "features": len(self.counts),
+            "pending": sum(self.counts.values()),
+            "flushed": self.flushed,
+            "dropped": self.dropped,
+            "failed_flushes": self.failed_flushes,
+        }
+
+
+evaluation_usage = UsageCounters()
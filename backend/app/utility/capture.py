@@ -0,0 +1,175 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+from app.utility.metrics import match_route
+
+logger = logging.getLogger(__name__)
+
+# Records a random share of the requests (0 disables capture, the middleware
+# isn't installed) to a JSON lines file, for tests/perf/replay.py
+CAPTURE_SAMPLE_RATE = float(os.getenv("CAPTURE_SAMPLE_RATE", 0))
+CAPTURE_FILE = os.getenv("CAPTURE_FILE", "capture.jsonl")
+# the file is rotated past CAPTURE_MAX_BYTES, keeping CAPTURE_BACKUP_COUNT old ones
+CAPTURE_MAX_BYTES = int(os.getenv("CAPTURE_MAX_BYTES", 100 * 1024 * 1024))
+CAPTURE_BACKUP_COUNT = int(os.getenv("CAPTURE_BACKUP_COUNT", 5))
+# larger bodies are cut, and flagged as such
+CAPTURE_MAX_BODY_BYTES = int(os.getenv("CAPTURE_MAX_BODY_BYTES", 64 * 1024))
+CAPTURE_FLUSH_SECONDS = float(os.getenv("CAPTURE_FLUSH_SECONDS", 1))
+CAPTURE_QUEUE_SIZE = int(os.getenv("CAPTURE_QUEUE_SIZE", 10000))
+# only headers that change the response are kept, never credentials
+CAPTURED_HEADERS = (b"content-type", b"accept", b"if-none-match")
+
+
+class CaptureWriter:
+    """
+    Buffers captured requests and appends them to `path` from a background
+    thread, every `flush_seconds`. Records beyond `queue_size` waiting are
+    dropped and counted, requests never wait on the disk.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_bytes: int = CAPTURE_MAX_BYTES,
+        backup_count: int = CAPTURE_BACKUP_COUNT,
+        flush_seconds: float = CAPTURE_FLUSH_SECONDS,
+        queue_size: int = CAPTURE_QUEUE_SIZE,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_seconds = flush_seconds
+        self.queue_size = queue_size
+        self.queue: deque = deque()
+        self.dropped = 0
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def write(self, record: dict):
+        if len(self.queue) >= self.queue_size:
+            self.dropped += 1
+            return
+        self.queue.append(record)
+        if self._thread is None:
+            self._start()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="capture-writer", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_seconds):
+            self.flush()
+
+    def flush(self):
+        lines = []
+        while self.queue:
+            lines.append(json.dumps(self.queue.popleft()) + "\n")
+        if not lines:
+            return
+        data = "".join(lines)
+        try:
+            if (
+                os.path.exists(self.path)
+                and os.path.getsize(self.path) + len(data) > self.max_bytes
+            ):
+                self.rotate()
+            with open(self.path, "a") as file:
+                file.write(data)
+        except OSError:
+            logger.exception("Failed to write %s captured requests", len(lines))
+
+    def rotate(self):
+        # capture.jsonl -> capture.jsonl.1 -> ... -> capture.jsonl.<backup_count>
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backup_count:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def shutdown(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+
+class CaptureMiddleware:
+    # records method, path, query, body, status and timing of sampled requests
+    def __init__(
+        self,
+        app,
+        writer: "CaptureWriter" = None,
+        sample_rate: float = CAPTURE_SAMPLE_RATE,
+        max_body_bytes: int = CAPTURE_MAX_BODY_BYTES,
+    ):
+        self.app = app
+        self.writer = writer if writer is not None else capture_writer
+        self.sample_rate = sample_rate
+        self.max_body_bytes = max_body_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or random.random() >= self.sample_rate:
+            return await self.app(scope, receive, send)
+
+        body = bytearray()
+        truncated = False
+        status_code = 500
+
+        async def receive_and_capture():
+            nonlocal truncated
+            message = await receive()
+            if message["type"] == "http.request":
+                chunk = message.get("body", b"")
+                room = self.max_body_bytes - len(body)
+                body.extend(chunk[:room])
+                truncated = truncated or len(chunk) > room
+            return message
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        timestamp = time.time()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive_and_capture, send_with_status)
+        finally:
+            duration = time.perf_counter() - start
+            record = {
+                "ts": timestamp,
+                "method": scope["method"],
+                "path": scope["path"],
+                "route": match_route(scope["app"], scope),
+                "query": scope["query_string"].decode("latin-1"),
+                "headers": {
+                    name.decode("latin-1"): value.decode("latin-1")
+                    for name, value in scope["headers"]
+                    if name in CAPTURED_HEADERS
+                },
+                "body": body.decode("utf-8", "replace"),
+                "status": status_code,
+                "duration_ms": round(duration * 1000, 3),
+            }
+            if truncated:
+                record["body_truncated"] = True
+            self.writer.write(record)
+
+
+capture_writer = CaptureWriter(CAPTURE_FILE)
@@ -31,3 +31,16 @@ class NameLengthLimitException(Exception):
 class DeletingParentFeature(Exception):
     # raised when deleting a parent feature
     pass
+
+
+class InvalidCursorException(Exception):
+    # raised when a pagination cursor can't be decoded
+    pass
+
+
+class BatchValidationException(Exception):
+    # raised when some operations of a batch are invalid, nothing is written
+    def __init__(self, errors):
+        super().__init__()
+        # list of (index of the operation, exception raised for it)
+        self.errors = errors
@@ -0,0 +1,219 @@
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Tuple
+
+from sqlalchemy import event
+from starlette.routing import Match
+
+# upper bounds (seconds) of the latency histogram buckets, +Inf is implicit
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+# first keyword of the SQL statements timed by operation, anything else is OTHER
+DB_OPERATIONS = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+# route label of requests matching no route, so unknown paths can't add series
+UNMATCHED_ROUTE = "unmatched"
+
+
+class Histogram:
+    # cumulative counts are computed when rendered, observe() only bumps one slot
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class RouteMetrics:
+    # everything recorded for one (method, route) pair, created on its first request
+    def __init__(self):
+        self.latency = Histogram()
+        self.in_flight = 0
+        self.responses: Dict[int, int] = {}
+
+
+class Metrics:
+    """
+    In-process aggregation for /metrics. Every series is created on first use and
+    updated in place afterwards, requests don't allocate anything that is kept.
+    Collectors add gauges read only when rendering (cache, pool...).
+    """
+
+    def __init__(self):
+        self.routes: Dict[Tuple[str, str], RouteMetrics] = {}
+        self.db_statements = {
+            operation: Histogram() for operation in DB_OPERATIONS + ("OTHER",)
+        }
+        self.collectors: List[Callable[[], List[Tuple[str, str, str, float]]]] = []
+
+    def route(self, method: str, route: str) -> RouteMetrics:
+        route_metrics = self.routes.get((method, route))
+        if route_metrics is None:
+            route_metrics = self.routes[(method, route)] = RouteMetrics()
+        return route_metrics
+
+    def observe_db_statement(self, statement: str, seconds: float):
+        for operation in DB_OPERATIONS:
+            if statement.startswith(operation):
+                break
+        else:
+            operation = "OTHER"
+        self.db_statements[operation].observe(seconds)
+
+    def add_collector(self, collector):
+        # collector() -> [(name, type, help, value)], called on every scrape
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        # Prometheus text exposition format 0.0.4
+        lines = []
+        routes = sorted(self.routes.items())
+
+        lines += [
+            "# HELP http_request_duration_seconds Request latency by route.",
+            "# TYPE http_request_duration_seconds histogram",
+        ]
+        for (method, route), route_metrics in routes:
+            labels = f'method="{method}",route="{route}"'
+            lines += render_histogram(
+                "http_request_duration_seconds", labels, route_metrics.latency
+            )
+
+        lines += [
+            "# HELP http_requests_in_flight Requests being served by route.",
+            "# TYPE http_requests_in_flight gauge",
+        ]
+        for (method, route), route_metrics in routes:
+            lines.append(
+                f'http_requests_in_flight{{method="{method}",route="{route}"}} '
+                f"{route_metrics.in_flight}"
+            )
+
+        lines += [
+            "# HELP http_responses_total Responses by route and status code.",
+            "# TYPE http_responses_total counter",
+        ]
+        for (method, route), route_metrics in routes:
+            for status, count in sorted(route_metrics.responses.items()):
+                lines.append(
+                    f'http_responses_total{{method="{method}",route="{route}",'
+                    f'status="{status}"}} {count}'
+                )
+
+        lines += [
+            "# HELP db_statement_duration_seconds SQL statement latency by operation.",
+            "# TYPE db_statement_duration_seconds histogram",
+        ]
+        for operation, histogram in self.db_statements.items():
+            lines += render_histogram(
+                "db_statement_duration_seconds", f'operation="{operation}"', histogram
+            )
+
+        for collector in self.collectors:
+            for name, metric_type, help_text, value in collector():
+                lines += [
+                    f"# HELP {name} {help_text}",
+                    f"# TYPE {name} {metric_type}",
+                    f"{name} {value}",
+                ]
+        return "\n".join(lines) + "\n"
+
+
+def render_histogram(name: str, labels: str, histogram: Histogram) -> List[str]:
+    lines = []
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+    lines.append(f"{name}_sum{{{labels}}} {histogram.sum}")
+    lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+    return lines
+
+
+def match_route(app, scope) -> str:
+    # path template of the route the request goes to, e.g. /api/v1/features/{feature_id}
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return UNMATCHED_ROUTE
+
+
+class MetricsMiddleware:
+    # Plain ASGI middleware (no per request Request/Response objects) recording
+    # latency, in-flight requests and status codes of every HTTP request
+    def __init__(self, app, metrics: "Metrics" = None):
+        self.app = app
+        self.metrics = metrics if metrics is not None else default_metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        route_metrics = self.metrics.route(
+            scope["method"], match_route(scope["app"], scope)
+        )
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        route_metrics.in_flight += 1
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route_metrics.latency.observe(time.perf_counter() - start)
+            route_metrics.in_flight -= 1
+            route_metrics.responses[status_code] = (
+                route_metrics.responses.get(status_code, 0) + 1
+            )
+
+
+def instrument_engine(engine, metrics: "Metrics" = None):
+    # times every statement run by the engine (async engines: pass engine.sync_engine)
+    metrics = metrics if metrics is not None else default_metrics
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, many):
+        start = conn.info["query_start_time"].pop()
+        metrics.observe_db_statement(statement, time.perf_counter() - start)
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(exception_context):
+        # the failed statement never reaches after_cursor_execute
+        conn = exception_context.connection
+        if conn is not None and conn.info.get("query_start_time"):
+            start = conn.info["query_start_time"].pop()
+            metrics.observe_db_statement(
+                exception_context.statement or "", time.perf_counter() - start
+            )
+
+
+# one registry per worker process
+default_metrics = Metrics()
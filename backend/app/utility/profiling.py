@@ -0,0 +1,220 @@
+import asyncio
+import hmac
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+# Profiles a request when it sends the secret in the X-Profile header, and a
+# random share of all requests. The middleware is only installed when one of
+# the two is set, so requests pay nothing otherwise.
+PROFILING_SECRET = os.getenv("PROFILING_SECRET", "")
+PROFILING_SAMPLE_RATE = float(os.getenv("PROFILING_SAMPLE_RATE", 0))
+PROFILING_INTERVAL_SECONDS = float(os.getenv("PROFILING_INTERVAL_SECONDS", 0.002))
+PROFILES_DIR = os.getenv(
+    "PROFILES_DIR", os.path.join(tempfile.gettempdir(), "feature-core-profiles")
+)
+PROFILING_ENABLED = bool(PROFILING_SECRET) or PROFILING_SAMPLE_RATE > 0
+PROFILE_HEADER = b"x-profile"
+
+# functions of these modules are the phases a sample is attributed to
+PHASE_MODULES = {
+    "app.services.feature_flag": "service",
+    "app.database.operations": "db",
+}
+# what the innermost recognised frame of a sample was doing
+ACTIVITY_MODULES = (
+    ("pydantic", "pydantic"),
+    ("sqlalchemy", "sqlalchemy"),
+    ("asyncpg", "asyncpg"),
+    ("orjson", "json"),
+    ("json", "json"),
+    ("fastapi", "framework"),
+    ("starlette", "framework"),
+)
+# the event loop waiting on sockets, i.e. on postgres or the client
+IDLE_MODULES = ("selectors", "asyncio.base_events")
+
+Stack = Tuple[Tuple[str, str], ...]
+
+
+def stack_of(frame) -> Stack:
+    # (module, function) of every frame, outermost first
+    stack = []
+    while frame is not None:
+        stack.append((frame.f_globals.get("__name__", "?"), frame.f_code.co_name))
+        frame = frame.f_back
+    return tuple(reversed(stack))
+
+
+def module_label(module: str, labels) -> Optional[str]:
+    for prefix, label in labels:
+        if module == prefix or module.startswith(prefix + "."):
+            return label
+    return None
+
+
+def phase_of(stack: Stack) -> Tuple[str, str]:
+    """
+    (phase, activity) of one sample: the innermost function of a phase module,
+    e.g. "db.get_feature_rows", and what was running below it, e.g. "sqlalchemy".
+    """
+    phase = "other"
+    activity = "python"
+    if stack and stack[-1][0] in IDLE_MODULES:
+        activity = "idle"
+    for module, function in stack:
+        if module in PHASE_MODULES:
+            phase = f"{PHASE_MODULES[module]}.{function}"
+            if activity != "idle":
+                activity = "python"
+        elif activity != "idle":
+            activity = module_label(module, ACTIVITY_MODULES) or activity
+    return phase, activity
+
+
+class Sampler(threading.Thread):
+    # records the stack of another thread (the event loop's) every `interval`
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(name="request-profiler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[stack_of(frame)] += 1
+
+    def stop(self):
+        # the thread exits once done with the sample it may be taking
+        self._stopped.set()
+
+    def collect(self) -> Counter:
+        # stops the thread and waits for it, to be run off the event loop
+        self.stop()
+        self.join()
+        return self.stacks
+
+
+def build_profile(stacks: Counter, interval: float, **request) -> dict:
+    phases: Counter = Counter()
+    for stack, count in stacks.items():
+        phases[phase_of(stack)] += count
+    return {
+        **request,
+        "interval_seconds": interval,
+        "samples": sum(stacks.values()),
+        "phases": [
+            {
+                "phase": phase,
+                "activity": activity,
+                "samples": count,
+                "seconds": round(count * interval, 6),
+            }
+            for (phase, activity), count in phases.most_common()
+        ],
+        # folded stacks, for flamegraph.pl / speedscope
+        "stacks": [
+            ";".join(f"{module}:{function}" for module, function in stack) + f" {count}"
+            for stack, count in stacks.most_common()
+        ],
+    }
+
+
+def server_timing(profile: dict) -> str:
+    # time per phase, shown by browser dev tools next to the request
+    durations: Dict[str, float] = {}
+    for phase in profile["phases"]:
+        durations[phase["phase"]] = (
+            durations.get(phase["phase"], 0.0) + phase["seconds"]
+        )
+    metrics: List[str] = [
+        f"{phase};dur={seconds * 1000:.1f}" for phase, seconds in durations.items()
+    ]
+    metrics.append(f"total;dur={profile['duration_seconds'] * 1000:.1f}")
+    return ", ".join(metrics)
+
+
+def write_profile(profiles_dir: str, profile: dict):
+    os.makedirs(profiles_dir, exist_ok=True)
+    with open(os.path.join(profiles_dir, f"{profile['id']}.json"), "w") as file:
+        json.dump(profile, file)
+
+
+class ProfilingMiddleware:
+    """
+    Samples the event loop thread while a request runs, until its response
+    starts, and writes the profile to `profiles_dir`. Requests profiled on demand
+    (X-Profile header) also get its id and a Server-Timing header back.
+
+    Every coroutine running on the loop is sampled, profile on a quiet worker to
+    see one request alone.
+    """
+
+    def __init__(
+        self,
+        app,
+        secret: str = PROFILING_SECRET,
+        sample_rate: float = PROFILING_SAMPLE_RATE,
+        interval: float = PROFILING_INTERVAL_SECONDS,
+        profiles_dir: str = PROFILES_DIR,
+    ):
+        self.app = app
+        self.secret = secret.encode()
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.profiles_dir = profiles_dir
+
+    def requested(self, scope) -> bool:
+        if not self.secret:
+            return False
+        for name, value in scope["headers"]:
+            if name == PROFILE_HEADER:
+                return hmac.compare_digest(value, self.secret)
+        return False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        requested = self.requested(scope)
+        if not requested and random.random() >= self.sample_rate:
+            return await self.app(scope, receive, send)
+
+        sampler = Sampler(threading.get_ident(), self.interval)
+        sampler.start()
+        start = time.perf_counter()
+
+        async def send_with_profile(message):
+            if message["type"] == "http.response.start":
+                profile = build_profile(
+                    await asyncio.to_thread(sampler.collect),
+                    self.interval,
+                    id=uuid.uuid4().hex,
+                    method=scope["method"],
+                    path=scope["path"],
+                    status=message["status"],
+                    duration_seconds=round(time.perf_counter() - start, 6),
+                )
+                await asyncio.to_thread(write_profile, self.profiles_dir, profile)
+                if requested:
+                    message["headers"] = [
+                        *message.get("headers", []),
+                        (b"x-profile-id", profile["id"].encode()),
+                        (b"server-timing", server_timing(profile).encode()),
+                    ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_profile)
+        finally:
+            # no response was started (the request failed), nothing to collect
+            sampler.stop()
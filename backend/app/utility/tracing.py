@@ -0,0 +1,400 @@
+import functools
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+import urllib.request
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import List, Optional
+
+from app.utility.metrics import match_route
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# Spans of the router handlers, service calls, db operations and SQL statements
+# of every request, exported in batches to a JSON lines file or to an OTLP/HTTP
+# collector. Functions are only wrapped when tracing is enabled.
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "false").lower() == "true"
+# "file" or "otlp"
+TRACING_EXPORTER = os.getenv("TRACING_EXPORTER", "file")
+TRACING_FILE = os.getenv("TRACING_FILE", "spans.jsonl")
+TRACING_OTLP_ENDPOINT = os.getenv(
+    "TRACING_OTLP_ENDPOINT", "http://localhost:4318/v1/traces"
+)
+TRACING_SERVICE_NAME = os.getenv("TRACING_SERVICE_NAME", "feature-core")
+# spans per export, seconds between exports and spans kept waiting at most
+# (more are dropped)
+TRACING_BATCH_SIZE = int(os.getenv("TRACING_BATCH_SIZE", 512))
+TRACING_FLUSH_SECONDS = float(os.getenv("TRACING_FLUSH_SECONDS", 5))
+TRACING_QUEUE_SIZE = int(os.getenv("TRACING_QUEUE_SIZE", 10000))
+# SQL kept on statement spans
+TRACING_STATEMENT_LENGTH = 1000
+
+# OTLP span kinds
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+
+current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+class Span:
+    __slots__ = (
+        "name",
+        "kind",
+        "trace_id",
+        "span_id",
+        "parent_id",
+        "start_ns",
+        "end_ns",
+        "attributes",
+        "error",
+    )
+
+    def __init__(
+        self,
+        name: str,
+        kind: int = SPAN_KIND_INTERNAL,
+        trace_id: Optional[str] = None,
+        parent_id: Optional[str] = None,
+        attributes: Optional[dict] = None,
+    ):
+        self.name = name
+        self.kind = kind
+        self.trace_id = trace_id or os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes = attributes or {}
+        self.error: Optional[str] = None
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "kind": self.kind,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_ns": self.start_ns,
+            "duration_ms": (self.end_ns - self.start_ns) / 1e6,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [otlp_attribute(k, v) for k, v in self.attributes.items()],
+            # 1 ok, 2 error
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+def otlp_attribute(key: str, value) -> dict:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+class FileSpanExporter:
+    # one JSON object per span and line
+    def __init__(self, path: str):
+        self.path = path
+
+    def export(self, spans: List[Span]):
+        with open(self.path, "a") as file:
+            for span in spans:
+                file.write(json.dumps(span.to_dict(), default=str) + "\n")
+
+
+class OtlpHttpSpanExporter:
+    # OTLP/HTTP with the JSON encoding, accepted by the OpenTelemetry collector,
+    # Jaeger, Tempo...
+    def __init__(self, endpoint: str, service_name: str, timeout: float = 10):
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.timeout = timeout
+
+    def payload(self, spans: List[Span]) -> dict:
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            otlp_attribute("service.name", self.service_name)
+                        ]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "app.utility.tracing"},
+                            "spans": [span.to_otlp() for span in spans],
+                        }
+                    ],
+                }
+            ]
+        }
+
+    def export(self, spans: List[Span]):
+        request = urllib.request.Request(
+            self.endpoint,
+            data=json.dumps(self.payload(spans)).encode(),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout):
+            pass
+
+
+class BatchSpanProcessor:
+    """
+    Queues ended spans and exports them from a background thread, every
+    `flush_seconds` or as soon as `batch_size` are waiting. Requests never wait
+    on the exporter; when it can't keep up, spans beyond `queue_size` are dropped
+    and counted.
+    """
+
+    def __init__(
+        self,
+        exporter,
+        batch_size: int = TRACING_BATCH_SIZE,
+        flush_seconds: float = TRACING_FLUSH_SECONDS,
+        queue_size: int = TRACING_QUEUE_SIZE,
+    ):
+        self.exporter = exporter
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.queue_size = queue_size
+        self.queue: deque = deque()
+        self.dropped = 0
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def on_end(self, span: Span):
+        if len(self.queue) >= self.queue_size:
+            self.dropped += 1
+            return
+        self.queue.append(span)
+        if self._thread is None:
+            self._start()
+        if len(self.queue) >= self.batch_size:
+            self._wakeup.set()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="span-exporter", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.flush_seconds)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        while self.queue:
+            batch = []
+            while self.queue and len(batch) < self.batch_size:
+                batch.append(self.queue.popleft())
+            try:
+                self.exporter.export(batch)
+            except Exception:
+                logger.exception("Failed to export %s spans", len(batch))
+
+    def shutdown(self):
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+
+class Tracer:
+    def __init__(self, enabled: bool, processor: Optional[BatchSpanProcessor] = None):
+        self.enabled = enabled
+        self.processor = processor
+
+    def start_span(
+        self, name: str, kind: int = SPAN_KIND_INTERNAL, **attributes
+    ) -> Span:
+        parent = current_span.get()
+        return Span(
+            name,
+            kind,
+            trace_id=parent.trace_id if parent else None,
+            parent_id=parent.span_id if parent else None,
+            attributes=attributes,
+        )
+
+    def end_span(self, span: Span):
+        span.end_ns = time.time_ns()
+        self.processor.on_end(span)
+
+    @contextmanager
+    def span(self, name: str, kind: int = SPAN_KIND_INTERNAL, **attributes):
+        # the span is the parent of the spans started inside the block
+        span = self.start_span(name, kind, **attributes)
+        token = current_span.set(span)
+        try:
+            yield span
+        except BaseException as exc:
+            span.error = f"{type(exc).__name__}: {exc}"
+            raise
+        finally:
+            current_span.reset(token)
+            self.end_span(span)
+
+    def traced(self, layer: str):
+        # @tracer.traced("db") wraps the function in a "db.<function name>" span,
+        # or leaves it as is when tracing is disabled
+        def decorator(fn):
+            if not self.enabled:
+                return fn
+            name = f"{layer}.{fn.__name__}"
+
+            if inspect.iscoroutinefunction(fn):
+
+                @functools.wraps(fn)
+                async def async_wrapper(*args, **kwargs):
+                    with self.span(name):
+                        return await fn(*args, **kwargs)
+
+                return async_wrapper
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return fn(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def shutdown(self):
+        if self.processor is not None:
+            self.processor.shutdown()
+
+
+def parse_traceparent(value: str):
+    # W3C trace context: 00-<trace id>-<parent span id>-<flags>
+    parts = value.split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None, None
+    return parts[1], parts[2]
+
+
+class TracingMiddleware:
+    # root span of every request, continuing the caller's trace (traceparent
+    # header) and returning the trace id in X-Trace-Id
+    def __init__(self, app, tracer: "Tracer" = None):
+        self.app = app
+        self.tracer = tracer if tracer is not None else default_tracer
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        route = match_route(scope["app"], scope)
+        span = Span(
+            f"{scope['method']} {route}",
+            SPAN_KIND_SERVER,
+            attributes={"http.method": scope["method"], "http.route": route},
+        )
+        for name, value in scope["headers"]:
+            if name == b"traceparent":
+                trace_id, parent_id = parse_traceparent(value.decode("latin-1"))
+                if trace_id:
+                    span.trace_id, span.parent_id = trace_id, parent_id
+
+        async def send_with_trace_id(message):
+            if message["type"] == "http.response.start":
+                span.attributes["http.status_code"] = message["status"]
+                message["headers"] = [
+                    *message.get("headers", []),
+                    (b"x-trace-id", span.trace_id.encode()),
+                ]
+            await send(message)
+
+        token = current_span.set(span)
+        try:
+            await self.app(scope, receive, send_with_trace_id)
+        except BaseException as exc:
+            span.error = f"{type(exc).__name__}: {exc}"
+            raise
+        finally:
+            current_span.reset(token)
+            self.tracer.end_span(span)
+
+
+def instrument_engine(engine, tracer: "Tracer" = None):
+    # a client span per SQL statement run inside a traced request (async
+    # engines: pass engine.sync_engine, SQLAlchemy carries the context over)
+    tracer = tracer if tracer is not None else default_tracer
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        span = None
+        if current_span.get() is not None:
+            span = tracer.start_span(
+                f"sql {statement.split(None, 1)[0] if statement else ''}",
+                SPAN_KIND_CLIENT,
+                **{
+                    "db.system": "postgresql",
+                    "db.statement": statement[:TRACING_STATEMENT_LENGTH],
+                    "db.executemany": many,
+                },
+            )
+        conn.info.setdefault("trace_spans", []).append(span)
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, many):
+        span = conn.info["trace_spans"].pop()
+        if span is not None:
+            tracer.end_span(span)
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(exception_context):
+        conn = exception_context.connection
+        if conn is not None and conn.info.get("trace_spans"):
+            span = conn.info["trace_spans"].pop()
+            if span is not None:
+                exc = exception_context.original_exception
+                span.error = f"{type(exc).__name__}: {exc}"
+                tracer.end_span(span)
+
+
+def tracer_from_env() -> Tracer:
+    if not TRACING_ENABLED:
+        return Tracer(enabled=False)
+    if TRACING_EXPORTER == "otlp":
+        exporter = OtlpHttpSpanExporter(TRACING_OTLP_ENDPOINT, TRACING_SERVICE_NAME)
+    else:
+        exporter = FileSpanExporter(TRACING_FILE)
+    return Tracer(enabled=True, processor=BatchSpanProcessor(exporter))
+
+
+# one tracer per worker process
+default_tracer = tracer_from_env()
@@ -1,6 +1,21 @@
+import json
+
+try:
+    import orjson
+except ImportError:  # optional, faster JSON encoding when installed
+    orjson = None
+
+
 def normalize_name(name: str) -> str:
     return name.strip().lower().replace(" ", "_")
 
 
 def denormalize_name(name: str) -> str:
     return name.replace("_", " ").title()
+
+
+def dumps_json(obj) -> bytes:
+    # compact UTF-8 JSON, same output as FastAPI's JSONResponse
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
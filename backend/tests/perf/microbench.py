@@ -0,0 +1,382 @@
+"""
+Microbenchmarks of the service layer hot paths, at several flag counts:
+
+    get_all_features         whole tree built from the rows (cache cold)
+    get_all_features_cached  same, served from the in-process cache
+    create_feature           one flag created
+    update_feature           a parent with children toggled
+    normalize_name           every flag name normalized
+    denormalize_name         every flag name denormalized
+    model_validate           Feature.model_validate of every flag
+
+Backends:
+
+    memory    the db operations used by the service replaced by an in-memory
+              stand-in, to measure our Python code alone
+    postgres  a real postgres (DATABASE_URL), seeded inside a transaction which
+              is rolled back at the end
+
+Save results as a baseline, then compare later runs against it:
+
+    cd backend
+    python -m tests.perf.microbench run --backend memory --output baseline.json
+    python -m tests.perf.microbench run --backend memory --output current.json
+    python -m tests.perf.microbench compare baseline.json current.json
+
+`compare` exits with 1 when a benchmark's median got slower than the baseline by
+more than --threshold (20% by default).
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from contextlib import asynccontextmanager
+from itertools import count
+from types import SimpleNamespace
+from unittest import mock
+
+from app.database.migrations import run_migrations
+from app.database.models import Base
+from app.routers.v1.schemas import Feature, FeatureCreate
+from app.services import feature_flag as feature_flag_svc
+from app.services.cache import feature_cache
+from app.utility.utils import denormalize_name, normalize_name
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from tests.perf.bench_read_path import DEFAULT_DB_URL, seed
+
+DEFAULT_SIZES = (100, 1000, 10000, 100000)
+# children per parent of the seeded flags
+CHILDREN_PER_PARENT = 9
+DEFAULT_THRESHOLD = 0.2
+# medians below this many ms are too noisy to fail on
+MIN_MEDIAN_MS = 0.05
+
+
+class MemoryDatabase:
+    """
+    Stand-in for the db operations used by the service functions, keeping flags
+    in a dict. Same signatures and row shapes as the real ones.
+    """
+
+    def __init__(self):
+        self.rows = {}
+        self.version = 0
+        self.ids = count(1)
+        self._sorted_rows = None
+
+    def add(self, name, is_enabled, parent_id=None):
+        row = SimpleNamespace(
+            id=next(self.ids),
+            name=name,
+            display_name=None,
+            is_enabled=is_enabled,
+            parent_id=parent_id,
+        )
+        self.rows[row.id] = row
+        self._sorted_rows = None
+        return row
+
+    def published(self, row, ids, **columns):
+        self.version += 1
+        return SimpleNamespace(
+            **vars(row), version=self.version, ids=ids, parent_found=True, **columns
+        )
+
+    async def get_flag_set_version(self, db):
+        return self.version
+
+    async def get_feature_rows(self, db, feature_id=None):
+        if self._sorted_rows is None:
+            self._sorted_rows = sorted(self.rows.values(), key=lambda row: row.name)
+        if feature_id is None:
+            return self._sorted_rows
+        return [
+            row for row in self._sorted_rows if feature_id in (row.id, row.parent_id)
+        ]
+
+    async def insert_feature(self, db, name, display_name, is_enabled, parent_id):
+        row = self.add(name, is_enabled, parent_id)
+        row.display_name = display_name
+        return self.published(row, [row.id, parent_id])
+
+    async def update_db_feature(
+        self,
+        db,
+        feature_id,
+        name,
+        display_name,
+        is_enabled,
+        parent_id,
+        children_limit=None,
+    ):
+        row = self.rows[feature_id]
+        old_is_enabled = row.is_enabled
+        row.name, row.display_name = name, display_name
+        row.is_enabled, row.parent_id = is_enabled, parent_id
+        self._sorted_rows = None
+        changed_children = []
+        if old_is_enabled != is_enabled:
+            changed_children = self.write_children(
+                feature_id, is_enabled, children_limit
+            )
+        children = [
+            vars(child) for child in self.rows.values() if child.parent_id == feature_id
+        ]
+        return self.published(
+            row,
+            [feature_id, *(child["id"] for child in changed_children)],
+            old_is_enabled=old_is_enabled,
+            children=children[:children_limit] if children_limit else children,
+            changed_children=changed_children,
+            feature_found=True,
+        )
+
+    def write_children(self, parent_id, is_enabled, limit):
+        # children given the parent's status, at most `limit` of them, as dicts
+        changed_children = []
+        for child in self.rows.values():
+            if limit and len(changed_children) == limit:
+                break
+            if child.parent_id == parent_id and child.is_enabled != is_enabled:
+                changed_children.append(
+                    dict(
+                        vars(child),
+                        is_enabled=is_enabled,
+                        old_is_enabled=child.is_enabled,
+                    )
+                )
+                child.is_enabled = is_enabled
+        return changed_children
+
+    async def update_children_status(self, db, parent_id, is_enabled, limit):
+        changed_children = self.write_children(parent_id, is_enabled, limit)
+        if not changed_children:
+            return None
+        self.version += 1
+        ids = [child["id"] for child in changed_children]
+        return {"version": self.version, "ids": ids, "origin": ""}, changed_children
+
+
+class MemorySession:
+    async def commit(self):
+        pass
+
+    async def rollback(self):
+        pass
+
+
+def seed_memory(store: MemoryDatabase, parents: int, children: int):
+    parent_ids = []
+    for i in range(parents):
+        parent_ids.append(store.add(f"bench_{i}", True).id)
+        for j in range(children):
+            store.add(f"bench_{i}_{j}", j % 2 == 0, parent_ids[-1])
+    return parent_ids
+
+
+@asynccontextmanager
+async def memory_backend(size: int):
+    store = MemoryDatabase()
+    parent_ids = seed_memory(
+        store, size // (CHILDREN_PER_PARENT + 1), CHILDREN_PER_PARENT
+    )
+    with mock.patch.multiple(
+        feature_flag_svc,
+        get_flag_set_version=store.get_flag_set_version,
+        get_feature_rows=store.get_feature_rows,
+        insert_feature=store.insert_feature,
+        update_db_feature=store.update_db_feature,
+        update_children_status=store.update_children_status,
+    ):
+        yield MemorySession(), parent_ids
+
+
+@asynccontextmanager
+async def postgres_backend(size: int):
+    engine = create_async_engine(os.getenv("DATABASE_URL", DEFAULT_DB_URL))
+    async with engine.connect() as conn:
+        # same schema as the app, committed before the transaction the benchmarks
+        # run in
+        async with conn.begin():
+            await conn.run_sync(Base.metadata.create_all)
+            await run_migrations(conn)
+        transaction = await conn.begin()
+        # the service's commits only release savepoints, everything is rolled
+        # back at the end
+        db = AsyncSession(
+            bind=conn, join_transaction_mode="create_savepoint", expire_on_commit=False
+        )
+        try:
+            parent_ids = await seed(
+                db, size // (CHILDREN_PER_PARENT + 1), CHILDREN_PER_PARENT
+            )
+            await db.commit()
+            yield db, parent_ids
+        finally:
+            await db.close()
+            await transaction.rollback()
+    await engine.dispose()
+
+
+BACKENDS = {"memory": memory_backend, "postgres": postgres_backend}
+
+
+def benchmarks(db, parent_ids, names, flags):
+    # name -> callable running the benchmark once (coroutine functions awaited)
+    created = count()
+    parent_id = parent_ids[0]
+    is_enabled = [True]
+
+    async def get_all_features():
+        feature_cache.invalidate()
+        await feature_flag_svc.get_all_features(db)
+
+    async def get_all_features_cached():
+        await feature_flag_svc.get_all_features(db)
+
+    async def create_feature():
+        await feature_flag_svc.create_feature(
+            db, FeatureCreate(name=f"created_{next(created)}", is_enabled=True)
+        )
+
+    async def update_feature():
+        is_enabled[0] = not is_enabled[0]
+        await feature_flag_svc.update_feature(
+            db,
+            parent_id,
+            FeatureCreate(name="bench_0", is_enabled=is_enabled[0]),
+        )
+
+    def normalize_names():
+        for name in names:
+            normalize_name(name)
+
+    def denormalize_names():
+        for name in names:
+            denormalize_name(name)
+
+    def model_validate():
+        for flag in flags:
+            Feature.model_validate(flag)
+
+    return {
+        "get_all_features": get_all_features,
+        "get_all_features_cached": get_all_features_cached,
+        "create_feature": create_feature,
+        "update_feature": update_feature,
+        "normalize_name": normalize_names,
+        "denormalize_name": denormalize_names,
+        "model_validate": model_validate,
+    }
+
+
+async def measure(benchmark, runs: int) -> dict:
+    is_async = asyncio.iscoroutinefunction(benchmark)
+    timings = []
+    for _ in range(runs + 1):
+        start = time.perf_counter()
+        if is_async:
+            await benchmark()
+        else:
+            benchmark()
+        timings.append((time.perf_counter() - start) * 1000)
+    # the first run warms up caches and prepared statements
+    timings = timings[1:]
+    return {
+        "median_ms": statistics.median(timings),
+        "p95_ms": statistics.quantiles(timings, n=20)[-1] if runs > 1 else timings[0],
+        "min_ms": min(timings),
+        "runs": runs,
+    }
+
+
+async def run(backend: str, sizes, runs: int, only=None) -> dict:
+    results = {}
+    for size in sizes:
+        names = [f"Bench Feature {i}" for i in range(size)]
+        flags = [
+            {"id": i, "name": name, "is_enabled": True, "parent_id": None}
+            for i, name in enumerate(names)
+        ]
+        async with BACKENDS[backend](size) as (db, parent_ids):
+            for name, benchmark in benchmarks(db, parent_ids, names, flags).items():
+                if only and name not in only:
+                    continue
+                result = await measure(benchmark, runs)
+                results[f"{name}[{size}]"] = result
+                print(
+                    f"{name + f'[{size}]':<34}{result['median_ms']:>12.3f}"
+                    f"{result['p95_ms']:>12.3f}",
+                    file=sys.stderr,
+                )
+        feature_cache.invalidate()
+    return {
+        "backend": backend,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> list:
+    # [(benchmark, baseline median, current median, change)] slower than threshold
+    regressions = []
+    for name, result in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+        change = result["median_ms"] / base["median_ms"] - 1
+        print(
+            f"{name:<34}{base['median_ms']:>12.3f}{result['median_ms']:>12.3f}"
+            f"{change:>+10.1%}"
+        )
+        if change > threshold and result["median_ms"] >= MIN_MEDIAN_MS:
+            regressions.append((name, base["median_ms"], result["median_ms"], change))
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("--backend", choices=BACKENDS, default="memory")
+    run_parser.add_argument(
+        "--sizes",
+        type=lambda value: [int(size) for size in value.split(",")],
+        default=DEFAULT_SIZES,
+    )
+    run_parser.add_argument("--runs", type=int, default=10)
+    run_parser.add_argument("--only", nargs="*", help="benchmarks to run")
+    run_parser.add_argument("--output", help="JSON file for the results")
+
+    compare_parser = commands.add_parser("compare", help="compare two runs")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        results = asyncio.run(run(args.backend, args.sizes, args.runs, args.only))
+        if args.output:
+            with open(args.output, "w") as file:
+                json.dump(results, file, indent=2)
+        return 0
+
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    with open(args.current) as file:
+        current = json.load(file)
+    regressions = compare(baseline, current, args.threshold)
+    for name, base, result, change in regressions:
+        print(f"REGRESSION {name}: {base:.3f} ms -> {result:.3f} ms ({change:+.1%})")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,180 @@
+"""
+Replays requests captured by the capture middleware (CAPTURE_SAMPLE_RATE) against
+a server, in capture order, and compares the latencies of two runs:
+
+    cd backend
+    python -m tests.perf.replay run capture.jsonl --target http://localhost:8000 \\
+        --speed 1 --concurrency 50 --output build_a.json
+    python -m tests.perf.replay run capture.jsonl --target http://localhost:8001 \\
+        --speed 1 --concurrency 50 --output build_b.json
+    python -m tests.perf.replay compare build_a.json build_b.json
+
+--speed 1 keeps the captured timing, 2 plays it twice as fast, 0 sends every
+request as soon as a slot among --concurrency is free. Writes are replayed too,
+run against a database restored to the state of the capture for matching
+responses; the status codes differing from the captured ones are reported.
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import sys
+import time
+from collections import defaultdict
+from typing import List
+
+import httpx
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+def load_capture(paths: List[str]) -> List[dict]:
+    # rotated files included (capture.jsonl.2 capture.jsonl.1 capture.jsonl),
+    # replayed in capture order
+    records = []
+    for path in paths:
+        with open(path) as file:
+            records += [json.loads(line) for line in file if line.strip()]
+    records.sort(key=lambda record: record["ts"])
+    return records
+
+
+def percentiles(latencies: List[float]) -> dict:
+    if len(latencies) < 2:
+        return {f"p{p}": latencies[0] if latencies else None for p in PERCENTILES}
+    cut_points = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {f"p{p}": cut_points[p - 1] for p in PERCENTILES}
+
+
+async def replay(
+    client: httpx.AsyncClient, records: List[dict], speed: float, concurrency: int
+) -> dict:
+    latencies = defaultdict(list)
+    statuses = defaultdict(lambda: defaultdict(int))
+    mismatches = defaultdict(int)
+    errors = defaultdict(int)
+    slots = asyncio.Semaphore(concurrency)
+
+    async def send(record: dict):
+        key = f"{record['method']} {record.get('route', record['path'])}"
+        try:
+            start = time.perf_counter()
+            response = await client.request(
+                record["method"],
+                record["path"] + (f"?{record['query']}" if record["query"] else ""),
+                headers=record["headers"],
+                content=record["body"].encode() if record["body"] else None,
+            )
+            latencies[key].append((time.perf_counter() - start) * 1000)
+        except httpx.HTTPError as exc:
+            errors[f"{key}: {type(exc).__name__}"] += 1
+            return
+        finally:
+            slots.release()
+        statuses[key][response.status_code] += 1
+        if response.status_code != record["status"]:
+            mismatches[key] += 1
+
+    tasks = []
+    first_ts = records[0]["ts"] if records else 0
+    start = time.perf_counter()
+    for record in records:
+        if record.get("body_truncated"):
+            errors["skipped, body truncated"] += 1
+            continue
+        if speed:
+            delay = (record["ts"] - first_ts) / speed - (time.perf_counter() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await slots.acquire()
+        tasks.append(asyncio.create_task(send(record)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "requests": sum(len(values) for values in latencies.values()),
+        "elapsed_seconds": elapsed,
+        "speed": speed,
+        "concurrency": concurrency,
+        "routes": {
+            key: {
+                "requests": len(values),
+                "mean_ms": statistics.fmean(values),
+                **percentiles(values),
+                "statuses": dict(statuses[key]),
+                "status_mismatches": mismatches[key],
+            }
+            for key, values in sorted(latencies.items())
+        },
+        "errors": dict(errors),
+    }
+
+
+def compare(a: dict, b: dict) -> List[str]:
+    # one line per route: percentiles of both runs and the relative change
+    lines = [
+        f"{'route':<40}"
+        + "".join(f"{f'p{p} a':>10}{f'p{p} b':>10}{'change':>9}" for p in PERCENTILES)
+    ]
+    for key in sorted(set(a["routes"]) | set(b["routes"])):
+        route_a, route_b = a["routes"].get(key), b["routes"].get(key)
+        if route_a is None or route_b is None:
+            lines.append(f"{key:<40}only in {'b' if route_a is None else 'a'}")
+            continue
+        line = f"{key:<40}"
+        for p in PERCENTILES:
+            value_a, value_b = route_a[f"p{p}"], route_b[f"p{p}"]
+            change = value_b / value_a - 1 if value_a else 0.0
+            line += f"{value_a:>10.2f}{value_b:>10.2f}{change:>+9.1%}"
+        lines.append(line)
+    return lines
+
+
+async def run(args):
+    records = load_capture(args.capture)
+    async with httpx.AsyncClient(
+        base_url=args.target,
+        timeout=args.timeout,
+        limits=httpx.Limits(max_connections=args.concurrency),
+    ) as client:
+        return await replay(client, records, args.speed, args.concurrency)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="replay a capture")
+    run_parser.add_argument("capture", nargs="+", help="capture files")
+    run_parser.add_argument("--target", default="http://localhost:8000")
+    run_parser.add_argument(
+        "--speed", type=float, default=1.0, help="1 as captured, 0 as fast as possible"
+    )
+    run_parser.add_argument("--concurrency", type=int, default=50)
+    run_parser.add_argument("--timeout", type=float, default=30)
+    run_parser.add_argument("--output", help="JSON file for the results")
+
+    compare_parser = commands.add_parser("compare", help="compare two replays")
+    compare_parser.add_argument("a")
+    compare_parser.add_argument("b")
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        results = asyncio.run(run(args))
+        if args.output:
+            with open(args.output, "w") as file:
+                json.dump(results, file, indent=2)
+        print(json.dumps(results["routes"], indent=2))
+        return 0
+
+    with open(args.a) as file:
+        a = json.load(file)
+    with open(args.b) as file:
+        b = json.load(file)
+    print("\n".join(compare(a, b)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,299 @@
+"""
+Locust workloads against a dataset seeded by tests/perf/seed_data.py:
+
+    HierarchicalToggleUser  toggles parents, large families included
+    PollingUser             polls the feature list (ETag) and the changes feed
+    MixedUser               reads and writes at READ_WRITE_RATIO (reads:writes)
+
+Load shapes, picked with LOAD_SHAPE:
+
+    step   STEP_USERS more users every STEP_SECONDS, up to MAX_USERS
+    spike  BASE_USERS, SPIKE_USERS for SPIKE_SECONDS every SPIKE_EVERY_SECONDS
+
+Results are written to LOAD_RESULTS_FILE (JSON) at the end: percentiles per
+request, and the current percentiles at the end of every stage of the shape.
+
+    cd backend
+    python -m tests.perf.seed_data --flags 50000 --manifest dataset.json
+    LOAD_DATASET=dataset.json LOAD_SHAPE=step \\
+        locust -f tests/perf/workloads.py --headless --host http://localhost:8000 \\
+        HierarchicalToggleUser PollingUser MixedUser
+"""
+
+import json
+import os
+import random
+import time
+import uuid
+
+from locust import (HttpUser, LoadTestShape, between, constant_pacing, events,
+                    task)
+
+LOAD_DATASET = os.getenv("LOAD_DATASET", "dataset.json")
+LOAD_RESULTS_FILE = os.getenv("LOAD_RESULTS_FILE", "load_results.json")
+LOAD_SHAPE = os.getenv("LOAD_SHAPE", "")
+READ_WRITE_RATIO = os.getenv("READ_WRITE_RATIO", "9:1")
+POLL_INTERVAL_SECONDS = float(os.getenv("POLL_INTERVAL_SECONDS", 5))
+
+STEP_USERS = int(os.getenv("STEP_USERS", 10))
+STEP_SECONDS = int(os.getenv("STEP_SECONDS", 60))
+MAX_USERS = int(os.getenv("MAX_USERS", 200))
+BASE_USERS = int(os.getenv("BASE_USERS", 20))
+SPIKE_USERS = int(os.getenv("SPIKE_USERS", 200))
+SPIKE_SECONDS = int(os.getenv("SPIKE_SECONDS", 30))
+SPIKE_EVERY_SECONDS = int(os.getenv("SPIKE_EVERY_SECONDS", 180))
+SPAWN_RATE = float(os.getenv("SPAWN_RATE", 10))
+RUN_SECONDS = int(os.getenv("RUN_SECONDS", 900))
+
+PERCENTILES = (0.5, 0.75, 0.9, 0.95, 0.99, 0.999)
+
+_dataset = None
+
+
+def dataset() -> dict:
+    # the manifest written by seed_data, loaded once per process
+    global _dataset
+    if _dataset is None:
+        with open(LOAD_DATASET) as file:
+            _dataset = json.load(file)
+    return _dataset
+
+
+def read_write_weights():
+    reads, writes = (int(part) for part in READ_WRITE_RATIO.split(":"))
+    return reads, writes
+
+
+def toggle(client, flag: dict, name: str):
+    # PUT replaces the whole flag, so the name as typed and the parent are sent
+    # unchanged
+    return client.put(
+        f"/api/v1/features/{flag['id']}",
+        json={
+            "name": flag["display_name"],
+            "is_enabled": random.random() < 0.5,
+            "parent_id": flag.get("parent_id"),
+        },
+        name=name,
+    )
+
+
+class HierarchicalToggleUser(HttpUser):
+    # toggling a parent rewrites all of its children in the same statement
+    wait_time = between(1, 3)
+
+    @task(1)
+    def toggle_large_parent(self):
+        if dataset()["large_parents"]:
+            toggle(
+                self.client,
+                random.choice(dataset()["large_parents"]),
+                "Toggle large parent",
+            )
+
+    @task(5)
+    def toggle_parent(self):
+        if dataset()["parents"]:
+            toggle(self.client, random.choice(dataset()["parents"]), "Toggle parent")
+
+    @task(5)
+    def toggle_child(self):
+        if dataset()["leaves"]:
+            toggle(self.client, random.choice(dataset()["leaves"]), "Toggle child")
+
+
+class PollingUser(HttpUser):
+    # a client keeping its copy of the flags in sync, every POLL_INTERVAL_SECONDS
+    wait_time = constant_pacing(POLL_INTERVAL_SECONDS)
+
+    def on_start(self):
+        self.etag = None
+        self.version = None
+
+    @task(1)
+    def poll_all_features(self):
+        headers = {"If-None-Match": self.etag} if self.etag else {}
+        with self.client.get(
+            "/api/v1/features",
+            headers=headers,
+            name="Poll all features",
+            catch_response=True,
+        ) as response:
+            if response.status_code in (200, 304):
+                self.etag = response.headers.get("ETag", self.etag)
+                response.success()
+        # the ETag is the flag set version, where the changes feed starts
+        if self.version is None and self.etag:
+            self.version = int(self.etag.strip('"'))
+
+    @task(1)
+    def poll_changes(self):
+        if self.version is None:
+            return
+        response = self.client.get(
+            f"/api/v1/features/changes?since={self.version}", name="Get changes"
+        )
+        if response.status_code == 200:
+            self.version = response.json()["version"]
+
+
+class MixedUser(HttpUser):
+    # reads and writes at READ_WRITE_RATIO
+    wait_time = between(0.5, 2)
+
+    def read(self):
+        choice = random.random()
+        if choice < 0.4:
+            flag = random.choice(dataset()["leaves"] or dataset()["standalone"])
+            self.client.get(f"/api/v1/features/{flag['id']}", name="Get feature")
+        elif choice < 0.7:
+            names = [
+                flag["name"]
+                for flag in random.sample(
+                    dataset()["leaves"], min(50, len(dataset()["leaves"]))
+                )
+            ]
+            self.client.post(
+                "/api/v1/features/evaluate",
+                json={"names": names},
+                name="Evaluate features",
+            )
+        elif choice < 0.9:
+            self.client.get("/api/v1/features?limit=100", name="Get features page")
+        else:
+            self.client.get("/api/v1/features", name="Get all features")
+
+    def write(self):
+        if random.random() < 0.8:
+            toggle(
+                self.client,
+                random.choice(dataset()["leaves"] or dataset()["standalone"]),
+                "Toggle flag",
+            )
+            return
+        response = self.client.post(
+            "/api/v1/features/",
+            json={"name": f"mixed_{uuid.uuid4().hex[:12]}", "is_enabled": True},
+            name="Create feature",
+        )
+        if response.status_code == 200:
+            self.client.delete(
+                f"/api/v1/features/{response.json()['id']}", name="Delete feature"
+            )
+
+    tasks = dict(zip((read, write), read_write_weights()))
+
+
+class StepLoadShape(LoadTestShape):
+    # picked up by locust only when LOAD_SHAPE=step
+    abstract = LOAD_SHAPE != "step"
+
+    def __init__(self):
+        super().__init__()
+        self.step = -1
+        self.users = 0
+
+    def tick(self):
+        run_time = self.get_run_time()
+        if run_time > RUN_SECONDS:
+            return None
+        step = int(run_time // STEP_SECONDS)
+        users = min(MAX_USERS, (step + 1) * STEP_USERS)
+        if step != self.step:
+            self.record()
+            self.step, self.users = step, users
+        return users, SPAWN_RATE
+
+    def record(self):
+        if self.step >= 0:
+            record_stage(self.runner, f"step {self.step}", self.users)
+
+
+class SpikeLoadShape(LoadTestShape):
+    # picked up by locust only when LOAD_SHAPE=spike
+    abstract = LOAD_SHAPE != "spike"
+
+    def __init__(self):
+        super().__init__()
+        self.spiking = None
+
+    def tick(self):
+        run_time = self.get_run_time()
+        if run_time > RUN_SECONDS:
+            return None
+        spiking = run_time % SPIKE_EVERY_SECONDS >= SPIKE_EVERY_SECONDS - SPIKE_SECONDS
+        if spiking != self.spiking:
+            self.record()
+            self.spiking = spiking
+        # spikes arrive all at once
+        if spiking:
+            return SPIKE_USERS, max(SPAWN_RATE, SPIKE_USERS)
+        return BASE_USERS, SPAWN_RATE
+
+    def record(self):
+        if self.spiking is not None:
+            record_stage(
+                self.runner,
+                "spike" if self.spiking else "base",
+                SPIKE_USERS if self.spiking else BASE_USERS,
+            )
+
+
+stages = []
+
+
+def percentiles(entry, current=False) -> dict:
+    get = (
+        entry.get_current_response_time_percentile
+        if current
+        else entry.get_response_time_percentile
+    )
+    return {f"p{percentile * 100:g}": get(percentile) for percentile in PERCENTILES}
+
+
+def record_stage(runner, stage: str, users: int):
+    # response times of the last seconds, i.e. at the end of the stage
+    total = runner.stats.total
+    stages.append(
+        {
+            "stage": stage,
+            "users": users,
+            "time": time.time(),
+            "rps": total.current_rps,
+            "fail_ratio": total.fail_ratio,
+            **percentiles(total, current=True),
+        }
+    )
+
+
+@events.quitting.add_listener
+def export_results(environment, **kwargs):
+    # the stage running when the test ended
+    if environment.shape_class is not None:
+        environment.shape_class.record()
+    stats = environment.stats
+    requests = [
+        {
+            "name": entry.name,
+            "method": entry.method,
+            "requests": entry.num_requests,
+            "failures": entry.num_failures,
+            "rps": entry.total_rps,
+            "avg_ms": entry.avg_response_time,
+            "max_ms": entry.max_response_time,
+            **percentiles(entry),
+        }
+        for entry in [*stats.entries.values(), stats.total]
+    ]
+    with open(LOAD_RESULTS_FILE, "w") as file:
+        json.dump(
+            {
+                "shape": LOAD_SHAPE or None,
+                "read_write_ratio": READ_WRITE_RATIO,
+                "dataset": {key: dataset()[key] for key in ("prefix", "plan", "flags")},
+                "requests": requests,
+                "stages": stages,
+            },
+            file,
+            indent=2,
+        )
@@ -0,0 +1,78 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from app.services.audit import AuditLog, audit_event
+
+
+def session_factory(db):
+    # async context manager yielding `db`, like AsyncSessionLocal
+    factory = MagicMock()
+    factory.return_value.__aenter__ = AsyncMock(return_value=db)
+    factory.return_value.__aexit__ = AsyncMock(return_value=False)
+    return factory
+
+
+class TestAuditLog:
+    @pytest.fixture(autouse=True)
+    def setup_method(self, monkeypatch):
+        self.insert = AsyncMock()
+        monkeypatch.setattr("app.services.audit.insert_audit_events", self.insert)
+        self.db = AsyncMock()
+
+    def audit_log(self, **kwargs):
+        return AuditLog(session_factory(self.db), enabled=True, **kwargs)
+
+    def test_full_queue_drops_events(self):
+        audit_log = self.audit_log(queue_size=2)
+        audit_log.record(*(audit_event(i, "update") for i in range(3)))
+        assert audit_log.stats()["queued"] == 2
+        assert audit_log.stats()["dropped"] == 1
+
+    def test_disabled(self):
+        audit_log = AuditLog(enabled=False)
+        audit_log.record(audit_event(1, "create"))
+        assert audit_log.stats()["queued"] == 0
+
+    @pytest.mark.asyncio
+    async def test_flush_writes_one_batch(self):
+        audit_log = self.audit_log(batch_size=2)
+        events = [audit_event(i, "update") for i in range(3)]
+        audit_log.record(*events)
+
+        assert await audit_log.flush() is True
+        self.insert.assert_awaited_once_with(self.db, events[:2])
+        self.db.commit.assert_awaited_once()
+        assert audit_log.stats()["queued"] == 1
+        assert audit_log.stats()["written"] == 2
+
+    @pytest.mark.asyncio
+    async def test_failed_flush_requeued_in_order(self):
+        audit_log = self.audit_log(batch_size=2)
+        events = [audit_event(i, "update") for i in range(3)]
+        audit_log.record(*events)
+        self.insert.side_effect = OSError()
+
+        assert await audit_log.flush() is False
+        assert list(audit_log.queue) == events
+        assert audit_log.stats()["failed_flushes"] == 1
+
+    @pytest.mark.asyncio
+    async def test_full_batch_flushed_before_interval(self):
+        audit_log = self.audit_log(batch_size=2, flush_seconds=60)
+        audit_log.start()
+        audit_log.record(audit_event(1, "update"), audit_event(2, "update"))
+        for _ in range(10):
+            await asyncio.sleep(0)
+        self.insert.assert_awaited_once()
+        await audit_log.stop()
+
+    @pytest.mark.asyncio
+    async def test_stop_drains_queue(self):
+        audit_log = self.audit_log(batch_size=2, flush_seconds=60)
+        audit_log.start()
+        audit_log.record(*(audit_event(i, "update") for i in range(3)))
+        await audit_log.stop()
+
+        assert audit_log.stats()["queued"] == 0
+        assert audit_log.stats()["written"] == 3
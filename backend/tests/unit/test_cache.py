@@ -0,0 +1,84 @@
+from app.services.cache import FeatureCache
+
+
+class TestFeatureCache:
+    def test_get_counts_hits_and_misses(self):
+        cache = FeatureCache(ttl_seconds=30)
+        assert cache.get("key") is None
+
+        cache.set("key", "value", cache.version)
+        assert cache.get("key") == "value"
+        assert cache.stats()["hits"] == 1
+        assert cache.stats()["misses"] == 1
+
+    def test_invalidate_drops_entries(self):
+        cache = FeatureCache(ttl_seconds=30)
+        cache.set("key", "value", cache.version)
+
+        cache.invalidate()
+        assert cache.peek("key") is None
+        assert cache.version == 1
+
+    def test_set_rejects_value_built_before_invalidation(self):
+        cache = FeatureCache(ttl_seconds=30)
+        version = cache.version
+        # a write happens while the value is being built
+        cache.invalidate()
+
+        assert cache.set("key", "stale", version) is False
+        assert cache.peek("key") is None
+
+    def test_set_rejects_value_older_than_applied_change(self):
+        cache = FeatureCache(ttl_seconds=30)
+        cache.apply_change([1], 5)
+
+        # read from a replica that hasn't replayed change 5 yet
+        assert cache.set("key", "stale", cache.version, 4) is False
+        assert cache.set("key", "fresh", cache.version, 5) is True
+
+    def test_expired_entry_is_a_miss(self, monkeypatch):
+        cache = FeatureCache(ttl_seconds=30)
+        monkeypatch.setattr("app.services.cache.time.monotonic", lambda: 100.0)
+        cache.set("key", "value", cache.version)
+
+        monkeypatch.setattr("app.services.cache.time.monotonic", lambda: 130.0)
+        assert cache.get("key") is None
+
+    def test_zero_ttl_disables_caching(self):
+        cache = FeatureCache(ttl_seconds=0)
+        assert cache.set("key", "value", cache.version) is False
+        assert cache.get("key") is None
+
+    def test_invalidate_feature_ids_keeps_other_features(self):
+        cache = FeatureCache(ttl_seconds=30)
+        cache.set("all_features", "tree", cache.version)
+        cache.set(1, "feature 1", cache.version)
+        cache.set(2, "feature 2", cache.version)
+
+        cache.invalidate([1])
+        assert cache.peek("all_features") is None
+        assert cache.peek(1) is None
+        assert cache.peek(2) == "feature 2"
+
+    def test_apply_change_tracks_latest_flag_set_version(self):
+        cache = FeatureCache(ttl_seconds=30)
+        cache.apply_change([1], 5)
+        cache.apply_change([2], 3)  # delivered late, must not go back
+        assert cache.flag_set_version == 5
+
+    def test_entry_keeps_flag_set_version_it_was_built_at(self):
+        cache = FeatureCache(ttl_seconds=30)
+        cache.set("key", "value", cache.version, 4)
+        cache.observe_flag_set_version(9)
+
+        assert cache.peek_flag_set_version("key") == 4
+        assert cache.flag_set_version == 9
+
+    def test_entry_older_than_min_flag_set_version_is_a_miss(self):
+        cache = FeatureCache(ttl_seconds=30)
+        cache.set("key", "value", cache.version, 4)
+
+        assert cache.get("key", min_flag_set_version=4) == "value"
+        assert cache.get("key", min_flag_set_version=5) is None
+        assert cache.peek_flag_set_version("key", min_flag_set_version=5) is None
+        assert cache.misses == 1
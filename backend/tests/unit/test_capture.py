@@ -0,0 +1,109 @@
+import json
+
+import httpx
+import pytest
+from app.utility.capture import CaptureMiddleware, CaptureWriter
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from tests.perf.replay import compare, load_capture, replay
+
+
+def capture_app(writer: CaptureWriter, **options) -> FastAPI:
+    app = FastAPI()
+
+    @app.post("/features/{feature_id}")
+    async def update(feature_id: int, feature: dict):
+        return {"id": feature_id, **feature}
+
+    app.add_middleware(CaptureMiddleware, writer=writer, **options)
+    return app
+
+
+def read_lines(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+class TestCaptureMiddleware:
+    def test_records_sampled_requests(self, tmp_path):
+        writer = CaptureWriter(str(tmp_path / "capture.jsonl"), flush_seconds=60)
+        client = TestClient(capture_app(writer, sample_rate=1.0))
+        client.post(
+            "/features/1?dry_run=true",
+            json={"name": "beta"},
+            headers={"Authorization": "secret"},
+        )
+        writer.shutdown()
+
+        (record,) = read_lines(tmp_path / "capture.jsonl")
+        assert record["method"] == "POST"
+        assert record["path"] == "/features/1"
+        assert record["route"] == "/features/{feature_id}"
+        assert record["query"] == "dry_run=true"
+        assert json.loads(record["body"]) == {"name": "beta"}
+        assert record["status"] == 200
+        assert "authorization" not in record["headers"]
+        assert record["headers"]["content-type"] == "application/json"
+
+    def test_not_sampled(self, tmp_path):
+        writer = CaptureWriter(str(tmp_path / "capture.jsonl"))
+        client = TestClient(capture_app(writer, sample_rate=0.0))
+        client.post("/features/1", json={"name": "beta"})
+        writer.shutdown()
+        assert not (tmp_path / "capture.jsonl").exists()
+
+    def test_body_truncated(self, tmp_path):
+        writer = CaptureWriter(str(tmp_path / "capture.jsonl"))
+        client = TestClient(capture_app(writer, sample_rate=1.0, max_body_bytes=5))
+        client.post("/features/1", json={"name": "beta"})
+        writer.shutdown()
+
+        (record,) = read_lines(tmp_path / "capture.jsonl")
+        assert record["body"] == '{"nam'
+        assert record["body_truncated"] is True
+
+
+class TestCaptureWriter:
+    def test_rotation(self, tmp_path):
+        path = tmp_path / "capture.jsonl"
+        writer = CaptureWriter(str(path), max_bytes=30, backup_count=2)
+        for i in range(4):
+            writer.write({"i": i, "padding": "x" * 10})
+            writer.flush()
+
+        assert read_lines(path) == [{"i": 3, "padding": "x" * 10}]
+        assert read_lines(tmp_path / "capture.jsonl.1")[0]["i"] == 2
+        assert read_lines(tmp_path / "capture.jsonl.2")[0]["i"] == 1
+        assert not (tmp_path / "capture.jsonl.3").exists()
+
+    def test_full_queue_drops(self, tmp_path):
+        writer = CaptureWriter(str(tmp_path / "capture.jsonl"), queue_size=1)
+        writer.queue.append({"i": 0})
+        writer.write({"i": 1})
+        assert writer.dropped == 1
+
+
+class TestReplay:
+    @pytest.mark.asyncio
+    async def test_replay_and_compare(self, tmp_path):
+        writer = CaptureWriter(str(tmp_path / "capture.jsonl"))
+        app = capture_app(writer, sample_rate=1.0)
+        client = TestClient(app)
+        client.post("/features/1", json={"name": "beta"})
+        client.post("/features/x", json={"name": "beta"})
+        writer.shutdown()
+        records = load_capture([str(tmp_path / "capture.jsonl")])
+
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app), base_url="http://test"
+        ) as replay_client:
+            results = await replay(replay_client, records, speed=0, concurrency=2)
+
+        route = results["routes"]["POST /features/{feature_id}"]
+        assert route["requests"] == 2
+        assert route["statuses"] == {200: 1, 422: 1}
+        # same responses as captured
+        assert route["status_mismatches"] == 0
+
+        lines = compare(results, results)
+        assert lines[1].startswith("POST /features/{feature_id}")
+        assert "+0.0%" in lines[1]
@@ -1,29 +1,48 @@
+from datetime import datetime, timezone
+
 import pytest
-from app.database.models import FeatureFlag
-from app.database.operations import (add_feature, delete_db_feature,
-                                     get_all_db_features, get_feature_by_id,
-                                     get_feature_by_name)
-from app.utility.exceptions import FeatureNotFoundException
-from sqlalchemy import text
+from app.database.models import FeatureFlag, FeatureFlagChange
+from app.database.operations import (delete_db_feature, get_all_db_features,
+                                     get_db_children, get_feature_usage_rows,
+                                     get_flag_set_version, insert_feature,
+                                     publish_feature_change,
+                                     update_children_status, update_db_feature,
+                                     upsert_feature_usage)
+from app.routers.v1.schemas import BatchOperation
+from app.services.feature_flag import apply_batch, integrity_error_exception
+from app.utility.exceptions import (DuplicateFeatureNameException,
+                                    FeatureNotFoundException,
+                                    SelfParentException)
+from sqlalchemy import select, text, update
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 
+# the SQL of every write is built once per call, warnings about it are bugs
+pytestmark = pytest.mark.filterwarnings("error::sqlalchemy.exc.SAWarning")
+
 
 @pytest.mark.asyncio
-async def test_get_feature_by_name_not_found(db_session: AsyncSession):
+async def test_get_all_db_features(db_session: AsyncSession):
     # Clear the database
     await db_session.execute(
         text("TRUNCATE TABLE feature_flags RESTART IDENTITY CASCADE")
     )
     await db_session.commit()
 
+    # Prepare test data
+    parent = FeatureFlag(name="parent", is_enabled=True)
+    child = FeatureFlag(name="child", is_enabled=True, parent=parent)
+    db_session.add_all([parent, child])
+    await db_session.commit()
+
     # Test
-    result = await get_feature_by_name(db_session, "nonexistent")
-    assert result is None
+    result = await get_all_db_features(db_session)
+    assert len(result) == 1  # Only parent returned
+    assert len(result[0].children) == 1
 
 
 @pytest.mark.asyncio
-async def test_get_feature_by_id_with_children(db_session: AsyncSession):
+async def test_delete_db_feature(db_session: AsyncSession):
     # Clear the database
     await db_session.execute(
         text("TRUNCATE TABLE feature_flags RESTART IDENTITY CASCADE")
@@ -32,76 +51,410 @@ async def test_get_feature_by_id_with_children(db_session: AsyncSession):
 
     # Prepare test data
     parent = FeatureFlag(id=1, name="parent", is_enabled=True)
-    child = FeatureFlag(id=2, name="child", is_enabled=True, parent_id=1)
+    child = FeatureFlag(id=2, name="child", is_enabled=True, parent=parent)
     db_session.add_all([parent, child])
     await db_session.commit()
 
     # Test
-    result = await get_feature_by_id(db_session, 1, with_children=True)
-    assert len(result.children) == 1
+    with pytest.raises(FeatureNotFoundException):
+        await delete_db_feature(db_session, feature_id=3)  # id=3 feature doesn't exists
 
+    with pytest.raises(IntegrityError):
+        await delete_db_feature(
+            db_session, feature_id=1
+        )  # id=1 is a parent, hence can't delete
 
-@pytest.mark.asyncio
-async def test_add_feature(db_session: AsyncSession):
-    # Clear the database
+    await delete_db_feature(db_session, feature_id=2)  # id=2 can be deleted safely
+    await delete_db_feature(
+        db_session, feature_id=1
+    )  # now id=1 is no more parent since id=2 is deleted
+
+
+async def clear_features(db_session: AsyncSession):
+    # features, the flag set version and the change log
     await db_session.execute(
-        text("TRUNCATE TABLE feature_flags RESTART IDENTITY CASCADE")
+        text(
+            "TRUNCATE TABLE feature_flags, feature_flag_state, feature_flag_changes "
+            "RESTART IDENTITY CASCADE"
+        )
     )
     await db_session.commit()
 
-    # Prepare test data
-    feature = FeatureFlag(name="test", is_enabled=True)
-    await add_feature(db_session, feature)
 
-    # Verify
-    result = await get_feature_by_id(db_session, feature.id)
-    assert result.name == "test"
+async def change_log(db_session: AsyncSession):
+    result = await db_session.execute(
+        select(FeatureFlagChange.version, FeatureFlagChange.feature_id).order_by(
+            FeatureFlagChange.version, FeatureFlagChange.feature_id
+        )
+    )
+    return [tuple(row) for row in result.all()]
 
 
-@pytest.mark.asyncio
-async def test_get_all_db_features(db_session: AsyncSession):
-    # Clear the database
+async def feature_statuses(db_session: AsyncSession):
+    result = await db_session.execute(
+        select(FeatureFlag.id, FeatureFlag.is_enabled).order_by(FeatureFlag.id)
+    )
+    return dict(result.all())
+
+
+async def insert_family(db_session: AsyncSession, children: int, is_enabled=True):
+    # a parent (id 1) and its children (ids 2...), committed
+    db_session.add(FeatureFlag(id=1, name="parent", is_enabled=is_enabled))
+    db_session.add_all(
+        FeatureFlag(
+            id=index + 2,
+            name=f"child_{index}",
+            is_enabled=is_enabled,
+            parent_id=1,
+        )
+        for index in range(children)
+    )
+    await db_session.flush()
+    # the ids were given, new features are numbered after them
     await db_session.execute(
-        text("TRUNCATE TABLE feature_flags RESTART IDENTITY CASCADE")
+        text(
+            "SELECT setval('feature_flags_id_seq', (SELECT max(id) FROM feature_flags))"
+        )
     )
     await db_session.commit()
 
-    # Prepare test data
-    parent = FeatureFlag(name="parent", is_enabled=True)
-    child = FeatureFlag(name="child", is_enabled=True, parent=parent)
-    db_session.add_all([parent, child])
+
+@pytest.mark.asyncio
+async def test_insert_feature_publishes_change(db_session: AsyncSession):
+    await clear_features(db_session)
+    await insert_family(db_session, children=0)
+
+    written = await insert_feature(db_session, "child", "Child", True, 1)
+    assert (written.name, written.display_name, written.parent_id) == (
+        "child",
+        "Child",
+        1,
+    )
+    # the new feature and its parent changed, in one version
+    assert (written.version, written.ids) == (1, sorted([1, written.id]))
+    assert await get_flag_set_version(db_session) == 1
+    assert await change_log(db_session) == [(1, 1), (1, written.id)]
+
+
+@pytest.mark.asyncio
+async def test_insert_feature_missing_parent(db_session: AsyncSession):
+    await clear_features(db_session)
+
+    written = await insert_feature(db_session, "orphan", "Orphan", True, 42)
+    assert written.id is None
+    assert (written.parent_found, written.parent_nested) == (False, False)
+    # nothing written, nothing published
+    assert written.version is None
+    assert await feature_statuses(db_session) == {}
+    assert await get_flag_set_version(db_session) == 0
+    assert await change_log(db_session) == []
+
+
+@pytest.mark.asyncio
+async def test_insert_feature_nested_parent(db_session: AsyncSession):
+    await clear_features(db_session)
+    await insert_family(db_session, children=1)
+
+    # feature 2 is a child itself
+    written = await insert_feature(db_session, "grandchild", "Grandchild", True, 2)
+    assert written.id is None
+    assert (written.parent_found, written.parent_nested) == (True, True)
+    assert written.version is None
+    assert sorted(await feature_statuses(db_session)) == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_insert_feature_duplicate_name(db_session: AsyncSession):
+    await clear_features(db_session)
+    await insert_family(db_session, children=0)
+
+    with pytest.raises(IntegrityError) as exc_info:
+        await insert_feature(db_session, "parent", "Parent", True, None)
+    await db_session.rollback()
+    assert isinstance(
+        integrity_error_exception(exc_info.value), DuplicateFeatureNameException
+    )
+    assert await get_flag_set_version(db_session) == 0
+
+
+@pytest.mark.asyncio
+async def test_update_db_feature_self_parent(db_session: AsyncSession):
+    await clear_features(db_session)
+    await insert_family(db_session, children=0)
+
+    with pytest.raises(IntegrityError) as exc_info:
+        await update_db_feature(db_session, 1, "parent", "Parent", True, 1)
+    await db_session.rollback()
+    assert isinstance(integrity_error_exception(exc_info.value), SelfParentException)
+
+
+@pytest.mark.asyncio
+async def test_update_db_feature_not_found(db_session: AsyncSession):
+    await clear_features(db_session)
+
+    written = await update_db_feature(db_session, 1, "missing", "Missing", True, None)
+    assert written.id is None
+    assert written.feature_found is False
+    assert written.version is None
+
+
+@pytest.mark.asyncio
+async def test_update_db_feature_missing_and_nested_parent(db_session: AsyncSession):
+    await clear_features(db_session)
+    await insert_family(db_session, children=1)
+    db_session.add(FeatureFlag(id=10, name="other", is_enabled=True))
     await db_session.commit()
 
-    # Test
-    result = await get_all_db_features(db_session)
-    assert len(result) == 1  # Only parent returned
-    assert len(result[0].children) == 1
+    written = await update_db_feature(db_session, 10, "other", "Other", True, 42)
+    assert written.id is None
+    assert (written.feature_found, written.parent_found) == (True, False)
+
+    # feature 2 is a child itself
+    written = await update_db_feature(db_session, 10, "other", "Other", True, 2)
+    assert written.id is None
+    assert (written.feature_found, written.parent_found, written.parent_nested) == (
+        True,
+        True,
+        True,
+    )
+    assert await get_flag_set_version(db_session) == 0
 
 
 @pytest.mark.asyncio
-async def test_delete_db_feature(db_session: AsyncSession):
-    # Clear the database
+async def test_update_db_feature_parent_with_children(db_session: AsyncSession):
+    await clear_features(db_session)
+    await insert_family(db_session, children=1)
+    db_session.add(FeatureFlag(id=10, name="other", is_enabled=True))
+    await db_session.commit()
+
+    # feature 1 has children, it can't become a child
+    written = await update_db_feature(db_session, 1, "parent", "Parent", True, 10)
+    assert written.id is None
+    assert (written.feature_found, written.has_children) == (True, True)
+    assert (written.parent_found, written.parent_nested) == (True, False)
+    assert await get_flag_set_version(db_session) == 0
+
+
+@pytest.mark.asyncio
+async def test_update_db_feature_new_parent(db_session: AsyncSession):
+    await clear_features(db_session)
+    await insert_family(db_session, children=1)
+    db_session.add(FeatureFlag(id=10, name="other", is_enabled=True))
+    await db_session.commit()
+
+    # child 2 moves from parent 1 to 10, both parents changed too
+    written = await update_db_feature(db_session, 2, "child_0", "Child 0", True, 10)
+    assert (written.id, written.parent_id) == (2, 10)
+    assert written.ids == [1, 2, 10]
+    assert await change_log(db_session) == [(1, 1), (1, 2), (1, 10)]
+
+
+@pytest.mark.asyncio
+async def test_update_db_feature_children_follow_status(db_session: AsyncSession):
+    await clear_features(db_session)
+    await insert_family(db_session, children=2)
+
+    written = await update_db_feature(db_session, 1, "parent", "Parent", False, None)
+    assert (written.is_enabled, written.old_is_enabled) == (False, True)
+    assert [child["is_enabled"] for child in written.children] == [False, False]
+    assert written.ids == [1, 2, 3]
+    assert await feature_statuses(db_session) == {1: False, 2: False, 3: False}
+
+    # renamed only, the children are left alone
+    written = await update_db_feature(db_session, 1, "renamed", "Renamed", False, None)
+    assert written.ids == [1]
+    assert await change_log(db_session) == [(1, 1), (1, 2), (1, 3), (2, 1)]
+
+
+@pytest.mark.asyncio
+async def test_update_children_status_in_chunks(db_session: AsyncSession):
+    await clear_features(db_session)
+    await insert_family(db_session, children=5)
+
+    written = await update_db_feature(
+        db_session, 1, "parent", "Parent", False, None, children_limit=2
+    )
+    # only 2 children are written yet, and returned
+    assert [(child["id"], child["is_enabled"]) for child in written.children] == [
+        (2, False),
+        (3, False),
+    ]
+    assert [child["id"] for child in written.changed_children] == [2, 3]
+    assert written.ids == [1, 2, 3]
+    assert await feature_statuses(db_session) == {
+        1: False,
+        2: False,
+        3: False,
+        4: True,
+        5: True,
+        6: True,
+    }
+
+    chunks = []
+    while (chunk := await update_children_status(db_session, 1, False, 2)) is not None:
+        chunks.append(chunk)
+    assert [(change["version"], change["ids"]) for change, _ in chunks] == [
+        (2, [4, 5]),
+        (3, [6]),
+    ]
+    assert [
+        (child["id"], child["old_is_enabled"], child["is_enabled"])
+        for _, children in chunks
+        for child in children
+    ] == [(4, True, False), (5, True, False), (6, True, False)]
+    assert set((await feature_statuses(db_session)).values()) == {False}
+    assert await get_flag_set_version(db_session) == 3
+
+
+@pytest.mark.asyncio
+async def test_publish_feature_change_compacts_change_log(
+    db_session: AsyncSession, monkeypatch
+):
+    await clear_features(db_session)
+    monkeypatch.setattr("app.database.operations.FEATURE_CHANGE_LOG_RETENTION", 2)
+
+    # nulls and duplicates are ignored, no ids publish nothing
+    assert await publish_feature_change(db_session, []) is None
+    first = await publish_feature_change(db_session, [3, None, 1, 3])
+    assert (first["version"], first["ids"]) == (1, [1, 3])
+    await publish_feature_change(db_session, [2])
+    await publish_feature_change(db_session, [4])
+
+    # version 1 is older than the last 2, it was compacted away
+    assert await get_flag_set_version(db_session) == 3
+    assert await change_log(db_session) == [(2, 2), (3, 4)]
+
+
+@pytest.mark.asyncio
+async def test_update_db_feature_returns_changed_children(db_session: AsyncSession):
+    await clear_features(db_session)
+    await insert_family(db_session, children=2)
+    # child 3 is already off
+    await db_session.execute(
+        update(FeatureFlag).filter(FeatureFlag.id == 3).values(is_enabled=False)
+    )
+    await db_session.commit()
+
+    written = await update_db_feature(db_session, 1, "parent", "Parent", False, None)
+    assert [
+        (child["id"], child["old_is_enabled"], child["is_enabled"])
+        for child in written.changed_children
+    ] == [(2, True, False)]
+    assert [(child["id"], child["is_enabled"]) for child in written.children] == [
+        (2, False),
+        (3, False),
+    ]
+    assert written.ids == [1, 2]
+
+
+async def usage(db_session: AsyncSession):
+    # name -> evaluations of every feature
+    rows = await get_feature_usage_rows(db_session)
+    return {row.name: row.evaluations for row in rows}
+
+
+@pytest.mark.asyncio
+async def test_usage_follows_feature_id(db_session: AsyncSession):
     await db_session.execute(
         text("TRUNCATE TABLE feature_flags RESTART IDENTITY CASCADE")
     )
+    await insert_feature(db_session, "parent", None, True, None)
+    await insert_feature(db_session, "child", None, True, 1)
     await db_session.commit()
+    at = datetime(2024, 1, 1, tzinfo=timezone.utc)
 
-    # Prepare test data
-    parent = FeatureFlag(id=1, name="parent", is_enabled=True)
-    child = FeatureFlag(id=2, name="child", is_enabled=True, parent=parent)
-    db_session.add_all([parent, child])
+    # feature 3 doesn't exist, e.g. deleted since it was counted
+    await upsert_feature_usage(db_session, [1, 2, 3], [5, 1, 7], [at, at, at])
+    await upsert_feature_usage(db_session, [2], [2], [at])
     await db_session.commit()
+    assert await usage(db_session) == {"parent": 5, "child": 3}
 
-    # Test
-    with pytest.raises(FeatureNotFoundException):
-        await delete_db_feature(db_session, feature_id=3)  # id=3 feature doesn't exists
+    # kept through a rename
+    await update_db_feature(db_session, 2, "renamed", None, True, 1)
+    await db_session.commit()
+    assert await usage(db_session) == {"parent": 5, "renamed": 3}
 
-    with pytest.raises(IntegrityError):
-        await delete_db_feature(
-            db_session, feature_id=1
-        )  # id=1 is a parent, hence can't delete
+    # dropped with the feature, a new one of the same name starts from zero
+    await delete_db_feature(db_session, feature_id=2)
+    await insert_feature(db_session, "renamed", None, True, 1)
+    await db_session.commit()
+    assert await usage(db_session) == {"parent": 5, "renamed": 0}
 
-    await delete_db_feature(db_session, feature_id=2)  # id=2 can be deleted safely
-    await delete_db_feature(
-        db_session, feature_id=1
-    )  # now id=1 is no more parent since id=2 is deleted
+
+async def features(db_session: AsyncSession):
+    # id -> (name, parent_id) of every feature
+    result = await db_session.execute(
+        select(FeatureFlag.id, FeatureFlag.name, FeatureFlag.parent_id)
+    )
+    return {row.id: (row.name, row.parent_id) for row in result.all()}
+
+
+@pytest.mark.asyncio
+async def test_apply_batch_written_in_request_order(db_session: AsyncSession):
+    await clear_features(db_session)
+    await insert_family(db_session, children=2)
+    await insert_feature(db_session, "x", None, True, None)
+    await insert_feature(db_session, "y", None, True, None)
+    await db_session.commit()
+
+    await apply_batch(
+        db_session,
+        [
+            # a rename chain, each name freed just before it is taken
+            BatchOperation(op="update", id=5, name="w", is_enabled=True),
+            BatchOperation(op="update", id=4, name="y", is_enabled=True),
+            # the parent can get one of its own once its children are gone
+            BatchOperation(op="delete", id=2),
+            BatchOperation(op="delete", id=3),
+            BatchOperation(
+                op="update", id=1, name="parent", is_enabled=True, parent_id=4
+            ),
+            # and a child deleted after its parent
+            BatchOperation(op="create", name="z", is_enabled=True, ref="z"),
+            BatchOperation(
+                op="create", name="z_child", is_enabled=True, parent_ref="z"
+            ),
+        ],
+    )
+    created = await db_session.execute(
+        select(FeatureFlag.id).filter(FeatureFlag.name.in_(["z", "z_child"]))
+    )
+    z, z_child = sorted(created.scalars().all())
+    assert await features(db_session) == {
+        1: ("parent", 4),
+        4: ("y", None),
+        5: ("w", None),
+        z: ("z", None),
+        z_child: ("z_child", z),
+    }
+
+    await apply_batch(
+        db_session,
+        [
+            BatchOperation(op="delete", id=z),
+            BatchOperation(op="update", id=5, name="z", is_enabled=True),
+            BatchOperation(op="delete", id=z_child),
+        ],
+    )
+    assert await features(db_session) == {
+        1: ("parent", 4),
+        4: ("y", None),
+        5: ("z", None),
+    }
+
+
+@pytest.mark.asyncio
+async def test_get_db_children_limited_per_parent(db_session: AsyncSession):
+    await clear_features(db_session)
+    await insert_family(db_session, children=3)
+    await insert_feature(db_session, "other", None, True, None)
+    await insert_feature(db_session, "other_child", None, True, 5)
+    await db_session.commit()
+
+    children = await get_db_children(db_session, [1, 5], limit=2)
+    assert [(child.parent_id, child.name) for child in children] == [
+        (1, "child_0"),
+        (1, "child_1"),
+        (5, "other_child"),
+    ]
+    assert len(await get_db_children(db_session, [1, 5])) == 4
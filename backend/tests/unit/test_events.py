@@ -0,0 +1,42 @@
+from app.services.events import RESYNC_FRAME, ChangeHub
+
+
+class TestChangeHub:
+    def test_publish_fans_out_same_frame(self):
+        hub = ChangeHub(queue_size=10)
+        first = hub.subscribe()
+        second = hub.subscribe()
+
+        hub.publish({"version": 3, "ids": [1, 2], "origin": "worker"})
+        frame = first.queue.get_nowait()
+        assert frame is second.queue.get_nowait()
+        assert frame == b'id: 3\nevent: change\ndata: {"version": 3, "ids": [1, 2]}\n\n'
+
+    def test_missed_changes_publish_resync(self):
+        hub = ChangeHub(queue_size=10)
+        subscription = hub.subscribe()
+
+        hub.publish(None)
+        assert subscription.queue.get_nowait() == RESYNC_FRAME
+
+    def test_slow_subscriber_is_dropped(self):
+        hub = ChangeHub(queue_size=1)
+        slow = hub.subscribe()
+        fast = hub.subscribe()
+
+        hub.publish({"version": 1, "ids": [1], "origin": "worker"})
+        fast.queue.get_nowait()
+        hub.publish({"version": 2, "ids": [1], "origin": "worker"})
+
+        assert slow.overflowed is True
+        assert slow not in hub.subscribers
+        assert fast.overflowed is False
+        assert hub.overflows == 1
+
+    def test_unsubscribe(self):
+        hub = ChangeHub(queue_size=1)
+        subscription = hub.subscribe()
+        hub.unsubscribe(subscription)
+
+        hub.publish({"version": 1, "ids": [1], "origin": "worker"})
+        assert subscription.queue.empty()
@@ -0,0 +1,81 @@
+from unittest.mock import AsyncMock
+
+import pytest
+from app.main import app
+from app.services import feature_flag as feature_flag_svc
+from app.utility.exceptions import FeatureNotFoundException
+from app.utility.metrics import Histogram, Metrics, default_metrics
+from fastapi.testclient import TestClient
+
+client = TestClient(app)
+
+
+class TestHistogram:
+    def test_observe(self):
+        histogram = Histogram(buckets=(0.1, 1.0))
+        histogram.observe(0.05)
+        histogram.observe(0.1)
+        histogram.observe(5.0)
+
+        # a value equal to a bound belongs to that bucket (le)
+        assert histogram.counts == [2, 0, 1]
+        assert histogram.count == 3
+        assert histogram.sum == pytest.approx(5.15)
+
+
+class TestMetrics:
+    def test_render(self):
+        metrics = Metrics()
+        metrics.route("GET", "/api/v1/features/{feature_id}").responses[404] = 2
+        metrics.observe_db_statement("SELECT 1", 0.002)
+        metrics.observe_db_statement("COMMIT", 0.001)
+        metrics.add_collector(lambda: [("cache_hit_ratio", "gauge", "Hit ratio.", 0.5)])
+
+        text = metrics.render()
+        assert (
+            'http_responses_total{method="GET",route="/api/v1/features/{feature_id}",'
+            'status="404"} 2' in text
+        )
+        assert 'db_statement_duration_seconds_count{operation="SELECT"} 1' in text
+        assert 'db_statement_duration_seconds_count{operation="OTHER"} 1' in text
+        assert "# TYPE cache_hit_ratio gauge\ncache_hit_ratio 0.5\n" in text
+
+
+class TestMetricsEndpoint:
+    @pytest.fixture(autouse=True)
+    def setup_method(self, mocker):
+        self.mock_get_feature_details = mocker.patch.object(
+            feature_flag_svc, "get_feature_details", new_callable=AsyncMock
+        )
+
+    def responses(self, status):
+        route_metrics = default_metrics.route("GET", "/api/v1/features/{feature_id}")
+        return route_metrics.responses.get(status, 0)
+
+    @pytest.mark.asyncio
+    async def test_mapped_exception_status_counted_by_route(self):
+        self.mock_get_feature_details.side_effect = FeatureNotFoundException()
+        before = self.responses(404)
+
+        client.get("/api/v1/features/1")
+        client.get("/api/v1/features/2")
+
+        assert self.responses(404) == before + 2
+        route_metrics = default_metrics.route("GET", "/api/v1/features/{feature_id}")
+        assert route_metrics.in_flight == 0
+
+    @pytest.mark.asyncio
+    async def test_unknown_paths_share_one_series(self):
+        client.get("/no/such/path/1")
+        client.get("/no/such/path/2")
+        assert ("GET", "/no/such/path/1") not in default_metrics.routes
+        assert default_metrics.route("GET", "unmatched").responses[404] >= 2
+
+    @pytest.mark.asyncio
+    async def test_get_metrics(self):
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        assert "# TYPE http_request_duration_seconds histogram" in response.text
+        assert "feature_cache_hit_ratio" in response.text
+        assert "db_pool_checked_out 0" in response.text
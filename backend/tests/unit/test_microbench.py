@@ -0,0 +1,32 @@
+import pytest
+from tests.conftest import TEST_DATABASE_URL
+from tests.perf.microbench import compare, run
+
+
+def results(**medians):
+    return {"results": {name: {"median_ms": ms} for name, ms in medians.items()}}
+
+
+class TestMicrobench:
+    @pytest.mark.asyncio
+    async def test_memory_backend(self):
+        # the in-memory stand-in keeps up with the service code
+        current = await run("memory", [100], runs=2)
+        assert current["backend"] == "memory"
+        assert "update_feature[100]" in current["results"]
+        assert current["results"]["get_all_features[100]"]["runs"] == 2
+
+    @pytest.mark.asyncio
+    async def test_postgres_backend(self, db_session, monkeypatch):
+        monkeypatch.setenv("DATABASE_URL", TEST_DATABASE_URL)
+        current = await run("postgres", [100], runs=1)
+        assert current["backend"] == "postgres"
+        assert current["results"]["update_feature[100]"]["runs"] == 1
+
+    def test_compare(self):
+        baseline = results(get_all_features=10.0, create_feature=1.0, noise=0.001)
+        current = results(
+            get_all_features=13.0, create_feature=1.1, noise=0.01, new_benchmark=5.0
+        )
+        regressions = compare(baseline, current, threshold=0.2)
+        assert [name for name, *_ in regressions] == ["get_all_features"]
@@ -0,0 +1,120 @@
+import asyncio
+import json
+import os
+import time
+from collections import Counter
+
+import pytest
+from app.utility.profiling import (ProfilingMiddleware, Sampler, build_profile,
+                                   phase_of, server_timing)
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+
+def profiled_client(tmp_path, **options) -> TestClient:
+    app = FastAPI()
+
+    @app.get("/slow")
+    def slow():
+        time.sleep(0.02)
+        return {"ok": True}
+
+    app.add_middleware(
+        ProfilingMiddleware, interval=0.001, profiles_dir=str(tmp_path), **options
+    )
+    return TestClient(app)
+
+
+class TestPhaseOf:
+    def test_innermost_phase_and_library(self):
+        stack = (
+            ("starlette.routing", "handle"),
+            ("app.services.feature_flag", "get_feature_details"),
+            ("app.database.operations", "get_feature_rows"),
+            ("sqlalchemy.engine.result", "all"),
+        )
+        assert phase_of(stack) == ("db.get_feature_rows", "sqlalchemy")
+
+    def test_own_code(self):
+        stack = (
+            ("app.services.feature_flag", "get_all_features"),
+            ("app.services.feature_flag", "assemble_feature_tree"),
+        )
+        assert phase_of(stack) == ("service.assemble_feature_tree", "python")
+
+    def test_idle_loop(self):
+        stack = (("asyncio.base_events", "_run_once"), ("selectors", "select"))
+        assert phase_of(stack) == ("other", "idle")
+
+
+class TestBuildProfile:
+    def test_phases_and_server_timing(self):
+        stacks = Counter(
+            {
+                (("app.database.operations", "get_feature_rows"),): 3,
+                (("app.services.feature_flag", "feature_from_row"),): 1,
+            }
+        )
+        profile = build_profile(stacks, 0.01, duration_seconds=0.05)
+
+        assert profile["samples"] == 4
+        assert profile["phases"][0] == {
+            "phase": "db.get_feature_rows",
+            "activity": "python",
+            "samples": 3,
+            "seconds": 0.03,
+        }
+        assert profile["stacks"][0] == "app.database.operations:get_feature_rows 3"
+        assert server_timing(profile) == (
+            "db.get_feature_rows;dur=30.0, service.feature_from_row;dur=10.0, "
+            "total;dur=50.0"
+        )
+
+
+class TestProfilingMiddleware:
+    def test_profile_on_secret_header(self, tmp_path):
+        client = profiled_client(tmp_path, secret="s3cret")
+        response = client.get("/slow", headers={"X-Profile": "s3cret"})
+
+        assert response.status_code == 200
+        assert "total;dur=" in response.headers["server-timing"]
+        with open(tmp_path / f"{response.headers['x-profile-id']}.json") as file:
+            profile = json.load(file)
+        assert profile["path"] == "/slow"
+        assert profile["status"] == 200
+        assert profile["samples"] > 0
+
+    @pytest.mark.parametrize("headers", [{}, {"X-Profile": "wrong"}])
+    def test_not_profiled(self, tmp_path, headers):
+        client = profiled_client(tmp_path, secret="s3cret")
+        response = client.get("/slow", headers=headers)
+
+        assert "x-profile-id" not in response.headers
+        assert os.listdir(tmp_path) == []
+
+    def test_sampled_without_headers(self, tmp_path):
+        client = profiled_client(tmp_path, sample_rate=1.0)
+        response = client.get("/slow")
+
+        # sampled profiles are only kept, not announced to the client
+        assert "x-profile-id" not in response.headers
+        assert len(os.listdir(tmp_path)) == 1
+
+    def test_sampler_joined_off_the_event_loop(self, tmp_path, monkeypatch):
+        joined_on_loop = []
+        join = Sampler.join
+
+        def recording_join(sampler, *args):
+            try:
+                asyncio.get_running_loop()
+                joined_on_loop.append(True)
+            except RuntimeError:
+                joined_on_loop.append(False)
+            join(sampler, *args)
+
+        monkeypatch.setattr(Sampler, "join", recording_join)
+        client = profiled_client(tmp_path, secret="s3cret")
+        response = client.get("/slow", headers={"X-Profile": "s3cret"})
+
+        assert response.status_code == 200
+        assert joined_on_loop == [False]
@@ -1,11 +1,19 @@
-from unittest.mock import AsyncMock
+from unittest.mock import ANY, AsyncMock
 
 import pytest
 from app.main import app  # Assuming your FastAPI app is initialized in main.py
-from app.routers.v1.schemas import AllFeaturesList, Feature, FeatureCreate
+from app.routers.v1.schemas import (AllFeaturesList, BatchItemResult,
+                                    BatchResult, Feature, FeatureChanges,
+                                    FeatureCreate, FeatureHistory,
+                                    FeatureRules, FeatureUsage,
+                                    FeatureUsageList)
 from app.services import feature_flag as feature_flag_svc
-from app.utility.exceptions import (DuplicateFeatureNameException,
-                                    FeatureNotFoundException)
+from app.services.cache import feature_cache
+from app.services.usage import evaluation_usage
+from app.utility.exceptions import (BatchValidationException,
+                                    DuplicateFeatureNameException,
+                                    FeatureNotFoundException,
+                                    InvalidCursorException)
 from fastapi.testclient import TestClient
 
 # Test client
@@ -28,6 +36,10 @@ class TestCreateFeature:
         response = client.post("/api/v1/features/", json=feature_data.model_dump())
         assert response.status_code == 200
         assert response.json()["name"] == "TestFeature"
+        # for the client to read its own write from replicas
+        assert response.headers["X-Flag-Set-Version"] == str(
+            feature_cache.flag_set_version
+        )
 
     @pytest.mark.asyncio
     async def test_create_feature_duplicate_name(self):
@@ -62,6 +74,32 @@ class TestGetFeatureDetails:
         assert response.status_code == 404
         assert response.json()["detail"] == "Feature not found"
 
+    @pytest.mark.asyncio
+    async def test_get_feature_not_modified(self, mocker):
+        feature = Feature(id=1, name="TestFeature", is_enabled=True, children=[])
+        feature_cache.set(1, feature, feature_cache.version, 3)
+
+        count = mocker.patch.object(evaluation_usage, "count")
+        response = client.get("/api/v1/features/1", headers={"If-None-Match": 'W/"3"'})
+        assert response.status_code == 304
+        self.mock_get_feature_details.assert_not_awaited()
+        # counted as used all the same
+        count.assert_called_once_with([1])
+
+    @pytest.mark.asyncio
+    async def test_get_feature_cached_before_client_write(self):
+        feature = Feature(id=1, name="TestFeature", is_enabled=True, children=[])
+        feature_cache.set(1, feature, feature_cache.version, 3)
+        self.mock_get_feature_details.return_value = feature
+
+        # the client wrote version 4, the cached ETag is older
+        response = client.get(
+            "/api/v1/features/1",
+            headers={"If-None-Match": '"3"', "X-Min-Flag-Set-Version": "4"},
+        )
+        assert response.status_code == 200
+        self.mock_get_feature_details.assert_awaited_once_with(ANY, 1, 4)
+
 
 class TestUpdateFeature:
     @pytest.fixture(autouse=True)
@@ -105,3 +143,389 @@ class TestGetAllFeatures:
         response = client.get("/api/v1/features")
         assert response.status_code == 200
         assert response.json()["features"] == []
+
+    @pytest.mark.asyncio
+    async def test_get_all_features_etag(self):
+        all_features = AllFeaturesList(features=[])
+        self.mock_get_all_features.return_value = all_features
+        feature_cache.set(
+            feature_flag_svc.ALL_FEATURES_CACHE_KEY,
+            all_features,
+            feature_cache.version,
+            7,
+        )
+
+        response = client.get("/api/v1/features")
+        assert response.status_code == 200
+        assert response.headers["ETag"] == '"7"'
+
+    @pytest.mark.asyncio
+    async def test_get_all_features_not_modified(self):
+        feature_cache.set(
+            feature_flag_svc.ALL_FEATURES_CACHE_KEY,
+            AllFeaturesList(features=[]),
+            feature_cache.version,
+            7,
+        )
+
+        response = client.get("/api/v1/features", headers={"If-None-Match": '"7"'})
+        assert response.status_code == 304
+        assert response.headers["ETag"] == '"7"'
+        assert response.content == b""
+        self.mock_get_all_features.assert_not_awaited()
+
+    @pytest.mark.asyncio
+    async def test_get_all_features_cached_before_client_write(self):
+        self.mock_get_all_features.return_value = AllFeaturesList(features=[])
+        feature_cache.set(
+            feature_flag_svc.ALL_FEATURES_CACHE_KEY,
+            AllFeaturesList(features=[]),
+            feature_cache.version,
+            7,
+        )
+
+        response = client.get(
+            "/api/v1/features",
+            headers={"If-None-Match": '"7"', "X-Min-Flag-Set-Version": "8"},
+        )
+        assert response.status_code == 200
+        self.mock_get_all_features.assert_awaited_once_with(ANY, 8)
+
+    @pytest.mark.asyncio
+    async def test_get_all_features_stale_etag(self):
+        self.mock_get_all_features.return_value = AllFeaturesList(features=[])
+        response = client.get("/api/v1/features", headers={"If-None-Match": '"6"'})
+        assert response.status_code == 200
+
+
+class TestGetAllFeaturesFastJson:
+    @pytest.fixture(autouse=True)
+    def setup_method(self, mocker, monkeypatch):
+        monkeypatch.setattr("app.routers.v1.feature_flag.FAST_JSON_RESPONSES", True)
+        self.mock_get_all_features_json = mocker.patch.object(
+            feature_flag_svc, "get_all_features_json", new_callable=AsyncMock
+        )
+        self.mock_get_all_features_json.return_value = b'{"features":[]}'
+
+    @pytest.mark.asyncio
+    async def test_get_all_features_bytes(self):
+        feature_cache.set(
+            feature_flag_svc.ALL_FEATURES_JSON_CACHE_KEY,
+            b'{"features":[]}',
+            feature_cache.version,
+            7,
+        )
+        response = client.get("/api/v1/features")
+        assert response.status_code == 200
+        assert response.content == b'{"features":[]}'
+        assert response.headers["content-type"] == "application/json"
+        assert response.headers["ETag"] == '"7"'
+
+    @pytest.mark.asyncio
+    async def test_get_all_features_not_modified(self):
+        feature_cache.set(
+            feature_flag_svc.ALL_FEATURES_JSON_CACHE_KEY,
+            b'{"features":[]}',
+            feature_cache.version,
+            7,
+        )
+        response = client.get("/api/v1/features", headers={"If-None-Match": '"7"'})
+        assert response.status_code == 304
+        self.mock_get_all_features_json.assert_not_awaited()
+
+
+class TestGetFeaturesPage:
+    @pytest.fixture(autouse=True)
+    def setup_method(self, mocker):
+        self.mock_get_features_page = mocker.patch.object(
+            feature_flag_svc, "get_features_page", new_callable=AsyncMock
+        )
+        self.mock_get_all_features = mocker.patch.object(
+            feature_flag_svc, "get_all_features", new_callable=AsyncMock
+        )
+
+    @pytest.mark.asyncio
+    async def test_get_features_page(self):
+        self.mock_get_features_page.return_value = AllFeaturesList(
+            features=[Feature(id=1, name="Feature A", is_enabled=True)],
+            next_cursor="abc",
+        )
+        response = client.get(
+            "/api/v1/features",
+            params={"limit": 1, "cursor": "xyz", "is_enabled": "true"},
+        )
+        assert response.status_code == 200
+        assert response.json()["next_cursor"] == "abc"
+        assert self.mock_get_features_page.await_args.args[1:] == (
+            1,
+            "xyz",
+            True,
+            None,
+        )
+        self.mock_get_all_features.assert_not_awaited()
+
+    @pytest.mark.asyncio
+    async def test_get_features_page_default_limit(self):
+        self.mock_get_features_page.return_value = AllFeaturesList(features=[])
+        response = client.get("/api/v1/features", params={"parent_id": 3})
+        assert response.status_code == 200
+        assert self.mock_get_features_page.await_args.args[1:] == (
+            100,
+            None,
+            None,
+            3,
+        )
+
+    @pytest.mark.asyncio
+    async def test_get_features_page_invalid_cursor(self):
+        self.mock_get_features_page.side_effect = InvalidCursorException()
+        response = client.get("/api/v1/features", params={"cursor": "garbage"})
+        assert response.status_code == 400
+        assert response.json()["detail"] == "Invalid cursor"
+
+    @pytest.mark.asyncio
+    async def test_get_features_page_limit_too_large(self):
+        response = client.get("/api/v1/features", params={"limit": 100000})
+        assert response.status_code == 422
+        self.mock_get_features_page.assert_not_awaited()
+
+
+class TestEvaluateFeatures:
+    @pytest.fixture(autouse=True)
+    def setup_method(self, mocker):
+        self.mock_evaluate_features = mocker.patch.object(
+            feature_flag_svc, "evaluate_features", new_callable=AsyncMock
+        )
+
+    @pytest.mark.asyncio
+    async def test_evaluate_features_success(self):
+        self.mock_evaluate_features.return_value = {"checkout": True, "search": False}
+
+        response = client.post(
+            "/api/v1/features/evaluate", json={"names": ["checkout", "search"]}
+        )
+        assert response.status_code == 200
+        assert response.json()["features"] == {"checkout": True, "search": False}
+
+    @pytest.mark.asyncio
+    async def test_evaluate_features_with_context(self):
+        self.mock_evaluate_features.return_value = {"checkout": True}
+
+        response = client.post(
+            "/api/v1/features/evaluate",
+            json={"names": ["checkout"], "context": {"user_id": "42", "age": 30}},
+        )
+        assert response.status_code == 200
+        assert self.mock_evaluate_features.await_args.args[2] == {
+            "user_id": "42",
+            "age": 30,
+        }
+
+    @pytest.mark.asyncio
+    async def test_evaluate_features_too_many_names(self):
+        response = client.post(
+            "/api/v1/features/evaluate", json={"names": ["feature"] * 1001}
+        )
+        assert response.status_code == 422
+
+
+class TestGetFeatureChanges:
+    @pytest.fixture(autouse=True)
+    def setup_method(self, mocker):
+        self.mock_get_feature_changes = mocker.patch.object(
+            feature_flag_svc, "get_feature_changes", new_callable=AsyncMock
+        )
+
+    @pytest.mark.asyncio
+    async def test_get_feature_changes_success(self):
+        self.mock_get_feature_changes.return_value = FeatureChanges(
+            version=5, deleted=[3]
+        )
+
+        response = client.get("/api/v1/features/changes?since=4")
+        assert response.status_code == 200
+        assert response.json() == {
+            "version": 5,
+            "resync": False,
+            "upserted": [],
+            "deleted": [3],
+        }
+        assert self.mock_get_feature_changes.await_args.args[1] == 4
+
+    @pytest.mark.asyncio
+    async def test_get_feature_changes_requires_since(self):
+        response = client.get("/api/v1/features/changes")
+        assert response.status_code == 422
+
+
+class TestFeatureRules:
+    @pytest.fixture(autouse=True)
+    def setup_method(self, mocker):
+        self.mock_get_feature_rules = mocker.patch.object(
+            feature_flag_svc, "get_feature_rules", new_callable=AsyncMock
+        )
+        self.mock_set_feature_rules = mocker.patch.object(
+            feature_flag_svc, "set_feature_rules", new_callable=AsyncMock
+        )
+        self.rules = {
+            "rules": [
+                {
+                    "conditions": [
+                        {"attribute": "country", "operator": "in", "values": ["IN"]}
+                    ],
+                    "rollout": 20.0,
+                }
+            ],
+            "rollout_key": "user_id",
+        }
+
+    @pytest.mark.asyncio
+    async def test_set_rules(self):
+        self.mock_set_feature_rules.side_effect = lambda db, id, rules, actor: rules
+        response = client.put(
+            "/api/v1/features/1/rules", json=self.rules, headers={"X-Actor": "alice"}
+        )
+        assert response.status_code == 200
+        assert response.json() == self.rules
+        assert self.mock_set_feature_rules.await_args.kwargs == {"actor": "alice"}
+        assert "X-Flag-Set-Version" in response.headers
+
+    @pytest.mark.asyncio
+    async def test_set_rules_invalid_rollout(self):
+        self.rules["rules"][0]["rollout"] = 120
+        response = client.put("/api/v1/features/1/rules", json=self.rules)
+        assert response.status_code == 422
+
+    @pytest.mark.asyncio
+    async def test_set_rules_feature_not_found(self):
+        self.mock_set_feature_rules.side_effect = FeatureNotFoundException()
+        response = client.put("/api/v1/features/1/rules", json=self.rules)
+        assert response.status_code == 404
+
+    @pytest.mark.asyncio
+    async def test_get_rules(self):
+        self.mock_get_feature_rules.return_value = FeatureRules(**self.rules)
+        response = client.get("/api/v1/features/1/rules")
+        assert response.status_code == 200
+        assert response.json() == self.rules
+
+    @pytest.mark.asyncio
+    async def test_get_rules_none(self):
+        self.mock_get_feature_rules.return_value = None
+        response = client.get("/api/v1/features/1/rules")
+        assert response.status_code == 404
+        assert response.json()["detail"] == "Feature has no targeting rules"
+
+    @pytest.mark.asyncio
+    async def test_delete_rules(self):
+        response = client.delete("/api/v1/features/1/rules")
+        assert response.status_code == 200
+        assert self.mock_set_feature_rules.await_args.args[1:] == (1, None)
+
+
+class TestGetFeatureUsage:
+    @pytest.fixture(autouse=True)
+    def setup_method(self, mocker):
+        self.mock_get_feature_usage = mocker.patch.object(
+            feature_flag_svc, "get_feature_usage", new_callable=AsyncMock
+        )
+
+    @pytest.mark.asyncio
+    async def test_get_feature_usage(self):
+        self.mock_get_feature_usage.return_value = FeatureUsageList(
+            features=[FeatureUsage(id=1, name="Old Flag")]
+        )
+        response = client.get(
+            "/api/v1/features/usage?unused_since=2026-01-01T00:00:00Z&limit=5"
+        )
+        assert response.status_code == 200
+        assert response.json() == {
+            "features": [
+                {
+                    "id": 1,
+                    "name": "Old Flag",
+                    "evaluations": 0,
+                    "last_evaluated_at": None,
+                }
+            ]
+        }
+        _, unused_since, limit = self.mock_get_feature_usage.await_args.args
+        assert (unused_since.year, limit) == (2026, 5)
+
+
+class TestGetFeatureHistory:
+    @pytest.fixture(autouse=True)
+    def setup_method(self, mocker):
+        self.mock_get_feature_history = mocker.patch.object(
+            feature_flag_svc, "get_feature_history", new_callable=AsyncMock
+        )
+        self.mock_get_feature_history.return_value = FeatureHistory()
+
+    @pytest.mark.asyncio
+    async def test_history_of_feature(self):
+        response = client.get(
+            "/api/v1/features/7/history",
+            params={"since": "2026-01-01T00:00:00Z", "limit": 10},
+        )
+        assert response.status_code == 200
+        assert response.json() == {"events": []}
+        _, feature_id, since, until, limit = (
+            self.mock_get_feature_history.await_args.args
+        )
+        assert (feature_id, since.year, until, limit) == (7, 2026, None, 10)
+
+    @pytest.mark.asyncio
+    async def test_history_of_all_features(self):
+        response = client.get("/api/v1/features/history")
+        assert response.status_code == 200
+        assert self.mock_get_feature_history.await_args.args[1] is None
+
+    @pytest.mark.asyncio
+    async def test_history_limit_too_large(self):
+        response = client.get("/api/v1/features/history?limit=100000")
+        assert response.status_code == 422
+
+
+class TestApplyBatch:
+    @pytest.fixture(autouse=True)
+    def setup_method(self, mocker):
+        self.mock_apply_batch = mocker.patch.object(
+            feature_flag_svc, "apply_batch", new_callable=AsyncMock
+        )
+
+    @pytest.mark.asyncio
+    async def test_apply_batch_success(self):
+        self.mock_apply_batch.return_value = BatchResult(
+            results=[BatchItemResult(index=0, op="delete", status_code=200)]
+        )
+        response = client.post(
+            "/api/v1/features/batch", json={"operations": [{"op": "delete", "id": 1}]}
+        )
+        assert response.status_code == 200
+        assert response.json()["results"][0]["status_code"] == 200
+
+    @pytest.mark.asyncio
+    async def test_apply_batch_invalid_operation(self):
+        self.mock_apply_batch.side_effect = BatchValidationException(
+            [(1, DuplicateFeatureNameException())]
+        )
+        response = client.post(
+            "/api/v1/features/batch",
+            json={
+                "operations": [
+                    {"op": "delete", "id": 1},
+                    {"op": "create", "name": "dup", "is_enabled": True},
+                ]
+            },
+        )
+        assert response.status_code == 400
+        results = response.json()["results"]
+        assert [item["status_code"] for item in results] == [424, 409]
+
+    @pytest.mark.asyncio
+    async def test_apply_batch_malformed_operation(self):
+        response = client.post(
+            "/api/v1/features/batch", json={"operations": [{"op": "update", "id": 1}]}
+        )
+        assert response.status_code == 422
+        self.mock_apply_batch.assert_not_awaited()
@@ -0,0 +1,96 @@
+from app.services.rules import (ROLLOUT_BUCKETS, CompiledRules, compile_rules,
+                                rollout_bucket)
+
+
+def rules(*rules, rollout_key="user_id"):
+    return {"rules": list(rules), "rollout_key": rollout_key}
+
+
+def condition(attribute, values, operator="in"):
+    return {"attribute": attribute, "operator": operator, "values": values}
+
+
+class TestCompileRules:
+    def test_conditions(self):
+        evaluate = compile_rules(
+            1,
+            rules(
+                {
+                    "conditions": [
+                        condition("country", ["IN", "US"]),
+                        condition("plan", ["free"], operator="not_in"),
+                    ],
+                    "rollout": 100,
+                }
+            ),
+        )
+        assert evaluate({"country": "IN", "plan": "pro"}) is True
+        assert evaluate({"country": "IN", "plan": "free"}) is False
+        assert evaluate({"country": "FR", "plan": "pro"}) is False
+        # a missing attribute is in no list
+        assert evaluate({"plan": "pro"}) is False
+        assert evaluate({"country": "US"}) is True
+
+    def test_first_matching_rule_decides(self):
+        evaluate = compile_rules(
+            1,
+            rules(
+                {"conditions": [condition("plan", ["internal"])], "rollout": 100},
+                {"conditions": [], "rollout": 0},
+            ),
+        )
+        assert evaluate({"plan": "internal", "user_id": "1"}) is True
+        assert evaluate({"plan": "pro", "user_id": "1"}) is False
+
+    def test_no_rules_is_off(self):
+        assert compile_rules(1, rules())({"user_id": "1"}) is False
+
+    def test_rollout_share(self):
+        evaluate = compile_rules(7, rules({"conditions": [], "rollout": 20}))
+        share = sum(evaluate({"user_id": user_id}) for user_id in range(10000))
+        assert 1800 < share < 2200
+
+    def test_rollout_needs_key(self):
+        evaluate = compile_rules(
+            7, rules({"conditions": [], "rollout": 50}, rollout_key="account")
+        )
+        assert evaluate({"user_id": "1"}) is False
+
+    def test_rollout_consistent_when_widened(self):
+        at_20 = compile_rules(7, rules({"conditions": [], "rollout": 20}))
+        at_30 = compile_rules(7, rules({"conditions": [], "rollout": 30}))
+        users = [{"user_id": user_id} for user_id in range(2000)]
+        assert all(at_30(user) for user in users if at_20(user))
+
+    def test_buckets_salted_by_feature(self):
+        buckets = [rollout_bucket(1, user_id) for user_id in range(100)]
+        assert buckets != [rollout_bucket(2, user_id) for user_id in range(100)]
+        assert all(0 <= bucket < ROLLOUT_BUCKETS for bucket in buckets)
+
+
+class TestCompiledRules:
+    def test_reused_until_rules_change(self):
+        compiled = CompiledRules()
+        everyone = rules({"conditions": [], "rollout": 100})
+        evaluate = compiled.get(1, everyone)
+        assert compiled.get(1, everyone) is evaluate
+        assert compiled.compiled == 1
+
+        nobody = rules({"conditions": [], "rollout": 0})
+        assert compiled.get(1, nobody)({"user_id": "1"}) is False
+        assert compiled.compiled == 2
+
+    def test_invalidate(self):
+        compiled = CompiledRules()
+        everyone = rules({"conditions": [], "rollout": 100})
+        compiled.get(1, everyone)
+        compiled.get(2, everyone)
+
+        compiled.invalidate([1])
+        compiled.get(1, everyone)
+        compiled.get(2, everyone)
+        assert compiled.compiled == 3
+
+        compiled.invalidate()
+        compiled.get(2, everyone)
+        assert compiled.compiled == 4
@@ -0,0 +1,42 @@
+import pytest
+from app.database.models import FeatureFlag
+from sqlalchemy import select
+from tests.perf.seed_data import DatasetPlan, plan_dataset, seed
+
+
+class TestPlanDataset:
+    def test_large_families(self):
+        plan = plan_dataset(
+            50000,
+            large_families=2,
+            large_family_size=5000,
+            family_size=9,
+            standalone_ratio=0.2,
+        )
+        assert plan.flags == 50000
+        assert plan.large_families * plan.large_family_size == 10000
+        assert plan.families == 3199
+        assert plan.standalone == 8008
+
+    def test_too_small(self):
+        with pytest.raises(ValueError):
+            plan_dataset(
+                100,
+                large_families=1,
+                large_family_size=5000,
+                family_size=9,
+                standalone_ratio=0.2,
+            )
+
+
+@pytest.mark.asyncio
+async def test_seed_manifest_display_names(db_session):
+    # the workloads PUT flags back with the display name of the manifest
+    manifest = await seed(db_session, "manifest_test", DatasetPlan(0, 0, 1, 2, 1))
+    flags = [*manifest["parents"], *manifest["leaves"], *manifest["standalone"]]
+    result = await db_session.execute(
+        select(FeatureFlag.id, FeatureFlag.display_name).where(
+            FeatureFlag.id.in_([flag["id"] for flag in flags])
+        )
+    )
+    assert {flag["id"]: flag["display_name"] for flag in flags} == dict(result.all())
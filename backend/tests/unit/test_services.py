@@ -1,469 +1,958 @@
-from unittest.mock import AsyncMock
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
 
 import pytest
 from app.database.models import FeatureFlag
-from app.routers.v1.schemas import Feature, FeatureCreate
+from app.routers.v1.schemas import BatchOperation, FeatureCreate
+from app.services.cache import feature_cache
+from app.services.events import RESYNC_FRAME, change_hub
 # Import your service functions and exceptions
-from app.services.feature_flag import (check_feature_name_exists,
-                                       create_feature, delete_feature,
-                                       dernomalize_feature_and_children_names,
-                                       get_all_features, get_feature_details,
-                                       update_feature, validate_parent)
-from app.utility.exceptions import (DBIntegrityError, DeletingParentFeature,
+from app.services.feature_flag import (apply_batch, create_feature,
+                                       decode_cursor, delete_feature,
+                                       encode_cursor, evaluate_features,
+                                       get_all_features, get_all_features_json,
+                                       get_feature_changes,
+                                       get_feature_details, get_features_page,
+                                       handle_feature_change_notification,
+                                       stream_feature_changes, update_feature)
+from app.utility.exceptions import (BatchValidationException, DBIntegrityError,
+                                    DeletingParentFeature,
                                     DuplicateFeatureNameException,
                                     FeatureNotFoundException,
+                                    InvalidCursorException,
+                                    NameLengthLimitException,
                                     NestedChildException, SelfParentException)
+from sqlalchemy.exc import IntegrityError
+
+
+@pytest.fixture(autouse=True)
+def fake_flag_set_version(monkeypatch):
+    # the flag set version only feeds ETags, no need to read it from the db here
+    fake = AsyncMock(return_value=0)
+    monkeypatch.setattr("app.services.feature_flag.get_flag_set_version", fake)
+    return fake
+
+
+def written_row(**columns):
+    # a row as returned by insert_feature / update_db_feature
+    row = dict(
+        id=1,
+        name="new_feature",
+        display_name=None,
+        is_enabled=True,
+        parent_id=None,
+        old_is_enabled=True,
+        children=None,
+        changed_children=None,
+        version=1,
+        ids=[1],
+        feature_found=True,
+        has_children=False,
+        parent_found=True,
+        parent_nested=False,
+    )
+    row.update(columns)
+    return SimpleNamespace(**row)
+
+
+def feature_row(id, name, is_enabled, parent_id=None, display_name=None):
+    # a row as returned by get_feature_rows
+    return SimpleNamespace(
+        id=id,
+        name=name,
+        display_name=display_name,
+        is_enabled=is_enabled,
+        parent_id=parent_id,
+    )
+
+
+def integrity_error(constraint_name):
+    # IntegrityError as raised through the asyncpg driver
+    cause = Exception()
+    cause.constraint_name = constraint_name
+    orig = Exception()
+    orig.__cause__ = cause
+    return IntegrityError("error", None, orig)
 
 
 # ------------------------------------------------------------
-# Test class for validate_parent
+# Test class for create_feature
 # ------------------------------------------------------------
-class TestValidateParent:
-    @pytest.mark.asyncio
-    async def test_self_parent_raises_exception(self, monkeypatch):
-        # When parent_id equals the current feature id, should raise SelfParentException
-        fake_feature = FeatureFlag(id=1, name="feat", is_enabled=True)
-        with pytest.raises(SelfParentException):
-            await validate_parent(AsyncMock(), 1, db_feature_with_children=fake_feature)
-
+class TestCreateFeature:
     @pytest.mark.asyncio
-    async def test_parent_not_found_raises_exception(self, monkeypatch):
-        # If parent_id is provided but get_feature_by_id returns None
-        async def fake_get_feature_by_id(db, parent_id, **kwargs):
-            return None
+    async def test_create_feature_success(self, monkeypatch):
+        # Prepare a FeatureCreate input
+        feature_in = FeatureCreate(name="New Feature", is_enabled=True, parent_id=None)
 
+        # Patch insert_feature to simulate the DB insert
+        fake_insert_feature = AsyncMock(return_value=written_row(id=1))
         monkeypatch.setattr(
-            "app.services.feature_flag.get_feature_by_id", fake_get_feature_by_id
+            "app.services.feature_flag.insert_feature", fake_insert_feature
         )
-        with pytest.raises(FeatureNotFoundException):
-            await validate_parent(AsyncMock(), 2)
+        db = AsyncMock()
 
-    @pytest.mark.asyncio
-    async def test_parent_with_own_parent_raises_exception(self, monkeypatch):
-        # Parent exists but its parent_id is not None => NestedChildException
-        fake_parent = FeatureFlag(id=2, name="parent", is_enabled=True, parent_id=1)
+        # Call create_feature
+        result = await create_feature(db, feature_in)
 
-        async def fake_get_feature_by_id(db, parent_id, **kwargs):
-            return fake_parent
+        # Check that the returned feature has the denormalized name and an id
+        assert result.id == 1
+        assert result.name == "New Feature"
+        assert result.children == []
+        # stored with the normalized name, in a single statement
+        fake_insert_feature.assert_awaited_once_with(
+            db, "new_feature", "New Feature", True, None
+        )
+        db.commit.assert_awaited_once()
+        assert feature_cache.version == 1
 
+    @pytest.mark.asyncio
+    async def test_create_feature_duplicate_name(self, monkeypatch):
+        feature_in = FeatureCreate(
+            name="Duplicate Feature", is_enabled=True, parent_id=None
+        )
+        # the unique index on the name is violated
         monkeypatch.setattr(
-            "app.services.feature_flag.get_feature_by_id", fake_get_feature_by_id
+            "app.services.feature_flag.insert_feature",
+            AsyncMock(side_effect=integrity_error("ix_feature_flags_name")),
         )
-        with pytest.raises(NestedChildException):
-            await validate_parent(AsyncMock(), 2)
+        db = AsyncMock()
+        with pytest.raises(DuplicateFeatureNameException):
+            await create_feature(db, feature_in)
+        db.rollback.assert_awaited_once()
 
     @pytest.mark.asyncio
-    async def test_current_feature_has_children_raises_exception(self, monkeypatch):
-        # Current feature already has children and a parent_id is provided => NestedChildException
-        fake_feature = FeatureFlag(id=3, name="child", is_enabled=True, parent_id=2)
-        # Simulate that the current feature has children
-        fake_feature.children = [FeatureFlag(id=4, name="grandchild", is_enabled=True)]
-
-        async def fake_get_feature_by_id(db, parent_id, **kwargs):
-            # Return a valid parent with no parent_id
-            return FeatureFlag(id=2, name="parent", is_enabled=True, parent_id=None)
+    async def test_create_feature_parent_not_found(self, monkeypatch):
+        feature_in = FeatureCreate(name="Feature", is_enabled=True, parent_id=2)
+        monkeypatch.setattr(
+            "app.services.feature_flag.insert_feature",
+            AsyncMock(return_value=written_row(id=None, parent_found=False)),
+        )
+        db = AsyncMock()
+        with pytest.raises(FeatureNotFoundException):
+            await create_feature(db, feature_in)
+        db.commit.assert_not_awaited()
 
+    @pytest.mark.asyncio
+    async def test_create_feature_nested_parent(self, monkeypatch):
+        feature_in = FeatureCreate(name="Feature", is_enabled=True, parent_id=2)
         monkeypatch.setattr(
-            "app.services.feature_flag.get_feature_by_id", fake_get_feature_by_id
+            "app.services.feature_flag.insert_feature",
+            AsyncMock(return_value=written_row(id=None, parent_nested=True)),
         )
         with pytest.raises(NestedChildException):
-            await validate_parent(AsyncMock(), 2, db_feature_with_children=fake_feature)
+            await create_feature(AsyncMock(), feature_in)
 
     @pytest.mark.asyncio
-    async def test_validate_parent_success(self, monkeypatch):
-        # Valid scenario: parent_id provided, parent exists, and parent's parent_id is None
-        fake_parent = FeatureFlag(id=2, name="parent", is_enabled=True, parent_id=None)
-
-        async def fake_get_feature_by_id(db, parent_id, **kwargs):
-            return fake_parent
-
+    async def test_create_feature_integrity_error(self, monkeypatch):
+        feature_in = FeatureCreate(name="Feature", is_enabled=True, parent_id=None)
+        # Simulate IntegrityError, not caused by a known constraint
         monkeypatch.setattr(
-            "app.services.feature_flag.get_feature_by_id", fake_get_feature_by_id
+            "app.services.feature_flag.insert_feature",
+            AsyncMock(side_effect=IntegrityError("error", None, None)),
         )
-        # Should not raise any exception
-        await validate_parent(AsyncMock(), 2)
+        with pytest.raises(DBIntegrityError):
+            await create_feature(AsyncMock(), feature_in)
 
 
 # ------------------------------------------------------------
-# Test class for check_feature_name_exists
+# Test class for get_feature_details
 # ------------------------------------------------------------
-class TestCheckFeatureNameExists:
+class TestGetFeatureDetails:
     @pytest.mark.asyncio
-    async def test_feature_not_exists(self, monkeypatch):
-        # When get_feature_by_name returns None, expect False
-        async def fake_get_feature_by_name(db, name):
-            return None
-
+    async def test_get_feature_details_not_found(self, monkeypatch):
+        # Patch get_feature_rows to return no rows
         monkeypatch.setattr(
-            "app.services.feature_flag.get_feature_by_name", fake_get_feature_by_name
+            "app.services.feature_flag.get_feature_rows", AsyncMock(return_value=[])
         )
-        result = await check_feature_name_exists(AsyncMock(), "somefeature")
-        assert result is False
+        with pytest.raises(FeatureNotFoundException):
+            await get_feature_details(AsyncMock(), feature_id=999)
 
     @pytest.mark.asyncio
-    async def test_feature_exists(self, monkeypatch):
-        # When get_feature_by_name returns a feature, expect True
-        fake_feature = FeatureFlag(id=1, name="somefeature", is_enabled=True)
-
-        async def fake_get_feature_by_name(db, name):
-            return fake_feature
-
+    async def test_get_feature_details_success(self, monkeypatch):
+        # the feature and its child, in name order
+        fake_get_feature_rows = AsyncMock(
+            return_value=[
+                feature_row(id=2, name="child", is_enabled=True, parent_id=1),
+                feature_row(id=1, name="test", is_enabled=True, parent_id=None),
+            ]
+        )
         monkeypatch.setattr(
-            "app.services.feature_flag.get_feature_by_name", fake_get_feature_by_name
+            "app.services.feature_flag.get_feature_rows", fake_get_feature_rows
         )
-        result = await check_feature_name_exists(AsyncMock(), "somefeature")
-        assert result is True
+        db = AsyncMock()
+        result = await get_feature_details(db, feature_id=1)
+        assert result.id == 1
+        assert result.name == "Test"
+        assert [child.name for child in result.children] == ["Child"]
+        fake_get_feature_rows.assert_awaited_once_with(db, 1)
 
+    @pytest.mark.asyncio
+    async def test_get_feature_details_counted_cached_or_not(self, monkeypatch):
+        usage = MagicMock()
+        monkeypatch.setattr("app.services.feature_flag.evaluation_usage", usage)
+        monkeypatch.setattr(
+            "app.services.feature_flag.get_feature_rows",
+            AsyncMock(return_value=[feature_row(id=1, name="test", is_enabled=True)]),
+        )
+        await get_feature_details(AsyncMock(), feature_id=1)
+        await get_feature_details(AsyncMock(), feature_id=1)
+        assert usage.count.call_args_list == [(([1],),)] * 2
 
-# ------------------------------------------------------------
-# Test class for dernomalize_feature_and_children_names
-# ------------------------------------------------------------
-class TestDernormalizeFeatureAndChildrenNames:
-    def test_dernormalize_feature_and_children_names(self, monkeypatch):
-        # Create a Feature instance with a child
-        feature = Feature(
-            id=1,
-            name="parent_feature_name",
-            is_enabled=True,
-            parent_id=None,
-            children=[
-                Feature(
-                    id=2,
-                    name="child_feature_1",
-                    is_enabled=False,
-                    parent_id=1,
-                    children=[],
-                )
-            ],
+    @pytest.mark.asyncio
+    async def test_get_feature_details_of_child(self, monkeypatch):
+        monkeypatch.setattr(
+            "app.services.feature_flag.get_feature_rows",
+            AsyncMock(
+                return_value=[
+                    feature_row(id=2, name="child", is_enabled=True, parent_id=1)
+                ]
+            ),
         )
-        # Call the function to update names
-        dernomalize_feature_and_children_names(feature)
-        assert feature.name == "Parent Feature Name"
-        assert feature.children[0].name == "Child Feature 1"
+        result = await get_feature_details(AsyncMock(), feature_id=2)
+        assert result.id == 2
+        assert result.parent_id == 1
+        assert result.children == []
 
 
 # ------------------------------------------------------------
-# Test class for create_feature
+# Test class for update_feature
 # ------------------------------------------------------------
-class TestCreateFeature:
+class TestUpdateFeature:
     @pytest.mark.asyncio
-    async def test_create_feature_success(self, monkeypatch, db_session: AsyncMock):
-        # Prepare a FeatureCreate input
-        feature_in = FeatureCreate(name="New Feature", is_enabled=True, parent_id=None)
-
-        # Patch check_feature_name_exists to return False (feature does not exist)
-        monkeypatch.setattr(
-            "app.services.feature_flag.check_feature_name_exists",
-            AsyncMock(return_value=False),
-        )
-        # Patch validate_parent (assume it passes)
+    async def test_update_feature_not_found(self, monkeypatch):
         monkeypatch.setattr(
-            "app.services.feature_flag.validate_parent", AsyncMock(return_value=None)
+            "app.services.feature_flag.update_db_feature",
+            AsyncMock(return_value=written_row(id=None, feature_found=False)),
         )
-
-        # Patch add_feature to simulate DB insert (no return value, but updates db_feature with an id)
-        async def fake_add_feature(db, db_feature):
-            db_feature.id = 1
-
-        monkeypatch.setattr("app.services.feature_flag.add_feature", fake_add_feature)
-        # Create a fake db_session that supports commit and refresh
-        fake_db_session = (
-            db_session  # Assume this is an AsyncMock representing AsyncSession
+        feature_update = FeatureCreate(
+            name="Updated Feature", is_enabled=False, parent_id=None
         )
-
-        # Call create_feature
-        result = await create_feature(fake_db_session, feature_in)
-
-        # Check that the returned feature has the normalized name and an id
-        assert result.id == 1
-        assert (
-            result.name == "New Feature"
-        )  # denormalization may change it, but for simplicity
+        with pytest.raises(FeatureNotFoundException):
+            await update_feature(
+                AsyncMock(), feature_id=1, feature_update=feature_update
+            )
 
     @pytest.mark.asyncio
-    async def test_create_feature_duplicate_name(
-        self, monkeypatch, db_session: AsyncMock
-    ):
-        feature_in = FeatureCreate(
-            name="Duplicate Feature", is_enabled=True, parent_id=None
-        )
-        # Patch check_feature_name_exists to return True
+    async def test_update_feature_duplicate_name(self, monkeypatch):
+        # the unique index on the name is violated
         monkeypatch.setattr(
-            "app.services.feature_flag.check_feature_name_exists",
-            AsyncMock(return_value=True),
+            "app.services.feature_flag.update_db_feature",
+            AsyncMock(side_effect=integrity_error("ix_feature_flags_name")),
+        )
+        feature_update = FeatureCreate(
+            name="Updated Feature", is_enabled=True, parent_id=None
         )
         with pytest.raises(DuplicateFeatureNameException):
-            await create_feature(db_session, feature_in)
+            await update_feature(
+                AsyncMock(), feature_id=1, feature_update=feature_update
+            )
 
     @pytest.mark.asyncio
-    async def test_create_feature_integrity_error(
-        self, monkeypatch, db_session: AsyncMock
-    ):
-        feature_in = FeatureCreate(name="Feature", is_enabled=True, parent_id=None)
+    async def test_update_feature_self_parent(self, monkeypatch):
+        fake_update_db_feature = AsyncMock()
         monkeypatch.setattr(
-            "app.services.feature_flag.check_feature_name_exists",
-            AsyncMock(return_value=False),
+            "app.services.feature_flag.update_db_feature", fake_update_db_feature
         )
+        feature_update = FeatureCreate(name="Feature", is_enabled=True, parent_id=1)
+        with pytest.raises(SelfParentException):
+            await update_feature(
+                AsyncMock(), feature_id=1, feature_update=feature_update
+            )
+        fake_update_db_feature.assert_not_awaited()
+
+    @pytest.mark.asyncio
+    async def test_update_feature_with_children_gets_parent(self, monkeypatch):
         monkeypatch.setattr(
-            "app.services.feature_flag.validate_parent", AsyncMock(return_value=None)
+            "app.services.feature_flag.update_db_feature",
+            AsyncMock(return_value=written_row(id=None, has_children=True)),
         )
+        feature_update = FeatureCreate(name="Feature", is_enabled=True, parent_id=2)
+        with pytest.raises(NestedChildException):
+            await update_feature(
+                AsyncMock(), feature_id=1, feature_update=feature_update
+            )
 
-        # Simulate IntegrityError by raising it in add_feature
-        async def fake_add_feature(db, db_feature):
-            from sqlalchemy.exc import IntegrityError
-
-            raise IntegrityError("error", None, None)
-
-        monkeypatch.setattr("app.services.feature_flag.add_feature", fake_add_feature)
-        with pytest.raises(DBIntegrityError):
-            await create_feature(db_session, feature_in)
-
-
-# ------------------------------------------------------------
-# Test class for get_feature_details
-# ------------------------------------------------------------
-class TestGetFeatureDetails:
     @pytest.mark.asyncio
-    async def test_get_feature_details_not_found(
-        self, monkeypatch, db_session: AsyncMock
-    ):
-        # Patch get_feature_by_id to return None
+    async def test_update_feature_success(self, monkeypatch):
+        # children as returned by the update, i.e. with their new status
+        child = {
+            "id": 2,
+            "name": "child",
+            "display_name": "child",
+            "is_enabled": False,
+            "parent_id": 1,
+        }
+        fake_update_db_feature = AsyncMock(
+            return_value=written_row(
+                id=1,
+                name="updated_feature",
+                is_enabled=False,
+                children=[child],
+                changed_children=[dict(child, old_is_enabled=True)],
+                ids=[1, 2],
+            )
+        )
         monkeypatch.setattr(
-            "app.services.feature_flag.get_feature_by_id", AsyncMock(return_value=None)
+            "app.services.feature_flag.update_db_feature", fake_update_db_feature
         )
-        with pytest.raises(FeatureNotFoundException):
-            await get_feature_details(db_session, feature_id=999)
+        db = AsyncMock()
+        feature_update = FeatureCreate(
+            name="Updated Feature", is_enabled=False, parent_id=None
+        )
+        result = await update_feature(db, feature_id=1, feature_update=feature_update)
+
+        # Check that the updated feature has new name and status
+        assert result.name == "Updated Feature"
+        assert result.is_enabled is False
+        # display names are copied as stored
+        assert result.children[0].name == "child"
+        assert result.children[0].is_enabled is False
+        fake_update_db_feature.assert_awaited_once_with(
+            db, 1, "updated_feature", "Updated Feature", False, None, children_limit=0
+        )
+        db.commit.assert_awaited_once()
 
     @pytest.mark.asyncio
-    async def test_get_feature_details_success(
-        self, monkeypatch, db_session: AsyncMock
-    ):
-        # Create a fake db feature with children
-        fake_db_feature = FeatureFlag(
-            id=1, name="test", is_enabled=True, parent_id=None
+    async def test_update_feature_children_updated_in_chunks(self, monkeypatch):
+        monkeypatch.setattr("app.services.feature_flag.CHILDREN_UPDATE_CHUNK_SIZE", 2)
+        children = [
+            {
+                "id": child_id,
+                "name": "child",
+                "display_name": None,
+                "is_enabled": False,
+                "old_is_enabled": True,
+                "parent_id": 1,
+            }
+            for child_id in (2, 3, 4, 5, 6)
+        ]
+        # only the first chunk of children is returned
+        monkeypatch.setattr(
+            "app.services.feature_flag.update_db_feature",
+            AsyncMock(
+                return_value=written_row(
+                    is_enabled=False,
+                    children=children[:2],
+                    changed_children=children[:2],
+                    ids=[1, 2, 3],
+                )
+            ),
+        )
+        # the remaining children, two per statement, until none is left
+        fake_update_children_status = AsyncMock(
+            side_effect=[
+                ({"version": 2, "ids": [4, 5], "origin": "test"}, children[2:4]),
+                ({"version": 3, "ids": [6], "origin": "test"}, children[4:]),
+                None,
+            ]
         )
-        fake_db_feature.children = []
         monkeypatch.setattr(
-            "app.services.feature_flag.get_feature_by_id",
-            AsyncMock(return_value=fake_db_feature),
+            "app.services.feature_flag.update_children_status",
+            fake_update_children_status,
         )
-        result = await get_feature_details(db_session, feature_id=1)
-        assert result.id == 1
-        assert result.name == "Test"
+        feature_cache.set(4, "cached", feature_cache.version)
+        db = AsyncMock()
+        feature_update = FeatureCreate(name="Feature", is_enabled=False, parent_id=None)
+        result = await update_feature(db, feature_id=1, feature_update=feature_update)
 
+        assert len(result.children) == 2
+        assert fake_update_children_status.await_count == 3
+        fake_update_children_status.assert_awaited_with(db, 1, False, 2)
+        db.commit.assert_awaited_once()
+        assert feature_cache.peek(4) is None
 
-# ------------------------------------------------------------
-# Test class for update_feature
-# ------------------------------------------------------------
-class TestUpdateFeature:
     @pytest.mark.asyncio
-    async def test_update_feature_not_found(self, monkeypatch, db_session: AsyncMock):
-        # Patch get_feature_by_id to return None
+    async def test_update_feature_integrity_error(self, monkeypatch):
         monkeypatch.setattr(
-            "app.services.feature_flag.get_feature_by_id", AsyncMock(return_value=None)
+            "app.services.feature_flag.update_db_feature",
+            AsyncMock(side_effect=IntegrityError("error", None, None)),
         )
+        db = AsyncMock()
         feature_update = FeatureCreate(
             name="Updated Feature", is_enabled=False, parent_id=None
         )
-        with pytest.raises(FeatureNotFoundException):
-            await update_feature(
-                db_session, feature_id=1, feature_update=feature_update
-            )
+        with pytest.raises(DBIntegrityError):
+            await update_feature(db, feature_id=1, feature_update=feature_update)
+        db.rollback.assert_awaited_once()
+
 
+# ------------------------------------------------------------
+# Test class for get_all_features
+# ------------------------------------------------------------
+class TestGetAllFeatures:
     @pytest.mark.asyncio
-    async def test_update_feature_duplicate_name(
-        self, monkeypatch, db_session: AsyncMock
-    ):
-        # Fake existing db_feature
-        fake_db_feature = FeatureFlag(
-            id=1, name="old_feature", is_enabled=True, parent_id=None
-        )
-        fake_db_feature.children = []
+    async def test_get_all_features_empty(self, monkeypatch):
+        # Patch get_feature_rows to return an empty list
         monkeypatch.setattr(
-            "app.services.feature_flag.get_feature_by_id",
-            AsyncMock(return_value=fake_db_feature),
+            "app.services.feature_flag.get_feature_rows", AsyncMock(return_value=[])
         )
-        # Patch get_feature_by_name to return an existing feature when new name is provided
+        result = await get_all_features(AsyncMock())
+        # Expect an empty features list
+        assert result.features == []
+
+    @pytest.mark.asyncio
+    async def test_get_all_features_success(self, monkeypatch):
+        # rows come in name order, children before their parent included
         monkeypatch.setattr(
-            "app.services.feature_flag.get_feature_by_name",
+            "app.services.feature_flag.get_feature_rows",
             AsyncMock(
-                return_value=FeatureFlag(id=2, name="updated_feature", is_enabled=True)
+                return_value=[
+                    feature_row(id=3, name="a_child", is_enabled=True, parent_id=2),
+                    feature_row(id=1, name="test_feature", is_enabled=True),
+                    feature_row(id=4, name="x_child", is_enabled=False, parent_id=2),
+                    feature_row(id=2, name="z_parent", is_enabled=True),
+                ]
             ),
         )
-        feature_update = FeatureCreate(
-            name="Updated Feature", is_enabled=True, parent_id=None
-        )
-        with pytest.raises(DuplicateFeatureNameException):
-            await update_feature(
-                db_session, feature_id=1, feature_update=feature_update
-            )
+        result = await get_all_features(AsyncMock())
+        # Expect the root features, with their children, in name order
+        assert [feature.id for feature in result.features] == [1, 2]
+        assert result.features[0].name == "Test Feature"
+        assert result.features[0].children == []
+        assert [child.name for child in result.features[1].children] == [
+            "A Child",
+            "X Child",
+        ]
 
     @pytest.mark.asyncio
-    async def test_update_feature_success_without_status_change(
-        self, monkeypatch, db_session: AsyncMock
-    ):
-        # Fake existing db_feature
-        fake_db_feature = FeatureFlag(
-            id=1, name="old_feature", is_enabled=True, parent_id=None
+    async def test_get_all_features_display_names(self, monkeypatch):
+        monkeypatch.setattr(
+            "app.services.feature_flag.get_feature_rows",
+            AsyncMock(
+                return_value=[
+                    # as typed by the user, not derived from the normalized name
+                    feature_row(
+                        id=1, name="ios_beta", is_enabled=True, display_name="iOS beta"
+                    ),
+                    # written before display names were stored
+                    feature_row(id=2, name="legacy_flag", is_enabled=True),
+                ]
+            ),
         )
-        fake_db_feature.children = [
-            FeatureFlag(id=2, name="child", is_enabled=False, parent_id=1)
+        result = await get_all_features(AsyncMock())
+        assert [feature.name for feature in result.features] == [
+            "iOS beta",
+            "Legacy Flag",
         ]
 
+    @pytest.mark.asyncio
+    async def test_get_all_features_served_from_cache(self, monkeypatch):
+        fake_get_feature_rows = AsyncMock(return_value=[])
         monkeypatch.setattr(
-            "app.services.feature_flag.get_feature_by_id",
-            AsyncMock(return_value=fake_db_feature),
+            "app.services.feature_flag.get_feature_rows", fake_get_feature_rows
         )
-        # Patch get_feature_by_name to return None (no duplicate)
+        first = await get_all_features(AsyncMock())
+        second = await get_all_features(AsyncMock())
+
+        # second call must not touch the db
+        assert first is second
+        assert fake_get_feature_rows.await_count == 1
+
+    @pytest.mark.asyncio
+    async def test_get_all_features_cache_invalidated_on_delete(self, monkeypatch):
+        fake_get_feature_rows = AsyncMock(return_value=[])
         monkeypatch.setattr(
-            "app.services.feature_flag.get_feature_by_name",
-            AsyncMock(return_value=None),
+            "app.services.feature_flag.get_feature_rows", fake_get_feature_rows
         )
-        # Patch validate_parent to do nothing
         monkeypatch.setattr(
-            "app.services.feature_flag.validate_parent", AsyncMock(return_value=None)
+            "app.services.feature_flag.delete_db_feature", AsyncMock(return_value=None)
+        )
+        await get_all_features(AsyncMock())
+        await delete_feature(AsyncMock(), 1)
+        await get_all_features(AsyncMock())
+
+        assert fake_get_feature_rows.await_count == 2
+
+
+class TestGetAllFeaturesJson:
+    @pytest.fixture(autouse=True)
+    def setup_method(self, monkeypatch):
+        self.fake_get_feature_rows = AsyncMock(
+            return_value=[
+                feature_row(id=3, name="a_child", is_enabled=True, parent_id=2),
+                feature_row(id=1, name="test_feature", is_enabled=True),
+                feature_row(id=2, name="z_parent", is_enabled=False),
+            ]
+        )
+        monkeypatch.setattr(
+            "app.services.feature_flag.get_feature_rows", self.fake_get_feature_rows
         )
 
-        # Simulate successful commit and refresh
-        async def fake_commit():
-            pass
-
-        monkeypatch.setattr(db_session, "commit", fake_commit)
+    @pytest.mark.asyncio
+    async def test_same_output_as_response_models(self):
+        content = await get_all_features_json(AsyncMock())
+        all_features = await get_all_features(AsyncMock())
+        assert content == all_features.model_dump_json().encode()
 
-        async def fake_refresh(feature, opts):
-            pass
+    @pytest.mark.asyncio
+    async def test_bytes_served_from_cache(self):
+        first = await get_all_features_json(AsyncMock())
+        second = await get_all_features_json(AsyncMock())
+        assert first is second
+        assert self.fake_get_feature_rows.await_count == 1
 
-        monkeypatch.setattr(db_session, "refresh", fake_refresh)
 
-        # Create a feature update
-        feature_update = FeatureCreate(
-            name="Updated Feature", is_enabled=True, parent_id=None
+# ------------------------------------------------------------
+# Test class for get_features_page
+# ------------------------------------------------------------
+class TestGetFeaturesPage:
+    @pytest.fixture(autouse=True)
+    def setup_method(self, monkeypatch):
+        self.roots = [
+            feature_row(id=1, name="feature_a", is_enabled=True, parent_id=None),
+            feature_row(id=2, name="feature_b", is_enabled=True, parent_id=None),
+            feature_row(id=3, name="feature_c", is_enabled=False, parent_id=None),
+        ]
+        children = [feature_row(id=4, name="child", is_enabled=True, parent_id=1)]
+        self.fake_get_db_features_page = AsyncMock(
+            side_effect=lambda db, limit, *args: self.roots[:limit]
         )
-        result = await update_feature(
-            db_session, feature_id=1, feature_update=feature_update
+        self.fake_get_db_children = AsyncMock(return_value=children)
+        monkeypatch.setattr(
+            "app.services.feature_flag.get_db_features_page",
+            self.fake_get_db_features_page,
+        )
+        monkeypatch.setattr(
+            "app.services.feature_flag.get_db_children", self.fake_get_db_children
         )
-        # Check that the updated feature has new name and status
-        assert result.name == "Updated Feature"
-        assert result.is_enabled is True
-        assert result.children[0].is_enabled is False  # no change here
 
     @pytest.mark.asyncio
-    async def test_update_feature_success_with_status_chage(
-        self, monkeypatch, db_session: AsyncMock
-    ):
-        # Fake existing db_feature
-        fake_db_feature = FeatureFlag(
-            id=1, name="old_feature", is_enabled=True, parent_id=None
-        )
-        fake_db_feature.children = [
-            FeatureFlag(id=2, name="child", is_enabled=True, parent_id=1)
+    async def test_get_features_page_with_next_page(self):
+        db = AsyncMock()
+        result = await get_features_page(db, limit=2, is_enabled=True)
+
+        assert [feature.name for feature in result.features] == [
+            "Feature A",
+            "Feature B",
         ]
+        assert result.features[0].children[0].name == "Child"
+        assert result.features[1].children == []
+        # one more row is fetched to know there is a next page
+        self.fake_get_db_features_page.assert_awaited_once_with(db, 3, None, True, None)
+        # as many children of each, and one more
+        self.fake_get_db_children.assert_awaited_once_with(db, [1, 2], 3)
+        assert decode_cursor(result.next_cursor) == "feature_b"
+        assert result.children_cursors == {}
 
-        monkeypatch.setattr(
-            "app.services.feature_flag.get_feature_by_id",
-            AsyncMock(return_value=fake_db_feature),
+    @pytest.mark.asyncio
+    async def test_get_features_page_children_capped(self):
+        self.fake_get_db_children.return_value = [
+            feature_row(id=5, name="child_a", is_enabled=True, parent_id=1),
+            feature_row(id=6, name="child_b", is_enabled=True, parent_id=1),
+            feature_row(id=7, name="child_c", is_enabled=True, parent_id=1),
+            feature_row(id=8, name="child_d", is_enabled=True, parent_id=2),
+        ]
+        result = await get_features_page(AsyncMock(), limit=2)
+
+        assert [child.id for child in result.features[0].children] == [5, 6]
+        assert [child.id for child in result.features[1].children] == [8]
+        # the rest of feature_a's children are paged with parent_id=1
+        assert list(result.children_cursors) == [1]
+        assert decode_cursor(result.children_cursors[1]) == "child_b"
+
+    @pytest.mark.asyncio
+    async def test_get_features_page_from_cursor(self):
+        db = AsyncMock()
+        result = await get_features_page(db, limit=5, cursor=encode_cursor("feature_b"))
+        assert len(result.features) == 3
+        assert result.next_cursor is None
+        assert self.fake_get_db_features_page.await_args.args[2] == "feature_b"
+
+    @pytest.mark.asyncio
+    async def test_get_features_page_of_children(self):
+        await get_features_page(AsyncMock(), limit=5, parent_id=1)
+        # children have no children of their own
+        self.fake_get_db_children.assert_not_awaited()
+
+    @pytest.mark.asyncio
+    async def test_get_features_page_invalid_cursor(self):
+        with pytest.raises(InvalidCursorException):
+            await get_features_page(AsyncMock(), limit=5, cursor="not a cursor")
+        self.fake_get_db_features_page.assert_not_awaited()
+
+
+# ------------------------------------------------------------
+# Test class for evaluate_features
+# ------------------------------------------------------------
+class TestEvaluateFeatures:
+    @pytest.fixture(autouse=True)
+    def setup_method(self, monkeypatch):
+        self.fake_get_feature_rows = AsyncMock(
+            return_value=[
+                feature_row(id=2, name="child", is_enabled=True, parent_id=1),
+                feature_row(id=3, name="new_checkout", is_enabled=True),
+                feature_row(id=1, name="parent", is_enabled=False),
+            ]
         )
-        # Patch get_feature_by_name to return None (no duplicate)
         monkeypatch.setattr(
-            "app.services.feature_flag.get_feature_by_name",
-            AsyncMock(return_value=None),
+            "app.services.feature_flag.get_feature_rows", self.fake_get_feature_rows
         )
-        # Patch validate_parent to do nothing
+        # no targeting rules unless a test adds some
+        self.fake_get_targeting_rules = AsyncMock(return_value=[])
         monkeypatch.setattr(
-            "app.services.feature_flag.validate_parent", AsyncMock(return_value=None)
+            "app.services.feature_flag.get_targeting_rules",
+            self.fake_get_targeting_rules,
         )
 
-        # Simulate successful commit and refresh
-        async def fake_commit():
-            pass
+    def targeting_row(self, id, name, rules=None, parent_id=None, parent_rules=None):
+        # a row as returned by get_targeting_rules
+        return SimpleNamespace(
+            id=id,
+            name=name,
+            parent_id=parent_id,
+            rules=rules,
+            parent_rules=parent_rules,
+        )
 
-        monkeypatch.setattr(db_session, "commit", fake_commit)
+    @pytest.mark.asyncio
+    async def test_evaluate_features_uses_effective_state(self):
+        result = await evaluate_features(
+            AsyncMock(), ["Parent", "child", " New Checkout ", "unknown"]
+        )
+        assert result == {
+            "Parent": False,
+            "child": False,  # disabled through its parent
+            " New Checkout ": True,
+            "unknown": False,
+        }
 
-        async def fake_refresh(feature, opts):
-            pass
+    @pytest.mark.asyncio
+    async def test_evaluate_features_index_built_once(self):
+        await evaluate_features(AsyncMock(), ["parent"])
+        await evaluate_features(AsyncMock(), ["child"])
+        assert self.fake_get_feature_rows.await_count == 1
 
-        monkeypatch.setattr(db_session, "refresh", fake_refresh)
+    @pytest.mark.asyncio
+    async def test_evaluations_counted(self, monkeypatch):
+        usage = MagicMock()
+        monkeypatch.setattr("app.services.feature_flag.evaluation_usage", usage)
+        await evaluate_features(AsyncMock(), ["Parent", " New Checkout ", "nope"])
+        # by id, names matching no flag aren't counted
+        usage.count.assert_called_once_with([1, 3])
 
-        # Create a feature update
-        feature_update = FeatureCreate(
-            name="Updated Feature", is_enabled=False, parent_id=None
+    @pytest.mark.asyncio
+    async def test_targeting_rules_select_users(self):
+        country_rules = {
+            "rules": [
+                {
+                    "conditions": [
+                        {"attribute": "country", "operator": "in", "values": ["IN"]}
+                    ],
+                    "rollout": 100,
+                }
+            ],
+            "rollout_key": "user_id",
+        }
+        self.fake_get_targeting_rules.return_value = [
+            self.targeting_row(3, "new_checkout", country_rules)
+        ]
+        names = ["new_checkout", "child"]
+
+        result = await evaluate_features(AsyncMock(), names, {"country": "IN"})
+        assert result == {"new_checkout": True, "child": False}
+        result = await evaluate_features(AsyncMock(), names, {"country": "US"})
+        assert result["new_checkout"] is False
+        # the rules only narrow down who gets an enabled feature
+        assert (await evaluate_features(AsyncMock(), ["child"], {}))["child"] is False
+
+    @pytest.mark.asyncio
+    async def test_parent_rules_gate_children(self, monkeypatch):
+        self.fake_get_feature_rows.return_value = [
+            feature_row(id=1, name="parent", is_enabled=True),
+            feature_row(id=2, name="child", is_enabled=True, parent_id=1),
+        ]
+        beta_only = {
+            "rules": [
+                {
+                    "conditions": [
+                        {"attribute": "plan", "operator": "in", "values": ["beta"]}
+                    ]
+                }
+            ]
+        }
+        self.fake_get_targeting_rules.return_value = [
+            self.targeting_row(1, "parent", beta_only),
+            self.targeting_row(2, "child", parent_id=1, parent_rules=beta_only),
+        ]
+
+        result = await evaluate_features(
+            AsyncMock(), ["parent", "child"], {"plan": "beta"}
         )
-        result = await update_feature(
-            db_session, feature_id=1, feature_update=feature_update
+        assert result == {"parent": True, "child": True}
+        result = await evaluate_features(
+            AsyncMock(), ["parent", "child"], {"plan": "free"}
         )
-        # Check that the updated feature has new name and status
-        assert result.name == "Updated Feature"
-        assert result.is_enabled is False
-        assert (
-            result.children[0].is_enabled is False
-        )  # children also gets updated as same
+        assert result == {"parent": False, "child": False}
+
 
+# ------------------------------------------------------------
+# Test class for get_feature_changes
+# ------------------------------------------------------------
+class TestGetFeatureChanges:
     @pytest.mark.asyncio
-    async def test_update_feature_integrity_error(
-        self, monkeypatch, db_session: AsyncMock
-    ):
-        fake_db_feature = FeatureFlag(
-            id=1, name="old_feature", is_enabled=True, parent_id=None
+    async def test_get_feature_changes_upserted_and_deleted(self, monkeypatch):
+        monkeypatch.setattr(
+            "app.services.feature_flag.get_changed_features",
+            AsyncMock(
+                return_value=(
+                    12,
+                    3,
+                    [
+                        (4, FeatureFlag(id=4, name="new_search", is_enabled=True)),
+                        (7, None),
+                    ],
+                )
+            ),
         )
-        fake_db_feature.children = []
+        result = await get_feature_changes(AsyncMock(), 10)
+
+        assert result.version == 12
+        assert result.resync is False
+        assert [feat.name for feat in result.upserted] == ["New Search"]
+        assert result.deleted == [7]
+
+    @pytest.mark.asyncio
+    async def test_get_feature_changes_up_to_date(self, monkeypatch):
         monkeypatch.setattr(
-            "app.services.feature_flag.get_feature_by_id",
-            AsyncMock(return_value=fake_db_feature),
+            "app.services.feature_flag.get_changed_features",
+            AsyncMock(return_value=(12, 3, [])),
         )
+        result = await get_feature_changes(AsyncMock(), 12)
+
+        assert result.version == 12
+        assert result.resync is False
+        assert result.upserted == [] and result.deleted == []
+
+    @pytest.mark.asyncio
+    async def test_get_feature_changes_compacted_cursor(self, monkeypatch):
+        # versions 6..8 are no longer in the change log
         monkeypatch.setattr(
-            "app.services.feature_flag.get_feature_by_name",
-            AsyncMock(return_value=None),
+            "app.services.feature_flag.get_changed_features",
+            AsyncMock(return_value=(12, 9, [])),
         )
+        result = await get_feature_changes(AsyncMock(), 5)
+
+        assert result.version == 12
+        assert result.resync is True
+
+    @pytest.mark.asyncio
+    async def test_get_feature_changes_cursor_from_the_future(self, monkeypatch):
         monkeypatch.setattr(
-            "app.services.feature_flag.validate_parent", AsyncMock(return_value=None)
+            "app.services.feature_flag.get_changed_features",
+            AsyncMock(return_value=(2, 1, [])),
         )
+        result = await get_feature_changes(AsyncMock(), 40)
+        assert result.resync is True
 
-        async def fake_commit():
-            from sqlalchemy.exc import IntegrityError
 
-            raise IntegrityError("error", None, None)
+# ------------------------------------------------------------
+# Test class for handle_feature_change_notification
+# ------------------------------------------------------------
+class TestHandleFeatureChangeNotification:
+    def test_change_from_other_worker_invalidates_changed_features(self):
+        feature_cache.set(1, "feature 1", feature_cache.version)
+        feature_cache.set(2, "feature 2", feature_cache.version)
+
+        handle_feature_change_notification(
+            {"version": 7, "ids": [1], "origin": "other-worker"}
+        )
+        assert feature_cache.peek(1) is None
+        assert feature_cache.peek(2) == "feature 2"
+        assert feature_cache.flag_set_version == 7
 
-        monkeypatch.setattr(db_session, "commit", fake_commit)
+    def test_own_change_is_skipped(self, monkeypatch):
+        monkeypatch.setattr("app.services.feature_flag.INSTANCE_ID", "this-worker")
+        feature_cache.set(1, "feature 1", feature_cache.version)
 
-        feature_update = FeatureCreate(
-            name="Updated Feature", is_enabled=False, parent_id=None
+        handle_feature_change_notification(
+            {"version": 7, "ids": [1], "origin": "this-worker"}
         )
-        with pytest.raises(DBIntegrityError):
-            await update_feature(
-                db_session, feature_id=1, feature_update=feature_update
-            )
+        assert feature_cache.peek(1) == "feature 1"
+
+    def test_reconnect_invalidates_everything(self):
+        feature_cache.set(1, "feature 1", feature_cache.version)
+        handle_feature_change_notification(None)
+        assert feature_cache.peek(1) is None
 
 
 # ------------------------------------------------------------
-# Test class for get_all_features
+# Test class for stream_feature_changes
 # ------------------------------------------------------------
-class TestGetAllFeatures:
+class TestStreamFeatureChanges:
+    @pytest.mark.asyncio
+    async def test_stream_yields_published_changes(self):
+        stream = stream_feature_changes()
+        next_frame = asyncio.ensure_future(stream.__anext__())
+        await asyncio.sleep(0)  # let the stream subscribe
+
+        handle_feature_change_notification(
+            {"version": 4, "ids": [1, 2], "origin": "other-worker"}
+        )
+        assert (await next_frame).startswith(b"id: 4\nevent: change\n")
+
+        await stream.aclose()
+        assert not change_hub.subscribers
+
     @pytest.mark.asyncio
-    async def test_get_all_features_empty(self, monkeypatch, db_session: AsyncMock):
-        # Patch get_all_db_features to return an empty list
+    async def test_stream_sends_keep_alive(self, monkeypatch):
         monkeypatch.setattr(
-            "app.services.feature_flag.get_all_db_features", AsyncMock(return_value=[])
+            "app.services.feature_flag.FEATURE_EVENTS_HEARTBEAT_SECONDS", 0.01
         )
-        result = await get_all_features(db_session)
-        # Expect an empty features list
-        assert result.features == []
+        stream = stream_feature_changes()
+        assert await stream.__anext__() == b": keep-alive\n\n"
+        await stream.aclose()
 
     @pytest.mark.asyncio
-    async def test_get_all_features_success(self, monkeypatch, db_session: AsyncMock):
-        # Create fake db features
-        fake_db_feature = FeatureFlag(
-            id=1, name="test_feature", is_enabled=True, parent_id=None
+    async def test_stream_closes_slow_client_with_resync(self):
+        stream = stream_feature_changes()
+        next_frame = asyncio.ensure_future(stream.__anext__())
+        await asyncio.sleep(0)
+        subscription = next(iter(change_hub.subscribers))
+        subscription.overflowed = True
+        subscription.queue.put_nowait(b"dropped")
+
+        assert await next_frame == RESYNC_FRAME
+        with pytest.raises(StopAsyncIteration):
+            await stream.__anext__()
+
+
+# ------------------------------------------------------------
+# Test class for apply_batch
+# ------------------------------------------------------------
+class TestApplyBatch:
+    @pytest.fixture(autouse=True)
+    def setup_method(self, monkeypatch):
+        # existing: kill_switch (1) with child checkout (2), and search (3)
+        self.db_rows = [
+            feature_row(id=1, name="kill_switch", is_enabled=True, parent_id=None),
+            feature_row(id=2, name="checkout", is_enabled=True, parent_id=1),
+            feature_row(id=3, name="search", is_enabled=True, parent_id=None),
+        ]
+        monkeypatch.setattr(
+            "app.services.feature_flag.get_batch_features",
+            AsyncMock(return_value=self.db_rows),
         )
-        fake_db_feature.children = []
+        self.bulk_update = AsyncMock()
+        self.bulk_delete = AsyncMock()
+        self.bulk_insert = AsyncMock(side_effect=[[10], [11]])
+        self.publish = AsyncMock(return_value={"version": 1, "ids": [], "origin": ""})
         monkeypatch.setattr(
-            "app.services.feature_flag.get_all_db_features",
-            AsyncMock(return_value=[fake_db_feature]),
+            "app.services.feature_flag.bulk_update_features", self.bulk_update
         )
-        result = await get_all_features(db_session)
-        # Expect a features list with one item
-        assert len(result.features) == 1
-        assert result.features[0].id == 1
-        assert result.features[0].name == "Test Feature"
+        monkeypatch.setattr(
+            "app.services.feature_flag.bulk_delete_features", self.bulk_delete
+        )
+        monkeypatch.setattr(
+            "app.services.feature_flag.bulk_insert_features", self.bulk_insert
+        )
+        monkeypatch.setattr(
+            "app.services.feature_flag.publish_feature_change", self.publish
+        )
+
+    @pytest.mark.asyncio
+    async def test_apply_batch_success(self):
+        operations = [
+            BatchOperation(op="create", name="Payments", is_enabled=True, ref="pay"),
+            BatchOperation(
+                op="create", name="Wallet", is_enabled=False, parent_ref="pay"
+            ),
+            BatchOperation(op="update", id=1, name="Kill Switch", is_enabled=False),
+            BatchOperation(op="delete", id=3),
+        ]
+        result = await apply_batch(AsyncMock(), operations)
+
+        # toggling the parent propagates to its child
+        assert sorted(
+            (row["id"], row["is_enabled"])
+            for row in self.bulk_update.await_args.args[1]
+        ) == [(1, False), (2, False)]
+        assert self.bulk_delete.await_args.args[1] == [3]
+        # the child goes in a second insert, with the new id of its parent
+        assert self.bulk_insert.await_args_list[0].args[1] == [
+            {
+                "name": "payments",
+                "display_name": "Payments",
+                "is_enabled": True,
+                "parent_id": None,
+            }
+        ]
+        assert self.bulk_insert.await_args_list[1].args[1] == [
+            {
+                "name": "wallet",
+                "display_name": "Wallet",
+                "is_enabled": False,
+                "parent_id": 10,
+            }
+        ]
+        assert sorted(self.publish.await_args.args[1]) == [1, 2, 3, 10, 11]
+
+        assert [item.status_code for item in result.results] == [200] * 4
+        assert result.results[1].feature.id == 11
+        assert result.results[1].feature.parent_id == 10
+        assert result.results[1].feature.name == "Wallet"
+        assert result.results[3].feature is None
+
+    @pytest.mark.asyncio
+    async def test_apply_batch_invalid_operations(self):
+        operations = [
+            BatchOperation(op="create", name="search", is_enabled=True),
+            BatchOperation(op="delete", id=1),
+            BatchOperation(op="create", name="ok", is_enabled=True),
+            BatchOperation(op="create", name="nested", is_enabled=True, parent_id=2),
+            BatchOperation(op="update", id=99, name="missing", is_enabled=True),
+            BatchOperation(op="create", name=" ", is_enabled=True),
+        ]
+        with pytest.raises(BatchValidationException) as exc_info:
+            await apply_batch(AsyncMock(), operations)
+
+        errors = {index: type(exc) for index, exc in exc_info.value.errors}
+        assert errors == {
+            0: DuplicateFeatureNameException,
+            1: DeletingParentFeature,
+            3: NestedChildException,
+            4: FeatureNotFoundException,
+            5: NameLengthLimitException,
+        }
+        self.bulk_insert.assert_not_awaited()
+        self.publish.assert_not_awaited()
+
+    @pytest.mark.asyncio
+    async def test_apply_batch_in_request_order(self):
+        operations = [
+            # the child is deleted, so the parent can go too
+            BatchOperation(op="delete", id=1),
+            BatchOperation(op="delete", id=2),
+            # the name is freed by the rename before it
+            BatchOperation(op="update", id=3, name="old search", is_enabled=True),
+            BatchOperation(op="create", name="search", is_enabled=True),
+        ]
+        result = await apply_batch(AsyncMock(), operations)
+
+        assert self.bulk_delete.await_args.args[1:] == ([1, 2], True)
+        assert [item.status_code for item in result.results] == [200] * 4
+
+        # the other way round, the name is still taken when created
+        operations = operations[:2] + operations[:1:-1]
+        with pytest.raises(BatchValidationException) as exc_info:
+            await apply_batch(AsyncMock(), operations)
+        assert [(index, type(exc)) for index, exc in exc_info.value.errors] == [
+            (2, DuplicateFeatureNameException)
+        ]
+
+    @pytest.mark.asyncio
+    async def test_apply_batch_rename_chain_written_in_order(self):
+        operations = [
+            BatchOperation(op="update", id=3, name="lookup", is_enabled=True),
+            BatchOperation(op="update", id=2, name="search", is_enabled=True),
+        ]
+        await apply_batch(AsyncMock(), operations)
+
+        # one statement, search is renamed before its name is taken
+        self.bulk_update.assert_awaited_once()
+        assert [
+            (row["id"], row["name"]) for row in self.bulk_update.await_args.args[1]
+        ] == [(3, "lookup"), (2, "search")]
 
 
 # ------------------------------------------------------------
@@ -500,8 +989,209 @@ class TestDeleteFeature:
 
     @pytest.mark.asyncio
     async def test_delete_feature_success(self, monkeypatch, db_session: AsyncMock):
-        # Patch delete_db_feature to return null
+        # Patch delete_db_feature to return the change it published: the deleted
+        # feature and its parent
         monkeypatch.setattr(
-            "app.services.feature_flag.delete_db_feature", AsyncMock(return_value=[])
+            "app.services.feature_flag.delete_db_feature",
+            AsyncMock(return_value={"version": 5, "ids": [1, 3], "origin": "worker"}),
         )
+        for feature_id in (1, 2, 3):
+            feature_cache.set(
+                feature_id, f"feature {feature_id}", feature_cache.version
+            )
+
         await delete_feature(db_session, 3)
+        assert feature_cache.peek(1) is None
+        assert feature_cache.peek(2) == "feature 2"
+        assert feature_cache.peek(3) is None
+        assert feature_cache.flag_set_version == 5
+
+
+class TestAuditEvents:
+    @pytest.fixture(autouse=True)
+    def setup_method(self, monkeypatch):
+        self.audit_log = MagicMock()
+        monkeypatch.setattr("app.services.feature_flag.audit_log", self.audit_log)
+
+    def recorded(self):
+        return [
+            event
+            for call in self.audit_log.record.call_args_list
+            for event in call.args
+        ]
+
+    @pytest.mark.asyncio
+    async def test_update_records_children_cascade(self, monkeypatch):
+        monkeypatch.setattr(
+            "app.services.feature_flag.update_db_feature",
+            AsyncMock(
+                return_value=written_row(
+                    is_enabled=False,
+                    old_is_enabled=True,
+                    children=[
+                        {
+                            "id": 2,
+                            "name": "child",
+                            "display_name": "Child",
+                            "is_enabled": False,
+                            "parent_id": 1,
+                        },
+                        # already off, not changed by the update
+                        {
+                            "id": 3,
+                            "name": "other_child",
+                            "display_name": None,
+                            "is_enabled": False,
+                            "parent_id": 1,
+                        },
+                    ],
+                    changed_children=[
+                        {
+                            "id": 2,
+                            "name": "child",
+                            "display_name": "Child",
+                            "is_enabled": False,
+                            "old_is_enabled": True,
+                            "parent_id": 1,
+                        }
+                    ],
+                    version=7,
+                )
+            ),
+        )
+        feature_update = FeatureCreate(name="New Feature", is_enabled=False)
+        await update_feature(AsyncMock(), 1, feature_update, actor="alice")
+
+        parent, child = self.recorded()
+        assert (parent["feature_id"], parent["action"], parent["actor"]) == (
+            1,
+            "update",
+            "alice",
+        )
+        assert (parent["is_enabled"], parent["old_is_enabled"]) == (False, True)
+        assert parent["flag_set_version"] == 7
+        assert (child["feature_id"], child["action"], child["name"]) == (
+            2,
+            "cascade",
+            "Child",
+        )
+        assert (child["is_enabled"], child["old_is_enabled"]) == (False, True)
+        assert child["parent_id"] == 1
+
+    @pytest.mark.asyncio
+    async def test_update_records_cascade_of_every_chunk(self, monkeypatch):
+        monkeypatch.setattr("app.services.feature_flag.CHILDREN_UPDATE_CHUNK_SIZE", 1)
+        children = [
+            {
+                "id": child_id,
+                "name": f"child_{child_id}",
+                "display_name": None,
+                "is_enabled": False,
+                "old_is_enabled": True,
+                "parent_id": 1,
+            }
+            for child_id in (2, 3)
+        ]
+        monkeypatch.setattr(
+            "app.services.feature_flag.update_db_feature",
+            AsyncMock(
+                return_value=written_row(
+                    is_enabled=False,
+                    old_is_enabled=True,
+                    children=children[:1],
+                    changed_children=children[:1],
+                    ids=[1, 2],
+                )
+            ),
+        )
+        monkeypatch.setattr(
+            "app.services.feature_flag.update_children_status",
+            AsyncMock(
+                side_effect=[
+                    ({"version": 2, "ids": [3], "origin": ""}, children[1:]),
+                    None,
+                ]
+            ),
+        )
+        feature_update = FeatureCreate(name="New Feature", is_enabled=False)
+        await update_feature(AsyncMock(), 1, feature_update)
+
+        assert [
+            (event["feature_id"], event["action"], event["flag_set_version"])
+            for event in self.recorded()
+        ] == [(1, "update", 2), (2, "cascade", 2), (3, "cascade", 2)]
+
+    @pytest.mark.asyncio
+    async def test_update_without_toggle_records_feature_only(self, monkeypatch):
+        monkeypatch.setattr(
+            "app.services.feature_flag.update_db_feature",
+            AsyncMock(
+                return_value=written_row(
+                    children=[
+                        {
+                            "id": 2,
+                            "name": "child",
+                            "display_name": None,
+                            "is_enabled": True,
+                            "old_is_enabled": True,
+                            "parent_id": 1,
+                        }
+                    ]
+                )
+            ),
+        )
+        feature_update = FeatureCreate(name="New Feature", is_enabled=True)
+        await update_feature(AsyncMock(), 1, feature_update)
+
+        assert [event["action"] for event in self.recorded()] == ["update"]
+
+    @pytest.mark.asyncio
+    async def test_failed_write_not_recorded(self, monkeypatch):
+        monkeypatch.setattr(
+            "app.services.feature_flag.insert_feature",
+            AsyncMock(side_effect=integrity_error("ix_feature_flags_name")),
+        )
+        with pytest.raises(DuplicateFeatureNameException):
+            await create_feature(
+                AsyncMock(), FeatureCreate(name="Taken", is_enabled=True)
+            )
+        self.audit_log.record.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_batch_records_each_feature(self, monkeypatch):
+        monkeypatch.setattr(
+            "app.services.feature_flag.get_batch_features",
+            AsyncMock(
+                return_value=[
+                    feature_row(id=1, name="kill_switch", is_enabled=True),
+                    feature_row(id=2, name="checkout", is_enabled=True, parent_id=1),
+                    # already off, not cascaded to
+                    feature_row(id=4, name="legacy", is_enabled=False, parent_id=1),
+                    feature_row(id=3, name="search", is_enabled=True),
+                ]
+            ),
+        )
+        for operation in ("bulk_update_features", "bulk_delete_features"):
+            monkeypatch.setattr(f"app.services.feature_flag.{operation}", AsyncMock())
+        monkeypatch.setattr(
+            "app.services.feature_flag.bulk_insert_features",
+            AsyncMock(side_effect=[[10], []]),
+        )
+        monkeypatch.setattr(
+            "app.services.feature_flag.publish_feature_change",
+            AsyncMock(return_value={"version": 4, "ids": [], "origin": ""}),
+        )
+        operations = [
+            BatchOperation(op="create", name="Payments", is_enabled=True),
+            BatchOperation(op="update", id=1, name="Kill Switch", is_enabled=False),
+            BatchOperation(op="delete", id=3),
+        ]
+        await apply_batch(AsyncMock(), operations, actor="bob")
+
+        events = {event["feature_id"]: event for event in self.recorded()}
+        assert {
+            feature_id: event["action"] for feature_id, event in events.items()
+        } == {10: "create", 1: "update", 2: "cascade", 3: "delete"}
+        assert (events[1]["old_is_enabled"], events[1]["is_enabled"]) == (True, False)
+        assert all(event["actor"] == "bob" for event in events.values())
+        assert all(event["flag_set_version"] == 4 for event in events.values())
@@ -0,0 +1,217 @@
+import json
+import struct
+from types import SimpleNamespace
+from unittest.mock import ANY, AsyncMock
+
+import pytest
+from app.main import app
+from app.routers.v1.schemas import AllFeaturesList
+from app.services import feature_flag as feature_flag_svc
+from app.services.cache import feature_cache
+from app.services.snapshot import (HEADER, Snapshot, SnapshotRefresher,
+                                   SnapshotStore, encode_snapshot)
+from fastapi.testclient import TestClient
+
+client = TestClient(app)
+
+
+def rows():
+    # (id, name, display_name, is_enabled, parent_id), in no particular order
+    return [
+        SimpleNamespace(
+            id=2,
+            name="checkout",
+            display_name="Checkout",
+            is_enabled=False,
+            parent_id=None,
+        ),
+        SimpleNamespace(
+            id=3, name="checkout_v2", display_name=None, is_enabled=True, parent_id=2
+        ),
+        SimpleNamespace(
+            id=1, name="beta", display_name="Beta ✨", is_enabled=True, parent_id=None
+        ),
+        SimpleNamespace(
+            id=4, name="beta_ui", display_name=None, is_enabled=True, parent_id=1
+        ),
+    ]
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = SnapshotStore(str(tmp_path / "flags.snapshot"))
+    monkeypatch.setattr("app.services.feature_flag.flag_snapshot", store)
+    monkeypatch.setattr("app.services.feature_flag.SHARED_SNAPSHOT_ENABLED", True)
+    return store
+
+
+class TestSnapshot:
+    def test_round_trip(self):
+        snapshot = Snapshot(encode_snapshot(7, rows(), b'{"features":[]}'))
+
+        assert snapshot.flag_set_version == 7
+        assert snapshot.count == 4
+        # sorted by name
+        assert list(snapshot.ids) == [1, 4, 2, 3]
+        assert list(snapshot.parent_ids) == [0, 1, 0, 2]
+        assert snapshot.name(0) == b"beta"
+        assert snapshot.is_enabled(3)
+        assert bytes(snapshot.features_json) == b'{"features":[]}'
+
+    def test_evaluate(self):
+        snapshot = Snapshot(encode_snapshot(7, rows(), b""))
+
+        assert snapshot.evaluate("beta_ui") is True
+        # enabled, but its parent isn't
+        assert snapshot.evaluate("checkout_v2") is False
+        assert snapshot.evaluate("checkout") is False
+        assert snapshot.evaluate("unknown") is False
+
+    def test_empty(self):
+        snapshot = Snapshot(encode_snapshot(0, [], b""))
+        assert snapshot.count == 0
+        assert snapshot.evaluate("beta") is False
+
+    def test_not_a_snapshot(self):
+        with pytest.raises(ValueError):
+            Snapshot(b"\0" * 64)
+
+    @pytest.mark.parametrize("size", [0, 10, 36, 37, 60, 130, -1])
+    def test_truncated(self, size):
+        data = encode_snapshot(7, rows(), b'{"features":[]}')
+        with pytest.raises(ValueError):
+            Snapshot(data[:size])
+
+    def test_corrupt_name_offsets(self):
+        data = bytearray(encode_snapshot(7, rows(), b""))
+        # second name offset, after the header, ids and parent ids
+        struct.pack_into("<I", data, HEADER.size + 16 * 4 + 4, 1000)
+        with pytest.raises(ValueError):
+            Snapshot(bytes(data))
+
+
+class TestSnapshotStore:
+    def test_publish_and_remap(self, tmp_path):
+        store = SnapshotStore(str(tmp_path / "flags.snapshot"))
+        assert store.current() is None
+
+        store.publish(encode_snapshot(1, rows(), b""))
+        first = store.current()
+        assert first.flag_set_version == 1
+        # not mapped again while the file is the same
+        assert store.current() is first
+
+        store.publish(encode_snapshot(2, rows(), b""))
+        assert store.current().flag_set_version == 2
+        # the old mapping stays readable
+        assert first.evaluate("beta")
+
+
+class TestSnapshotRefresher:
+    def test_single_leader(self, tmp_path):
+        store = SnapshotStore(str(tmp_path / "flags.snapshot"))
+        # one per worker, flock locks are per open file
+        leader, follower = SnapshotRefresher(store), SnapshotRefresher(store)
+        assert leader.try_lock() is True
+        assert follower.try_lock() is False
+
+    @pytest.mark.asyncio
+    async def test_refresh_only_when_version_moved(self, tmp_path):
+        store = SnapshotStore(str(tmp_path / "flags.snapshot"))
+        refresher = SnapshotRefresher(store)
+        build = AsyncMock(return_value=encode_snapshot(5, rows(), b""))
+
+        assert await refresher.refresh(build, AsyncMock(return_value=5)) is True
+        assert await refresher.refresh(build, AsyncMock(return_value=5)) is False
+        assert build.await_count == 1
+
+
+class TestSharedSnapshotReads:
+    @pytest.mark.asyncio
+    async def test_evaluate_features_without_db(self, store):
+        store.publish(encode_snapshot(3, rows(), b""))
+        result = await feature_flag_svc.evaluate_features(None, ["Beta UI", "nope"])
+        assert result == {"Beta UI": True, "nope": False}
+
+    @pytest.mark.asyncio
+    async def test_targeting_rules_without_db(self, store):
+        beta_testers = {
+            "rules": [
+                {
+                    "conditions": [
+                        {"attribute": "group", "operator": "in", "values": ["beta"]}
+                    ],
+                    "rollout": 100,
+                }
+            ]
+        }
+        targeting = [
+            {
+                "id": 4,
+                "name": "beta_ui",
+                "parent_id": 1,
+                "rules": beta_testers,
+                "parent_rules": None,
+            }
+        ]
+        store.publish(encode_snapshot(3, rows(), b"", json.dumps(targeting).encode()))
+
+        result = await feature_flag_svc.evaluate_features(
+            None, ["beta", "beta_ui"], {"group": "beta"}
+        )
+        assert result == {"beta": True, "beta_ui": True}
+        result = await feature_flag_svc.evaluate_features(None, ["beta", "beta_ui"])
+        assert result == {"beta": True, "beta_ui": False}
+
+    @pytest.mark.asyncio
+    async def test_truncated_file_falls_back_to_db(self, store, mocker):
+        store.publish(encode_snapshot(3, rows(), b"")[:-5])
+        mocker.patch.object(
+            feature_flag_svc,
+            "get_evaluation_index",
+            AsyncMock(return_value={"beta_ui": (4, True)}),
+        )
+        mocker.patch.object(
+            feature_flag_svc, "get_targeting_index", AsyncMock(return_value={})
+        )
+
+        assert store.current() is None
+        result = await feature_flag_svc.evaluate_features(None, ["Beta UI", "nope"])
+        assert result == {"Beta UI": True, "nope": False}
+
+    def test_stale_snapshot_not_used(self, store):
+        store.publish(encode_snapshot(3, rows(), b""))
+        assert feature_flag_svc.get_shared_snapshot() is not None
+        # this worker has seen a later change, e.g. its own write
+        feature_cache.observe_flag_set_version(4)
+        assert feature_flag_svc.get_shared_snapshot() is None
+
+    def test_get_all_features_from_snapshot(self, store, mocker):
+        get_all_features = mocker.patch.object(
+            feature_flag_svc, "get_all_features", new_callable=AsyncMock
+        )
+        store.publish(encode_snapshot(3, rows(), b'{"features":[]}'))
+
+        response = client.get("/api/v1/features")
+        assert response.status_code == 200
+        assert response.content == b'{"features":[]}'
+        assert response.headers["ETag"] == '"3"'
+
+        response = client.get("/api/v1/features", headers={"If-None-Match": '"3"'})
+        assert response.status_code == 304
+        get_all_features.assert_not_called()
+
+    def test_snapshot_older_than_client_write_not_used(self, store, mocker):
+        get_all_features = mocker.patch.object(
+            feature_flag_svc, "get_all_features", new_callable=AsyncMock
+        )
+        get_all_features.return_value = AllFeaturesList(features=[])
+        store.publish(encode_snapshot(3, rows(), b'{"features":[]}'))
+
+        # the client wrote version 4 through another worker
+        response = client.get(
+            "/api/v1/features",
+            headers={"If-None-Match": '"3"', "X-Min-Flag-Set-Version": "4"},
+        )
+        assert response.status_code == 200
+        get_all_features.assert_awaited_once_with(ANY, 4)
@@ -0,0 +1,158 @@
+import json
+
+import pytest
+from app.utility.tracing import (SPAN_KIND_SERVER, BatchSpanProcessor,
+                                 FileSpanExporter, OtlpHttpSpanExporter, Span,
+                                 Tracer, TracingMiddleware, instrument_engine,
+                                 parse_traceparent)
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+
+
+class MemoryExporter:
+    def __init__(self):
+        self.batches = []
+
+    def export(self, spans):
+        self.batches.append(list(spans))
+
+    @property
+    def spans(self):
+        return [span for batch in self.batches for span in batch]
+
+
+@pytest.fixture
+def exporter():
+    return MemoryExporter()
+
+
+@pytest.fixture
+def tracer(exporter):
+    tracer = Tracer(enabled=True, processor=BatchSpanProcessor(exporter))
+    yield tracer
+    tracer.shutdown()
+
+
+class TestTracer:
+    @pytest.mark.asyncio
+    async def test_nested_spans(self, tracer, exporter):
+        @tracer.traced("db")
+        async def get_rows():
+            return [1]
+
+        @tracer.traced("service")
+        async def get_features():
+            return await get_rows()
+
+        assert await get_features() == [1]
+        tracer.shutdown()
+
+        db_span, service_span = exporter.spans
+        assert db_span.name == "db.get_rows"
+        assert service_span.name == "service.get_features"
+        assert db_span.parent_id == service_span.span_id
+        assert db_span.trace_id == service_span.trace_id
+        assert service_span.parent_id is None
+
+    def test_error_recorded(self, tracer, exporter):
+        @tracer.traced("service")
+        def fail():
+            raise ValueError("boom")
+
+        with pytest.raises(ValueError):
+            fail()
+        tracer.shutdown()
+        assert exporter.spans[0].error == "ValueError: boom"
+
+    def test_disabled_leaves_functions_alone(self):
+        def get_rows():
+            pass
+
+        assert Tracer(enabled=False).traced("db")(get_rows) is get_rows
+
+
+class TestBatchSpanProcessor:
+    def test_batches_and_drops(self, exporter):
+        processor = BatchSpanProcessor(
+            exporter, batch_size=2, flush_seconds=60, queue_size=3
+        )
+        processor.queue.extend(Span("s") for _ in range(3))
+        processor.on_end(Span("dropped"))
+        processor.shutdown()
+
+        assert processor.dropped == 1
+        assert [len(batch) for batch in exporter.batches] == [2, 1]
+
+
+class TestExporters:
+    def ended_span(self):
+        span = Span("sql SELECT", attributes={"db.executemany": False, "rows": 2})
+        span.end_ns = span.start_ns + 1_500_000
+        return span
+
+    def test_file(self, tmp_path):
+        path = tmp_path / "spans.jsonl"
+        FileSpanExporter(str(path)).export([self.ended_span()])
+        span = json.loads(path.read_text())
+        assert span["name"] == "sql SELECT"
+        assert span["duration_ms"] == 1.5
+
+    def test_otlp_payload(self):
+        payload = OtlpHttpSpanExporter("http://collector", "feature-core").payload(
+            [self.ended_span()]
+        )
+        span = payload["resourceSpans"][0]["scopeSpans"][0]["spans"][0]
+        assert span["attributes"] == [
+            {"key": "db.executemany", "value": {"boolValue": False}},
+            {"key": "rows", "value": {"intValue": "2"}},
+        ]
+        assert span["status"] == {"code": 1}
+        assert "parentSpanId" not in span
+
+
+class TestTracingMiddleware:
+    def test_request_span(self, tracer, exporter):
+        app = FastAPI()
+
+        @app.get("/features/{feature_id}")
+        @tracer.traced("router")
+        async def get_feature(feature_id: int):
+            return {"id": feature_id}
+
+        app.add_middleware(TracingMiddleware, tracer=tracer)
+        trace_id = "4bf92f3577b34da6a3ce929d0e0e4736"
+        response = TestClient(app).get(
+            "/features/1",
+            headers={"traceparent": f"00-{trace_id}-00f067aa0ba902b7-01"},
+        )
+        tracer.shutdown()
+
+        assert response.json() == {"id": 1}
+        assert response.headers["x-trace-id"] == trace_id
+        handler_span, request_span = exporter.spans
+        assert request_span.name == "GET /features/{feature_id}"
+        assert request_span.kind == SPAN_KIND_SERVER
+        assert request_span.parent_id == "00f067aa0ba902b7"
+        assert request_span.attributes["http.status_code"] == 200
+        assert handler_span.parent_id == request_span.span_id
+
+    def test_parse_traceparent_invalid(self):
+        assert parse_traceparent("garbage") == (None, None)
+
+
+class TestInstrumentEngine:
+    def test_statement_spans(self, tracer, exporter):
+        engine = create_engine("sqlite://")
+        instrument_engine(engine, tracer)
+        with engine.connect() as conn:
+            # outside of a trace, not recorded
+            conn.execute(text("SELECT 1"))
+            with tracer.span("db.get_feature_rows"):
+                conn.execute(text("SELECT 2"))
+        tracer.shutdown()
+
+        statement_span, operation_span = exporter.spans
+        assert statement_span.name == "sql SELECT"
+        assert statement_span.attributes["db.statement"] == "SELECT 2"
+        assert statement_span.parent_id == operation_span.span_id
@@ -0,0 +1,79 @@
+import asyncio
+from datetime import datetime, timezone
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from app.services.usage import UsageCounters
+
+
+def session_factory(db):
+    # async context manager yielding `db`, like AsyncSessionLocal
+    factory = MagicMock()
+    factory.return_value.__aenter__ = AsyncMock(return_value=db)
+    factory.return_value.__aexit__ = AsyncMock(return_value=False)
+    return factory
+
+
+class TestUsageCounters:
+    @pytest.fixture(autouse=True)
+    def setup_method(self, monkeypatch):
+        self.upsert = AsyncMock()
+        monkeypatch.setattr("app.services.usage.upsert_feature_usage", self.upsert)
+        monkeypatch.setattr("app.services.usage.time.time", lambda: 1000.0)
+        self.db = AsyncMock()
+
+    def usage(self, **kwargs):
+        return UsageCounters(session_factory(self.db), enabled=True, **kwargs)
+
+    def test_count(self):
+        usage = self.usage()
+        usage.count([2, 1, 2])
+        assert usage.counts == {2: 2, 1: 1}
+        assert usage.last_evaluated == {2: 1000.0, 1: 1000.0}
+
+    def test_new_features_dropped_past_limit(self):
+        usage = self.usage(max_features=1)
+        usage.count([2, 1, 2])
+        assert usage.counts == {2: 2}
+        assert usage.stats()["dropped"] == 1
+
+    @pytest.mark.asyncio
+    async def test_flush_one_upsert_in_id_order(self):
+        usage = self.usage()
+        usage.count([2, 1, 2])
+
+        assert await usage.flush() is True
+        at = datetime.fromtimestamp(1000.0, timezone.utc)
+        self.upsert.assert_awaited_once_with(self.db, [1, 2], [1, 2], [at, at])
+        self.db.commit.assert_awaited_once()
+        assert usage.counts == {}
+        assert usage.stats()["flushed"] == 3
+
+    @pytest.mark.asyncio
+    async def test_failed_flush_counted_again(self):
+        usage = self.usage()
+        usage.count([2])
+        self.upsert.side_effect = OSError()
+        assert await usage.flush() is False
+
+        usage.count([2])
+        assert usage.counts == {2: 2}
+        assert usage.stats()["failed_flushes"] == 1
+
+    @pytest.mark.asyncio
+    async def test_nothing_to_flush(self):
+        assert await self.usage().flush() is True
+        self.upsert.assert_not_awaited()
+
+    @pytest.mark.asyncio
+    async def test_flushed_periodically_and_on_stop(self):
+        usage = self.usage(flush_seconds=0.01)
+        usage.start()
+        usage.count([2])
+        await asyncio.sleep(0.05)
+        self.upsert.assert_awaited_once()
+
+        usage.count([1])
+        await usage.stop()
+        assert self.upsert.await_count == 2
+        assert usage.counts == {}
@@ -2,7 +2,7 @@ import React, { useEffect, useState } from 'react';
 import { Container, Typography, Snackbar, Alert } from '@mui/material';
 import FeatureList from './components/FeatureList';
 import FeatureModal from './components/FeatureModal';
-import { fetchAllFeatures, updateFeature, deleteFeature } from './services/api';
+import { fetchAllFeatures, updateFeature, deleteFeature, subscribeToFeatureChanges } from './services/api';
 import logo from './assets/logo.png';
 
 const App = () => {
@@ -23,6 +23,8 @@ const App = () => {
 
   useEffect(() => {
     loadFeatures();
+    // reload whenever someone else changes a feature
+    return subscribeToFeatureChanges(() => loadFeatures());
   }, []);
 
   const handleSaveFeature = async (feature) => {
@@ -1,7 +1,9 @@
 import axios from 'axios';
 
+const API_URL = process.env.REACT_APP_API_URL || 'http://localhost:8000/api/v1'; // Fallback to localhost if env var is not set
+
 const API = axios.create({
-  baseURL: process.env.REACT_APP_API_URL || 'http://localhost:8000/api/v1', // Fallback to localhost if env var is not set
+  baseURL: API_URL,
 });
 
 export const fetchAllFeatures = async () => {
@@ -23,3 +25,12 @@ export const deleteFeature = async (featureId) => {
   const response = await API.delete(`/features/${featureId}`);
   return response.data;
 };
+
+// Calls onChange whenever features change on the server. Returns a function to unsubscribe
+export const subscribeToFeatureChanges = (onChange) => {
+  const source = new EventSource(`${API_URL}/features/stream`);
+  source.addEventListener('change', onChange);
+  // server asks us to fetch everything again (we missed some changes)
+  source.addEventListener('resync', onChange);
+  return () => source.close();
+};